@@ -0,0 +1,317 @@
+'''
+Asyncio CanOpen Client
+----------------------
+
+AsyncCanOpen runs the SDO protocol of CanOpen as coroutines.  Frames are
+received by the CanDispatcher of the wrapped CanOpen object and handed to
+the event loop with ``call_soon_threadsafe``; there they are queued for the
+transfer waiting on that COB-ID.  A coroutine waiting for a response costs
+a future, not a thread, so hundreds of node operations can run
+concurrently from one event loop::
+
+    client = AsyncCanOpen(canopen)
+    values = await asyncio.gather(*[client.SDOUpload(node, 0x1018, 1, 'unsigned32')
+                                    for node in range(1, 31)])
+
+    async with client.heartbeats() as stream:
+        async for frame in stream:
+            print(frame[0] - 0x700, frame[1][0])
+
+Transfers to the same node are serialized, transfers to different nodes
+run in parallel.  The frames of every transfer are built and checked by
+the same code as those of CanOpen, which runs it blocking (see
+CanOpen._sdoRun), so both return the same values and share the SdoCache.
+'''
+import asyncio
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger(__name__)
+
+
+#---------------------------------------------------------------------------#
+# Frame streams
+#---------------------------------------------------------------------------#
+class FrameStream(object):
+    ''' Async iterator over the frames of a set of COB-IDs
+
+    When the stream is not consumed fast enough the oldest frames are
+    discarded once maxsize frames are waiting.
+    '''
+
+    def __init__(self, client, cobIds, maxsize=256):
+        ''' Initialize the stream, frames are queued from now on
+
+        :param client: AsyncCanOpen delivering the frames
+        :param cobIds: iterable of COB-IDs to receive
+        :param maxsize: queue bound, 0 for unbounded
+        '''
+        self.client = client
+        self.cobIds = tuple(cobIds)
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+        client.dispatcher.addCallback(self.cobIds, self._receive)
+
+    def _receive(self, frame):
+        # dispatcher thread
+        self.client.loop.call_soon_threadsafe(self._put, frame)
+
+    def _put(self, frame):
+        if self.queue.full():
+            self.dropped += 1
+            self.queue.get_nowait()
+        self.queue.put_nowait(frame)
+
+    def close(self):
+        ''' Stop receiving frames
+        '''
+        self.client.dispatcher.removeCallback(self.cobIds, self._receive)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.queue.get()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, klass, value, traceback):
+        self.close()
+
+
+#---------------------------------------------------------------------------#
+# Client
+#---------------------------------------------------------------------------#
+class AsyncCanOpen(object):
+    ''' Coroutine versions of the CanOpen SDO services
+    '''
+
+    def __init__(self, canopen, loop=None):
+        ''' Initialize the client
+
+        The receive dispatcher of canopen is started if it is not running.
+        Must be created while the event loop runs, or be given the loop.
+
+        :param canopen: CanOpen object owning the channel
+        :param loop: event loop completing the futures, the running one if None
+        '''
+        self.canopen = canopen
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        self.dispatcher = canopen.startDispatcher()
+        # response COB-ID -> asyncio.Queue of the responses, number of requests sent
+        self.queues = {}
+        self.requests = {}
+        self.locks = {}
+        self.subscribed = set()
+
+    @property
+    def timeout(self):
+        return self.canopen.timeout
+
+    def close(self):
+        ''' Stop receiving SDO responses, the CanOpen object stays open
+        '''
+        for cobId in self.subscribed:
+            self.dispatcher.removeCallback(cobId, self._receive)
+        self.subscribed = set()
+
+    #-----------------------------------------------------------------------#
+    # Request / response
+    #-----------------------------------------------------------------------#
+    def _receive(self, frame):
+        # dispatcher thread; a frame which arrived before the request that is
+        # sent meanwhile is not the response to it
+        self.loop.call_soon_threadsafe(self._deliver, frame, self.requests.get(frame[0]))
+
+    def _deliver(self, frame, requests):
+        if self.requests.get(frame[0]) == requests:
+            self.queues[frame[0]].put_nowait(bytearray(frame[1]))
+
+    def _lock(self, nodeId):
+        lock = self.locks.get(nodeId)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.locks[nodeId] = lock
+        return lock
+
+    async def pingCanMessage(self, nodeIdSend, nodeIdReply, msg, timeout=None):
+        ''' Send a request and wait for the response
+
+        :param nodeIdSend : Communication object ID for request
+        :param nodeIdReply: Communication object Id for responce
+        :param msg        : message to be sent
+        :param timeout    : [sec], CanOpen.timeout if None
+        :returns          : responce message
+        '''
+        return await self._frames(nodeIdSend, nodeIdReply, (msg,), self.timeout if timeout is None else timeout)
+
+    async def _frames(self, nodeIdSend, nodeIdReply, frames, timeout):
+        ''' Send frames and wait for the next response, see CanOpen._sdoFrames
+
+        The responses are queued, the segments of a block upload arrive
+        faster than the steps of the transfer ask for them.
+
+        :param timeout: [sec], None - do not wait
+        :returns: the response, None if timeout is None
+        '''
+        if nodeIdReply not in self.subscribed:
+            self.queues[nodeIdReply] = asyncio.Queue()
+            self.requests[nodeIdReply] = 0
+            self.dispatcher.addCallback(nodeIdReply, self._receive)
+            self.subscribed.add(nodeIdReply)
+        queue = self.queues[nodeIdReply]
+        if frames:
+            # a late answer to a request that already timed out is not ours
+            self.requests[nodeIdReply] += 1
+            while not queue.empty():
+                queue.get_nowait()
+            for frame in frames:
+                self.dispatcher.write(nodeIdSend, frame)
+        if timeout is None:
+            return None
+        try:
+            return await asyncio.wait_for(queue.get(), timeout)
+        except asyncio.TimeoutError:
+            self.dispatcher.check()
+            _logger.error('Timeout waiting for COB-ID 0x%x' % nodeIdReply)
+            raise Exception('Timeout')
+
+    async def _run(self, nodeId, steps):
+        ''' Run the steps of an SDO transfer of CanOpen (see CanOpen._sdoRun),
+        awaiting the responses instead of blocking for them
+
+        :param steps: generator, e.g. CanOpen._sdoUploadSteps(...)
+        :returns: the value the generator returned
+        '''
+        async with self._lock(nodeId):
+            try:
+                msg = next(steps)
+                while True:
+                    try:
+                        if type(msg) is tuple:
+                            msgRet = await self._frames(nodeId + 0x600, nodeId + 0x580, *msg)
+                        else:
+                            msgRet = await self.pingCanMessage(nodeId + 0x600, nodeId + 0x580, msg)
+                    except Exception as ex:
+                        msg = steps.throw(ex)
+                    else:
+                        msg = steps.send(msgRet)
+            except StopIteration as stop:
+                return stop.value
+
+    #-----------------------------------------------------------------------#
+    # SDO
+    #-----------------------------------------------------------------------#
+    async def SDOUpload(self, nodeId, index, subindex=None, TypeIn=None, decode=True, cached=True):
+        ''' Read an object, expedited or segmented; see CanOpen.SDOUpload
+
+        :param index: index, name or OdEntry, see CanOpen.resolveObject
+        :returns: the value, as CanOpen.SDOUpload returns it
+        '''
+        return await self._run(nodeId, self.canopen._sdoUploadSteps(nodeId, index, subindex, TypeIn, decode, cached))
+
+    async def SDOUploadStream(self, nodeId, index, subindex=None, sink=None, progress=None):
+        ''' Upload a domain into a buffer or file; see CanOpen.SDOUploadStream
+
+        A file sink is written from the event loop thread.
+        '''
+        return await self._run(nodeId, self.canopen._sdoUploadStreamSteps(nodeId, index, subindex, sink, progress))
+
+    async def SDOUploadBlock(self, nodeId, index, subindex=None, size=127, pst=0):
+        ''' Read a domain by block upload; see CanOpen.SDOUploadBlock
+
+        :param size: blksize [1..127] requested from the server
+        :param pst: protocol switch threshold [bytes], 0 - no switch
+        :returns: the uploaded data (bytes)
+        '''
+        return await self._run(nodeId, self.canopen._sdoUploadBlockSteps(nodeId, index, subindex, size, pst))
+
+    async def SDODownload(self, nodeId, Index, SubIndex=None, data=None, Type=None):
+        ''' Write an object, expedited or segmented; see CanOpen.SDODownload
+
+        :param Index: index, name or OdEntry, see CanOpen.resolveObject
+        :param data: int / float, or for 'vis string' str, a buffer or a binary
+                     file, read from the event loop thread
+        :returns: 0
+        '''
+        return await self._run(nodeId, self.canopen._sdoDownloadSteps(nodeId, Index, SubIndex, data, Type))
+
+    async def SDODownloadBlock(self, nodeId, index, subindex=None, str_data=None, size=None):
+        ''' Write a domain by block download; see CanOpen.SDODownloadBlock
+
+        :param str_data: data to write, str or bytes-like object
+        :param size: number of bytes indicated to the server, len(str_data) if None
+        :returns: 0
+        '''
+        return await self._run(nodeId, self.canopen._sdoDownloadBlockSteps(nodeId, index, subindex, str_data, size))
+
+    async def upload_record(self, node, index, subindices=None, types=None):
+        ''' Read sub-indices of an array or record; see CanOpen.upload_record
+        '''
+        return await self._run(node, self.canopen._uploadRecordSteps(node, index, subindices, types))
+
+    async def download_record(self, node, index, values, types=None):
+        ''' Write sub-indices of an array or record; see CanOpen.download_record
+        '''
+        return await self._run(node, self.canopen._downloadRecordSteps(node, index, values, types))
+
+    async def SetPdoMapping(self, NodeId, PdoNum, FlagRxTxIn, TransType, IndexArr, SubIndexArr, LenArr, PdoCobId=None):
+        ''' Map a PDO; see CanOpen.SetPdoMapping
+
+        :param PdoNum: Number of PDO [1,4]
+        :param FlagRxTxIn: 'Rx' or 'Tx'
+        :param TransType: Transmission type [0...255]
+        :param IndexArr: indices of the objects to be mapped
+        :param SubIndexArr: sub-indices of the objects to be mapped
+        :param LenArr: lengths of the objects to be mapped [bits]
+        :param PdoCobId: if given, set as PDO COB-ID
+        '''
+        return await self._run(NodeId, self.canopen._setPdoMappingSteps(
+            NodeId, PdoNum, FlagRxTxIn, TransType, IndexArr, SubIndexArr, LenArr, PdoCobId))
+
+    async def SetOsIntCmd(self, str, NodeId=None):
+        ''' Send a string to the OS interpreter; see CanOpen.SetOsIntCmd
+
+        :param str: String to transmit
+        :param NodeId: Node ID, CanOpen.getNodeId() if None
+        :returns: Received string
+        '''
+        NodeId = self.canopen.getNodeId() if NodeId is None else NodeId
+        return await self._run(NodeId, self.canopen._setOsIntCmdSteps(NodeId, str))
+
+    #-----------------------------------------------------------------------#
+    # Streams
+    #-----------------------------------------------------------------------#
+    def frames(self, cobIds, maxsize=256):
+        ''' Stream the frames of any COB-IDs
+
+        :param cobIds: a COB-ID or an iterable of COB-IDs
+        :returns: FrameStream
+        '''
+        if isinstance(cobIds, int):
+            cobIds = (cobIds,)
+        return FrameStream(self, cobIds, maxsize)
+
+    def pdos(self, nodeId, pdoNums=(1, 2, 3, 4), maxsize=256):
+        ''' Stream the transmit PDOs of a node (0x180, 0x280, ... + Node ID)
+        '''
+        return self.frames([0x80 + 0x100 * num + nodeId for num in pdoNums], maxsize)
+
+    def emcys(self, nodeId=None, maxsize=256):
+        ''' Stream the EMCY messages of a node (0x80 + Node ID), all nodes if None
+        '''
+        return self.frames(range(0x81, 0x100) if nodeId is None else 0x80 + nodeId, maxsize)
+
+    def heartbeats(self, nodeId=None, maxsize=256):
+        ''' Stream the heartbeats of a node (0x700 + Node ID), all nodes if None
+        '''
+        return self.frames(range(0x701, 0x780) if nodeId is None else 0x700 + nodeId, maxsize)
+
+
+#---------------------------------------------------------------------------#
+# Exported symbols
+#---------------------------------------------------------------------------#
+__all__ = ['AsyncCanOpen', 'FrameStream']
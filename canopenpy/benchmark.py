@@ -0,0 +1,281 @@
+'''
+End-to-end Benchmarks
+---------------------
+
+Runs CanOpen against simulated slaves on a VirtualBus and reports
+
+* expedited SDO round trip latency (p50 / p99)
+* segmented and block SDO throughput
+* PDO receive rate and CPU time per received frame
+* GetRU decode time of a 16k sample recorder vector
+
+Every metric is the median of ``--repeat`` runs, so one run disturbed by
+the scheduler does not count as a regression.  Results are written as
+JSON; with a baseline file every metric is compared against it and the run
+fails if one got worse by more than the tolerance, which can be set per
+metric for the noisy ones::
+
+    python benchmark.py --json baseline.json --repeat 5
+    python benchmark.py --baseline baseline.json --tolerance 0.15 \
+        --metric-tolerance sdo_expedited_p99_us=0.5
+
+By default the bus runs at zero latency, so the numbers measure the
+Python side of the stack; ``--bitrate`` adds realistic frame timing.
+'''
+import sys
+import json
+import time
+import statistics
+import struct
+import platform
+import argparse
+import threading
+import canopenpy
+from virtualcan import VirtualBus
+from simslave import SimNetwork
+from dispatcher import CanDispatcher
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger(__name__)
+
+NODE = 1
+# (name, unit, True if higher is better)
+METRICS = [
+    ('sdo_expedited_p50_us', 'us', False),
+    ('sdo_expedited_p99_us', 'us', False),
+    ('sdo_segmented_Bps', 'B/s', True),
+    ('sdo_block_upload_Bps', 'B/s', True),
+    ('sdo_block_download_Bps', 'B/s', True),
+    ('pdo_rx_frames_per_s', 'frames/s', True),
+    ('pdo_cpu_us_per_frame', 'us', False),
+    ('getru_decode_ms', 'ms', False),
+]
+
+
+#---------------------------------------------------------------------------#
+# Helpers
+#---------------------------------------------------------------------------#
+def percentile(values, p):
+    ''' p-th percentile [0,100] of a sorted list '''
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def setup(bitrate=None, timeout=0.1):
+    ''' Build a bus with one simulated slave and a CanOpen master
+
+    :returns: (bus, network, canopen)
+    '''
+    bus = VirtualBus(bitrate or 1000000, zeroLatency=bitrate is None)
+    slave = bus.openChannel(1)
+    slave.open()
+    network = SimNetwork(slave)
+    network.addNode(NODE)
+    network.start()
+    master = bus.openChannel(0)
+    master.open()
+    canopen = canopenpy.CanOpen(master)
+    canopen.timeout = timeout
+    return bus, network, canopen
+
+
+def throughput(function, size, seconds):
+    ''' Repeat function for about seconds, return bytes/s '''
+    n = 0
+    start = time.perf_counter()
+    while True:
+        function()
+        n += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return n * size / elapsed
+
+
+#---------------------------------------------------------------------------#
+# Benchmarks
+#---------------------------------------------------------------------------#
+def benchSdo(results, count, seconds, bitrate):
+    bus, network, canopen = setup(bitrate)
+    server = network.servers[NODE]
+    try:
+        # expedited round trip
+        samples = []
+        for i in range(count):
+            start = time.perf_counter()
+            canopen.SDOUpload(NODE, 0x1018, 4, 'unsigned32')
+            samples.append(time.perf_counter() - start)
+        samples.sort()
+        results['sdo_expedited_p50_us'] = percentile(samples, 50) * 1e6
+        results['sdo_expedited_p99_us'] = percentile(samples, 99) * 1e6
+
+        data = bytes(range(256)) * 16
+        server.setObject(0x2000, 0, data, 'vis string')
+        results['sdo_segmented_Bps'] = throughput(
+            lambda: canopen.SDOUpload(NODE, 0x2000, 0, 'vis string', decode=False), len(data), seconds)
+        results['sdo_block_upload_Bps'] = throughput(
+            lambda: canopen.SDOUploadBlock(NODE, 0x2000, 0), len(data), seconds)
+        results['sdo_block_download_Bps'] = throughput(
+            lambda: canopen.SDODownloadBlock(NODE, 0x2000, 0, data), len(data), seconds)
+    finally:
+        network.stop()
+        canopen.close()
+
+
+def benchPdo(results, count, bitrate):
+    bus = VirtualBus(bitrate or 1000000, zeroLatency=bitrate is None)
+    producer = bus.openChannel(0)
+    consumer = bus.openChannel(1)
+    producer.open()
+    consumer.open()
+    done = threading.Event()
+    received = [0]
+
+    def onPdo(frame):
+        received[0] += 1
+        if received[0] == count:
+            done.set()
+
+    dispatcher = CanDispatcher(consumer, pollTimeout=0.01)
+    dispatcher.addCallback(range(0x181, 0x200), onPdo)
+    dispatcher.start()
+    msg = bytearray(8)
+    try:
+        cpu = time.process_time()
+        start = time.perf_counter()
+        for i in range(count):
+            struct.pack_into('<L', msg, 0, i)
+            producer.write(0x181 + i % 12, msg)
+        done.wait(60)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+    finally:
+        dispatcher.stop()
+    results['pdo_rx_frames_per_s'] = received[0] / elapsed
+    results['pdo_cpu_us_per_frame'] = cpu / max(received[0], 1) * 1e6
+
+
+def benchGetRU(results, repeat):
+    # float recorder: type 2, 16k samples, factor 0.5
+    samples = 16384
+    value = struct.pack('<BHf', 2, samples, 0.5) + struct.pack('<%df' % samples, *range(samples))
+    canopen = canopenpy.CanOpen(None)
+    # the decode alone, the upload is covered by the SDO benchmarks
+    canopen.SDOUpload = lambda *args, **kwargs: value
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        canopen.GetRU(NODE, 0)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    results['getru_decode_ms'] = best * 1e3
+
+
+def run(quick=False, bitrate=None, repeat=1, samples=None):
+    ''' Run all benchmarks
+
+    :param quick: shorter runs, for a smoke test
+    :param bitrate: bus bit rate, None for a zero latency bus
+    :param repeat: number of runs, every metric is the median of them
+    :param samples: None or a dict receiving {metric: [value of every run]}
+    :returns: {metric: value}
+    '''
+    samples = {} if samples is None else samples
+    for i in range(repeat):
+        results = {}
+        benchSdo(results, 500 if quick else 5000, 0.2 if quick else 1.0, bitrate)
+        benchPdo(results, 5000 if quick else 50000, bitrate)
+        benchGetRU(results, 3 if quick else 20)
+        for name, value in results.items():
+            samples.setdefault(name, []).append(value)
+    return dict((name, statistics.median(values)) for name, values in samples.items())
+
+
+#---------------------------------------------------------------------------#
+# Regression tracking
+#---------------------------------------------------------------------------#
+def compare(results, baseline, tolerance, metrics=METRICS, tolerances=None):
+    ''' Compare results against a baseline
+
+    :param tolerance: allowed relative deterioration, e.g. 0.1 for 10%
+    :param metrics: list of (name, unit, higher is better)
+    :param tolerances: None or {metric: tolerance} overriding tolerance
+    :returns: list of (metric, baseline, value, change, regressed)
+    '''
+    tolerances = tolerances or {}
+    rows = []
+    for name, unit, higherBetter in metrics:
+        if name not in results or name not in baseline:
+            continue
+        base, value = baseline[name], results[name]
+        change = (value - base) / base if base else 0.0
+        worse = -change if higherBetter else change
+        rows.append((name, base, value, change, worse > tolerances.get(name, tolerance)))
+    return rows
+
+
+def metricTolerance(text):
+    ''' argparse type of --metric-tolerance NAME=VALUE '''
+    name, sep, value = text.partition('=')
+    if not sep or name not in dict((metric[0], metric) for metric in METRICS):
+        raise argparse.ArgumentTypeError('expected METRIC=TOLERANCE with a metric of %s, got %r'
+                                         % (', '.join(metric[0] for metric in METRICS), text))
+    try:
+        return name, float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('tolerance of %s is not a number: %r' % (name, value))
+
+
+def report(results, rows=None, metrics=METRICS):
+    units = dict((name, unit) for name, unit, higherBetter in metrics)
+    if rows is None:
+        for name, unit, higherBetter in metrics:
+            if name in results:
+                print('%-30s %14.2f %s' % (name, results[name], unit))
+        return
+    for name, base, value, change, regressed in rows:
+        print('%-30s %14.2f %14.2f %-8s %+7.1f%% %s' % (name, base, value, units[name],
+                                                     change * 100, 'REGRESSION' if regressed else ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='CanOpen end-to-end benchmarks')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare against this results file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed relative deterioration (default 0.1)')
+    parser.add_argument('--metric-tolerance', type=metricTolerance, action='append', default=[],
+                        metavar='METRIC=TOLERANCE', help='tolerance of one metric, repeatable')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs per metric, the median counts (default 5)')
+    parser.add_argument('--bitrate', type=int, help='bus bit rate, zero latency bus if not given')
+    parser.add_argument('--quick', action='store_true', help='short smoke run')
+    args = parser.parse_args(argv)
+
+    samples = {}
+    results = run(args.quick, args.bitrate, args.repeat, samples)
+    document = {'meta': {'python': platform.python_version(),
+                         'platform': platform.platform(),
+                         'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                         'bitrate': args.bitrate,
+                         'quick': args.quick,
+                         'repeat': args.repeat},
+                'results': results,
+                'samples': samples}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+
+    if not args.baseline:
+        report(results)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    rows = compare(results, baseline, args.tolerance, tolerances=dict(args.metric_tolerance))
+    report(results, rows)
+    return 1 if any(row[4] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,6 +4,10 @@ import struct
 import logging
 import inspect
 import time
+try:
+    import numpy as np
+except ImportError:
+    np = None
 #from canlib import dict
 #------------------------------------------------------------------#
 # Canlib constants                                                 #
@@ -159,6 +163,10 @@ BaudTable = {1000000:canBITRATE_1M ,
             83000:canBITRATE_83K,
             10000:canBITRATE_10K }
 
+# record layout returned by canChannel.read_many
+if np is not None:
+    from common import canFrameDtype
+
 class canError(Exception):
     def __init__(self, canlib, canERR):
         self.canlib = canlib
@@ -201,7 +209,12 @@ class canlib(object):
     # definitions
     canMessage = 8 * c_uint8
 
-    def __init__(self, debug=None):
+    def __init__(self, debug=None, dll=None):
+        '''
+        :param debug: log at DEBUG level
+        :param dll  : path of a library to load instead of the Kvaser one,
+                      e.g. a stub exporting the same functions for benchmarks
+        '''
         fmt = '[%(levelname)s] %(funcName)s: %(message)s'
         if debug:
             logging.basicConfig(stream=sys.stderr,
@@ -212,7 +225,9 @@ class canlib(object):
                                 level=logging.ERROR,
                                 format=fmt)
 
-        if sys.platform.startswith('win'):
+        if dll is not None:
+            self.dll = CDLL(dll)
+        elif sys.platform.startswith('win'):
             self.dll = WinDLL('canlib32')
             self.dll.canInitializeLibrary()
         else:
@@ -268,13 +283,13 @@ class canlib(object):
                                                      POINTER(c_uint), POINTER(c_uint),
                                                      POINTER(c_ulong)]
             self.dll.canReadSpecificSkip.errcheck = self._canErrorCheck
-        except Exception(e):
+        except AttributeError as e:
             print ('Info:', e, '(Not implemented in Linux)')
 
         try:
             self.dll.canReadSyncSpecific.argtypes = [c_int, c_long, c_ulong]
             self.dll.canReadSyncSpecific.errcheck = self._canErrorCheck
-        except Exception(e):
+        except AttributeError as e:
             print ('Info:', e, '(Not implemented in Linux)')
 
         self.dll.canSetBusOutputControl.argtypes = [c_int, c_ulong]
@@ -290,7 +305,7 @@ class canlib(object):
             self.dll.kvScriptSendEvent.argtypes = [c_int, c_int, c_int, c_int, c_uint]
             self.dll.kvScriptSendEvent.errcheck = self._canErrorCheck
 
-        except Exception(e):
+        except AttributeError as e:
             print ('Info:', e, '(Not implemented in Linux)')
 
 
@@ -411,7 +426,7 @@ class canlib(object):
         (build, release, minor, major) = struct.unpack('HHHH', buf)
         return (major, minor, build)
 
-    def openChannel(self, channel, flags=0):
+    def openChannel(self, channel, flags=0, fastPath=False):
         '''Opens a CAN channel (circuit) and returns a handle which is used in subsequent calls to CANLIB.
         Channel numbering is dependent on the installed hardware. The first channel always has number 0.
         For example,
@@ -422,6 +437,8 @@ class canlib(object):
         channel - The number of the channel. Channel numbering is hardware dependent
         flags  - A combination of canOPEN_xxx flags(for more information about flags for this function see canlib.h ) 
         
+        fastPath - return a canFastChannel (reused ctypes buffers, bytes payload) 
+        
         Returns object of type canChannel of  opened circuit, or canERR_xxx (negative) if the call failed'''
 
         #if channel in self.getNumberOfChannels():
@@ -431,6 +448,8 @@ class canlib(object):
         #        (self.canlib.getChannelData_Name(), self.canlib.getChannelData_EAN()))
 
         self.fn = inspect.stack()[0][3]
+        if fastPath:
+            return canFastChannel(self, channel, flags)
         return canChannel(self, channel, flags)
 
    
@@ -606,6 +625,41 @@ canERR_xxx (negative) if failure
         msgList = [msg[i] for i in range(len(msg))]
         return id.value, msgList[:dlc.value], dlc.value, flag.value, time.value ,returns
 
+    def read_many(self, max_frames=512, timeout=0):
+        '''Drains the receive buffer in one call.
+        Waits up to timeout [ms] for the first message, then reads everything 
+        that is already queued, up to max_frames messages.
+        Returns a NumPy structured array of canFrameDtype with the fields
+        timestamp, id, flags, dlc, data[8]  (empty if no message arrived),
+        data beyond dlc is zero
+        '''
+        if np is None:
+            raise ImportError('read_many requires numpy')
+        self.canlib.fn = 'read_many'
+        frames = np.zeros(max_frames, dtype=canFrameDtype)
+        stamps, ids, flags, dlcs, datas = [frames[name] for name in canFrameDtype.names]
+        msg = self.canlib.canMessage()
+        id = c_long()
+        dlc = c_uint()
+        flag = c_uint()
+        time = c_ulong()
+        refs = (byref(id), byref(msg), byref(dlc), byref(flag), byref(time))
+        # msg is reused, only its first dlc bytes belong to the frame
+        msgView = np.frombuffer(msg, dtype=np.uint8)
+        n = 0
+        try:
+            while n < max_frames:
+                self.dll.canReadWait(self.handle, *refs, timeout if n == 0 else 0)
+                stamps[n] = time.value
+                ids[n] = id.value
+                flags[n] = flag.value
+                dlcs[n] = dlc.value
+                datas[n, :dlc.value] = msgView[:dlc.value]     # stops at 8 for a dlc above 8
+                n += 1
+        except canNoMsg:
+            pass
+        return frames[:n]
+
     def readDeviceCustomerData(self, userNumber=100, itemNumber=0):
         self.fn = inspect.stack()[0][3]
         buf_type = c_uint8 * 8
@@ -631,23 +685,36 @@ canERR_xxx (negative) if failure
         '''
         self.canlib.fn = inspect.stack()[0][3]
         msg = self.canlib.canMessage()
-        id = c_long(id)
         dlc = c_uint()
         flag = c_uint()
-        time = c_ulong(timeout)
-        self.dll.canReadSpecificSkip(self.handle, id, byref(msg), byref(dlc),
+        time = c_ulong()
+        returns = self.dll.canReadSpecificSkip(self.handle, id, byref(msg), byref(dlc),
                                      byref(flag), byref(time))
         msgList = [msg[i] for i in range(len(msg))]
-        return id.value, msgList[:dlc.value], dlc.value, flag.value, time.value
+        return id, msgList[:dlc.value], dlc.value, flag.value, time.value, returns
 
     def readSyncSpecific(self, id, timeout=0):
-        '''Reads a message with a specified identifier from the receive buffer.
+        '''Waits until the receive queue contains a message with the specified identifier,
+        or a timeout occurs. The message is not removed from the receive buffer.
         Any preceding message not matching the specified identifier will be kept
-        in the receive buffer. If no message with the specified identifier is available,
-        the function returns immediately with an error code.'''
+        in the receive buffer.
+        Raises canNoMsg if no such message arrived within timeout [ms].'''
         self.canlib.fn = inspect.stack()[0][3]
-        id = c_long(id)
-        self.dll.canReadSyncSpecific(self.handle, id, timeout)
+        try:
+            self.dll.canReadSyncSpecific(self.handle, id, timeout)
+        except canError as ce:
+            if ce.canERR == canERR_TIMEOUT:
+                raise canNoMsg(self.canlib, ce.canERR)
+            raise
+
+    def readSpecific(self, id, timeout=0):
+        '''Waits in the driver up to timeout [ms] for a message with the specified
+        identifier and removes it from the receive buffer, together with any
+        preceding message not matching the identifier.
+        The call returns as soon as the message arrives.
+        Returns the message in the format of read(), raises canNoMsg on timeout'''
+        self.readSyncSpecific(id, timeout)
+        return self.readSpecificSkip(id)
 
     def scriptSendEvent(self, slotNo=0, eventType=kvEVENT_TYPE_KEY, eventNo=ord('a'), data=0):
         self.canlib.fn = inspect.stack()[0][3]
@@ -717,6 +784,64 @@ canERR_xxx (negative) if failure
         self.canlib.fn = inspect.stack()[0][3]
         return self.canlib.getChannelData_Firmware(self.index)
 
+class canFastChannel(canChannel):
+    '''canChannel for high frame rates.
+    read/write reuse ctypes buffers allocated once per channel instead of 
+    building new c_long/c_uint/canMessage objects for every frame, and record
+    the error context as a constant instead of walking the stack with inspect.
+    read returns the data as bytes of exactly dlc length:
+        (id, data, dlc, flag, time, returns)
+    '''
+
+    def __init__(self, canlib, channel, flags=0):
+        canChannel.__init__(self, canlib, channel, flags)
+        self._msg = canlib.canMessage()
+        self._id = c_long()
+        self._dlc = c_uint()
+        self._flag = c_uint()
+        self._time = c_ulong()
+        self._txMsg = canlib.canMessage()
+        # byref() objects stay valid as long as the buffers they point to
+        self._msgRef = byref(self._msg)
+        self._idRef = byref(self._id)
+        self._dlcRef = byref(self._dlc)
+        self._flagRef = byref(self._flag)
+        self._timeRef = byref(self._time)
+        self._msgView = memoryview(self._msg).cast('B')
+
+    def write(self, id, msg, flag=0):
+        '''Same as canChannel.write, msg is copied into a reused 8 byte buffer'''
+        self.canlib.fn = 'write'
+        n = len(msg)
+        self._txMsg[:n] = msg
+        self.dll.canWrite(self.handle, id, self._txMsg, n, flag)
+
+    def read(self, timeout=0):
+        '''Same as canChannel.read, returns the data as bytes of length dlc'''
+        self.canlib.fn = 'read'
+        returns = self.dll.canReadWait(self.handle, self._idRef, self._msgRef, self._dlcRef,
+                                       self._flagRef, self._timeRef, timeout)
+        dlc = self._dlc.value
+        return self._id.value, self._msgView[:dlc].tobytes(), dlc, self._flag.value, self._time.value, returns
+
+    def readSpecificSkip(self, id, timeout=0):
+        '''Same as canChannel.readSpecificSkip, returns the data as bytes of length dlc'''
+        self.canlib.fn = 'readSpecificSkip'
+        returns = self.dll.canReadSpecificSkip(self.handle, id, self._msgRef, self._dlcRef,
+                                               self._flagRef, self._timeRef)
+        dlc = self._dlc.value
+        return id, self._msgView[:dlc].tobytes(), dlc, self._flag.value, self._time.value, returns
+
+    def readSyncSpecific(self, id, timeout=0):
+        self.canlib.fn = 'readSyncSpecific'
+        try:
+            self.dll.canReadSyncSpecific(self.handle, id, timeout)
+        except canError as ce:
+            if ce.canERR == canERR_TIMEOUT:
+                raise canNoMsg(self.canlib, ce.canERR)
+            raise
+
+
 if __name__ == '__main__':
     cl = canlib()
     #ch = cl.openChannel(ch, canOPEN_ACCEPT_VIRTUAL)
@@ -161,11 +161,25 @@ import struct
 import queue
 import logging
 import time
+import math
+import binascii
+from dispatcher import CanDispatcher, NoMessage
+from objectdictionary import OdEntry
+from sdocache import SdoCache
+try:
+    import numpy as np
+except ImportError:
+    np = None
 #from canlib import canError
 #CAN communication variable types 
-TypeLength = {'integer8': (1,True,'b') , 'integer16':  (2,True,'<h') , 'integer32':  (4,True,'<l') , 
-              'unsigned8' :  (1,False,'B') , 'unsigned16': (2,False,'<H') , 'unsigned32': (4,False,'<L') ,'vis string': (-1,False,'B')} 
-MapOpt = {'rx':{0x1400,0x1600,0x100},'tx':{0x1800,0x1a00,0x80}} 
+#the 8 byte types do not fit an expedited transfer and go segmented
+TypeLength = {'integer8': (1,True,'b') , 'integer16':  (2,True,'<h') , 'integer32':  (4,True,'<l') , 'integer64':  (8,True,'<q') ,
+              'unsigned8' :  (1,False,'B') , 'unsigned16': (2,False,'<H') , 'unsigned32': (4,False,'<L') , 'unsigned64': (8,False,'<Q') ,
+              'real32': (4,True,'<f') , 'real64': (8,True,'<d') ,'vis string': (-1,False,'B')} 
+# NumPy types of the recorder samples by GetRU data type, (signed, unsigned)
+RecorderTypes = [('<i2','<u2'), ('<i4','<u4'), ('<f4','<f4'), ('<i8','<u8'), ('<f8','<f8')]
+RecorderFormats = {'<i2':'h', '<u2':'H', '<i4':'l', '<u4':'L', '<f4':'f', '<i8':'q', '<u8':'Q', '<f8':'d'}
+MapOpt = {'rx':(0x1400,0x1600,0x100),'tx':(0x1800,0x1a00,0x80)} 
 
 
 
@@ -304,6 +318,47 @@ CANOPEN_SDO_CS_DB_SS_BD_ACK  =0x02
 CANOPEN_SDO_CS_DB_SS_BD_END  =0x01
 CANOPEN_SDO_CS_DB_SS_MASK    =0x03
 
+# block upload 
+CANOPEN_SDO_CS_RX_BU  = 0xA0
+CANOPEN_SDO_CS_TX_BU  = 0xC0
+CANOPEN_SDO_CS_BU_STR = "Block Upload"
+
+CANOPEN_SDO_CS_UB_CS_IBU   = 0x00
+CANOPEN_SDO_CS_UB_CS_EBU   = 0x01
+CANOPEN_SDO_CS_UB_CS_ACK   = 0x02
+CANOPEN_SDO_CS_UB_CS_START = 0x03
+
+CANOPEN_SDO_CS_UB_SS_IBU   = 0x00
+CANOPEN_SDO_CS_UB_SS_EBU   = 0x01
+CANOPEN_SDO_CS_UB_SS_MASK  = 0x01
+
+CANOPEN_SDO_SEQNO_MASK     = 0x7F
+CANOPEN_SDO_BLKSIZE_MAX    = 127
+
+# record transfers: strings up to this length [bytes] take fewer round trips
+# segmented (1 + n/7) than by block transfer (3)
+CANOPEN_RECORD_PST         = 14
+
+# bits of an 8 byte standard frame, worst case bit stuffing included
+CANOPEN_FRAME_BITS         = 135
+
+# abort codes sent by the client
+CANOPEN_SDO_ABORT_TOGGLE   = 0x05030000
+CANOPEN_SDO_ABORT_TIMEOUT  = 0x05040000
+CANOPEN_SDO_ABORT_CS       = 0x05040001
+CANOPEN_SDO_ABORT_SEQNO    = 0x05040003
+CANOPEN_SDO_ABORT_CRC      = 0x05040004
+CANOPEN_SDO_ABORT_MEMORY   = 0x05040005
+
+
+def crc16(data, crc=0):
+    '''
+    CRC of the SDO block transfer: CRC-16-CCITT, x^16 + x^12 + x^5 + 1, initial value 0
+    :param data: bytes-like object
+    :param crc : crc of the preceding data, to compute the crc incrementally
+    '''
+    return binascii.crc_hqx(data, crc)
+
 
 #class SimpleList:
 #    ''' simple list is    
@@ -463,19 +518,70 @@ class CanOpen():
         """"""
         self.can = canlib
         self.timeout = 0.002
+        # bit rate of the bus [bit/s], the time a block of segments takes on the bus
+        self.bitrate = 1000000
+        self.dispatcher = None
+        self.ods = {}
+        self.sdoCache = None
+        # Node ID -> True / False once a block transfer succeeded / was refused
+        self.blockSupport = {}
+        # (Node ID, PDO communication parameter index) -> (COB-ID, transmission type, mapping)
+        self.pdoMappings = {}
 
     def AnalyzeSdoAbort( self, errcode): 
         try:
             return SdoAbortCode[ errcode ] ;
         except:
             return 'Unknow SDO abort code'
+
+    def raiseSdoAbort( self, nodeId, index, subindex, msgRet ):
+        '''
+        Log and raise the abort received from the server
+        :param msgRet: the Abort SDO Transfer message
+        '''
+        AbortCode =  struct.unpack_from('<L',msgRet,4)[0]
+        text = 'Abort code [' + self.AnalyzeSdoAbort(AbortCode) + '] \
+            for object Node ID:{0} index {1} subindex {2} '.format( nodeId , index , subindex)
+        logging.error( text )
+        raise Exception( text )
+
+    def SDOAbort( self, nodeId, index, subindex, AbortCode ):
+        '''
+        Abort SDO Transfer - sent by the client, no response
+        bit 7..5 - cs: Command Specifier = 4
+        byte 1-3 - Multiplexor
+        byte 4-7 - Abort code
+        '''
+        msg =  (CANOPEN_SDO_CS_RX_ADT).to_bytes(1,'little')+(index).to_bytes(2,'little')+\
+            (subindex).to_bytes(1,'little')+(AbortCode).to_bytes(4,'little')
+        self.writeCanMessage( nodeId + 0x600 , msg )
     
 
     def open(self,ch=0,baud=1000000):
         self.can.open(ch,baud)
+        self.bitrate = baud
 
     def close(self,ch=0):
-        self.can.close(ch)
+        self.stopDispatcher()
+        self.can.close()
+
+    def startDispatcher(self,pollTimeout=0.1):
+        '''
+        Hand canChannel.read over to a background CanDispatcher.
+        From now on responses are taken from per COB-ID queues, so frames of
+        other COB-IDs (PDO, EMCY, heartbeat) are no longer lost during an SDO.
+        :param pollTimeout: see CanDispatcher
+        :returns          : the running dispatcher, to subscribe further consumers
+        '''
+        if self.dispatcher is None:
+            self.dispatcher = CanDispatcher(self.can,pollTimeout)
+        self.dispatcher.start()
+        return self.dispatcher
+
+    def stopDispatcher(self):
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+            self.dispatcher = None
 
     def pingCanMessage(self,nodeIdSend,nodeIdReply,msg):
         '''
@@ -484,21 +590,52 @@ class CanOpen():
         :param msg        : message to be sent 
         :returns          : responce message
         '''
-        try:
+        if self.dispatcher is not None:
+            # the queue must exist before the request leaves, else a fast
+            # answer is dropped as unrouted
+            self.dispatcher.subscribe(nodeIdReply)
+            # a late answer to a request that already timed out is not ours
+            self.dispatcher.flush(nodeIdReply)
+        self.writeCanMessage(nodeIdSend,msg)
+        return self.waitCanMessage(nodeIdReply)
+
+    def writeCanMessage(self,nodeIdSend,msg):
+        '''
+        Send a frame without waiting for an answer
+        :param nodeIdSend : Communication object ID
+        :param msg        : message to be sent 
+        '''
+        if self.dispatcher is not None:
+            self.dispatcher.write(nodeIdSend,msg)
+        else:
             self.can.write(nodeIdSend,msg)
-            wait  = int(self.timeout/0.001)          
-            while   wait:     
-                time.sleep(0.001)        
-                ret = self.can.read()#timeout = self.timeout*1000)
-                if ret[0] == nodeIdReply: 
-                    break           
-                wait-=1                        
-            return bytearray(ret[1])
-            raise   Exception('Timeout')    
-        except Exception as ex:
-           res = None
-           print ( ex )
-           
+
+    def waitCanMessage(self,nodeIdReply,timeout=None):
+        '''
+        Block until a frame with COB-ID nodeIdReply arrives.
+        Without dispatcher the wait is left to the driver (canReadSyncSpecific,
+        ncWaitForState), so the caller wakes up as soon as the frame is there
+        instead of on the next OS sleep tick. Frames of other COB-IDs received
+        meanwhile are discarded by the driver.
+        :param nodeIdReply: Communication object Id for responce
+        :param timeout    : [sec], self.timeout if None
+        :returns          : data of the received frame
+        '''
+        timeout = self.timeout if timeout is None else timeout
+        dispatcher = self.dispatcher
+        try:
+            if dispatcher is not None:
+                dispatcher.check()
+                ret = dispatcher.subscribe(nodeIdReply).get(timeout=timeout)
+            else:
+                ret = self.can.readSpecific(nodeIdReply,int(math.ceil(timeout*1000)))
+        except NoMessage + (queue.Empty,):
+            if dispatcher is not None:
+                # no answer because the receive thread died
+                dispatcher.check()
+            logging.error('Timeout waiting for COB-ID 0x%x' % nodeIdReply)
+            raise Exception('Timeout')
+        return bytearray(ret[1])
 
     def read_can_frame(self):
         """
@@ -512,6 +649,68 @@ class CanOpen():
         else:
             raise Exception("CAN frame read error: can not connected")
             
+    def addObjectDictionary(self,od,nodeIds=None):
+        '''
+        Attach an object dictionary, from then on the SDO and PDO functions
+        accept names and OdEntry objects in place of index, subindex and type
+        :param od      : objectdictionary.ObjectDictionary
+        :param nodeIds : Node IDs described by od; None - the Node ID of a DCF,
+                         all nodes without an own dictionary for an EDS
+        '''
+        if nodeIds is None:
+            nodeIds = (od.nodeId,)
+        elif isinstance(nodeIds,int):
+            nodeIds = (nodeIds,)
+        for nodeId in nodeIds:
+            self.ods[nodeId] = od
+
+    def objectDictionary(self,nodeId):
+        '''
+        :returns: the object dictionary of a node, None if there is none
+        '''
+        od = self.ods.get(nodeId)
+        return self.ods.get(None) if od is None else od
+
+    def resolveObject(self,nodeId,index,subindex=None,Type=None):
+        '''
+        Index, subindex and type of an object given by number, name or OdEntry
+        :param index   : index, name or OdEntry
+        :param subindex: subindex, 0 if None; for a name of an array or record the
+                         subindex within it
+        :param Type    : type, from the object dictionary if None
+        :returns       : (index, subindex, Type)
+        '''
+        if isinstance(index,int) and Type is not None:
+            return index, 0 if subindex is None else subindex, Type
+        if isinstance(index,OdEntry):
+            entry = index
+        else:
+            od = self.objectDictionary(nodeId)
+            if od is None:
+                logging.error('No object dictionary for node {0} to resolve {1!r}'.format(nodeId, index))
+                raise Exception('No object dictionary for node {0} to resolve {1!r}'.format(nodeId, index))
+            if isinstance(index,str):
+                entry = od[index]
+                if subindex is not None and subindex != entry.subindex:
+                    entry = od[(entry.index, subindex)]
+            else:
+                entry = od[(index, subindex or 0)]
+        return entry.index, entry.subindex, entry.sdoType if Type is None else Type
+
+    def enableSdoCache(self,maxsize=1024,default='never',writeThrough=False):
+        '''
+        Put an SdoCache in front of SDOUpload, see sdocache
+        :param default : policy of the objects without rule: 'never', 'pinned'
+                         or time to live [sec]
+        :returns       : the cache, to set policies and read the counters
+        '''
+        if self.sdoCache is None:
+            self.sdoCache = SdoCache(self, maxsize, default, writeThrough)
+        return self.sdoCache
+
+    def disableSdoCache(self):
+        self.sdoCache = None
+
     def setNodeId(self,nodeId):
             self.nodeId = nodeId
 
@@ -528,7 +727,51 @@ class CanOpen():
     # 
     #---------------------------------------------------------------------------
 
-    def SDOUpload(self,nodeId, index, subindex,TypeIn,AbortMsg = None):
+    def _sdoRun(self,nodeId,steps):
+        '''
+        Run an SDO transfer written as generator of its steps: every request it
+        yields goes to the SDO server of nodeId and the response is sent back
+        into it, a failure to get one (Timeout) is thrown into it.
+        The block transfers yield (frames, timeout) instead: the frames, none,
+        one or a whole block, are sent and the next response is waited for
+        timeout [sec], not at all if timeout is None.
+        AsyncCanOpen runs the same generators on an event loop, so both
+        build and check every frame with the same code.
+        :param steps : generator, e.g. _sdoUploadSteps(...)
+        :returns     : the value the generator returned
+        '''
+        nodeIdSend  = nodeId + 0x600
+        nodeIdReply = nodeId + 0x580
+        try:
+            msg = next(steps)
+            while True:
+                try:
+                    if type(msg) is tuple:
+                        msgRet = self._sdoFrames( nodeIdSend , nodeIdReply , *msg )
+                    else:
+                        msgRet = self.pingCanMessage( nodeIdSend , nodeIdReply , msg )
+                except Exception as ex:
+                    msg = steps.throw(ex)
+                else:
+                    msg = steps.send(msgRet)
+        except StopIteration as stop:
+            return stop.value
+
+    def _sdoFrames(self,nodeIdSend,nodeIdReply,frames,timeout):
+        '''
+        Step (frames, timeout) of a block transfer, see _sdoRun
+        :returns : the response, None if timeout is None
+        '''
+        if frames and self.dispatcher is not None:
+            # as pingCanMessage, the queue exists before the first frame leaves
+            self.dispatcher.subscribe(nodeIdReply)
+            self.dispatcher.flush(nodeIdReply)
+        for frame in frames:
+            self.writeCanMessage(nodeIdSend,frame)
+        if timeout is not None:
+            return self.waitCanMessage(nodeIdReply,timeout)
+
+    def SDOUpload(self,nodeId, index, subindex=None,TypeIn=None,AbortMsg = None,decode = True,cached = True):
         """
             The Initiate SDO Upload - Request
             =================================
@@ -553,7 +796,41 @@ class CanOpen():
             bit 3..2 - n: if e=s=1, number of data bytes in Byte 4..7 that do not contain data
             bit 1    - e: set to 1 for expedited transfer (data is in bytes 4-7)
             bit 0    - s: set to 1 if data size is indicated
+
+            index may be a name or OdEntry and TypeIn None, see resolveObject.
+            With an SdoCache (enableSdoCache) the value may come from the cache,
+            cached = False reads from the node and refreshes the cache.
+            'vis string' with decode = False returns a bytearray owned by the
+            caller, whether expedited, segmented or from the cache.
         """
+        return self._sdoRun( nodeId , self._sdoUploadSteps( nodeId , index , subindex , TypeIn , decode , cached ) )
+
+    def _sdoUploadSteps(self,nodeId, index, subindex=None,TypeIn=None,decode = True,cached = True):
+        '''
+        Steps of SDOUpload, see _sdoRun
+        '''
+        index, subindex, TypeIn = self.resolveObject(nodeId, index, subindex, TypeIn)
+        cache = self.sdoCache
+        if cache is None:
+            return (yield from self._sdoUploadObjectSteps(nodeId, index, subindex, TypeIn, decode))
+        if cached:
+            found, value = cache.lookup(nodeId, index, subindex, TypeIn, decode)
+            if found:
+                return value
+        value = yield from self._sdoUploadObjectSteps(nodeId, index, subindex, TypeIn, decode)
+        cache.store(nodeId, index, subindex, TypeIn, decode, value)
+        return value
+
+    def SDOUploadObject(self,nodeId, index, subindex,TypeIn,decode = True):
+        '''
+        SDOUpload of an object given by number, without cache
+        '''
+        return self._sdoRun( nodeId , self._sdoUploadObjectSteps( nodeId , index , subindex , TypeIn , decode ) )
+
+    def _sdoUploadObjectSteps(self,nodeId, index, subindex,TypeIn,decode = True):
+        '''
+        Steps of SDOUploadObject, see _sdoRun
+        '''
         Type = TypeIn.lower()
         if  Type not in TypeLength.keys():
             logging.error('SDO desired for ilegal type, found['+repr(Type)+'] , permitted: ' + repr(TypeLength.keys()) )
@@ -563,16 +840,12 @@ class CanOpen():
         msg =  (64).to_bytes(1,'little')+(index).to_bytes(2,'little')+(subindex).to_bytes(5,'little') 
         #Sends SDO requests to each node by using message ID:600h + Node ID  
         #Expects reply in message ID: 580h + Node ID      
-        msgRet = self.pingCanMessage( nodeId + 0x600 ,  nodeId + 0x580 ,msg ) 
+        msgRet = yield msg
 
         # verify returned message~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         #Test abort message
         if msgRet[0] & CANOPEN_SDO_CS_RX_ADT : 
-            AbortCode =  struct.unpack_from('L',msgRet,4)[0]  # Return error code + abort 
-            logging.error ( 'Abort code [' + self.AnalyzeSdoAbort(AbortCode) + '] \
-            for object Node ID:{0} index {1} subindex {2} '.format( NodeId , Index , SubIndex) )
-            raise Exception(  'Abort code [' + self.AnalyzeSdoAbort(AbortCode) + '] \
-            for object Node ID:{0} index {1} subindex {2} '.format( NodeId , Index , SubIndex) )
+            self.raiseSdoAbort( nodeId , index , subindex , msgRet )
 
         #Test command specifier and multiplexor
         if (((msgRet[0] & CANOPEN_SDO_CS_MASK ) >> 5 ) != 2) or ( msgRet[1:4] != msg[1:4] ) : 
@@ -590,7 +863,7 @@ class CanOpen():
            
 
             if Type == 'vis string' :
-                return msgRet[4:4+n].decode('ascii')  
+                return msgRet[4:4+n].decode('ascii') if decode else bytearray(msgRet[4:4+n])
             return  struct.unpack_from(TypeLength[Type][2],msgRet,4)[0] #Return result, no abort 
 
 
@@ -616,57 +889,144 @@ class CanOpen():
         
             
         '''
-        # assign buffer for data
-        buf =  (0).to_bytes(8,'little')  
-        # assing Upload SDO Segment Request msg 
-        msg =  (0x60).to_bytes(8,'little')
+        buf = yield from self._sdoUploadSegmentsSteps( nodeId , index , subindex , msgRet )
+        if Type != 'vis string':
+            if len(buf) < TypeLength[Type][0]:
+                raise Exception('Length of SDO upload not as expected')
+            return struct.unpack_from(TypeLength[Type][2],buf)[0]
+       
+        if decode:
+            return buf.decode('ascii') 
+        else:
+            return buf 
+
+
+
+    def SDOUploadSegments(self, nodeId, index, subindex, msgRet, sink=None, progress=None):
+        '''
+        Upload the segments of a segmented transfer 
+        The data goes into a bytearray allocated once if the server indicated the
+        size, or as every segment arrives into sink.
+        :param msgRet   : the Initiate SDO Upload response of the server
+        :param sink     : None, a writable buffer (bytearray, memoryview, mmap,
+                          NumPy array) filled from its start, or a file-like
+                          object whose write() takes every segment
+        :param progress : None or called progress(received, size) after every segment,
+                          size None if the server did not indicate it
+        :returns        : the uploaded data (bytearray) if sink is None, 
+                          else the number of bytes received
+        '''
+        return self._sdoRun( nodeId , self._sdoUploadSegmentsSteps( nodeId , index , subindex , msgRet , sink , progress ) )
+
+    def _sdoUploadSegmentsSteps(self, nodeId, index, subindex, msgRet, sink=None, progress=None):
+        '''
+        Steps of SDOUploadSegments, see _sdoRun
+        '''
         # number of data bytes to recieve
-        nDelivery = struct.unpack_from('L',msgRet,4)[0] if ( msgRet[0] & 1 ) else -1
+        nDelivery = struct.unpack_from('<L',msgRet,4)[0] if ( msgRet[0] & CANOPEN_SDO_CS_ID_S_FLAG ) else -1
+        size = nDelivery if nDelivery >= 0 else None
+        write = None
+        if sink is None:
+            buf = bytearray(nDelivery) if nDelivery >= 0 else bytearray()
+            view = memoryview(buf) if nDelivery >= 0 else None
+        elif hasattr(sink, 'write'):
+            write = sink.write
+        else:
+            view = memoryview(sink).cast('B')
+            if nDelivery > len(view):
+                self.SDOAbort( nodeId , index , subindex , CANOPEN_SDO_ABORT_MEMORY )
+                raise Exception('SDO upload of %d bytes does not fit in %d bytes' % (nDelivery, len(view)))
+        # assing Upload SDO Segment Request msg, toggled in place
+        msg = bytearray(8)
+        msg[0] = CANOPEN_SDO_CS_RX_UDS
+        received = 0
         while True:
-            msgRet = self.pingCanMessage( nodeId + 0x600 ,  nodeId + 0x580 ,msg ) 
+            msgRet = yield msg
             # toggle bit
-            msg = (msg[0] ^ 0x10).to_bytes(1,'little') + msg[1:]
+            msg[0] ^= CANOPEN_SDO_CS_DS_T_FLAG
             # verify returned message~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
             #Test abort message
             if msgRet[0] & CANOPEN_SDO_CS_RX_ADT : 
-                AbortCode =  struct.unpack_from('L',msgRet,4)[0] # Return error code + abort 
-                logging.error ( 'Abort code [' + self.AnalyzeSdoAbort(AbortCode) + '] \
-                for object Node ID:{0} index {1} subindex {2} '.format( NodeId , Index , SubIndex) )  
-                               
-                raise Exception(  'Abort code [' + self.AnalyzeSdoAbort(AbortCode) + '] \
-                for object Node ID:{0} index {1} subindex {2} '.format( NodeId , Index , SubIndex) )
-                #return AbortCode
+                self.raiseSdoAbort( nodeId , index , subindex , msgRet )
 
             #Test command specifier 
-            if (msgRet[0] & CANOPEN_SDO_CS_MASK ) != 0:
+            if (msgRet[0] & CANOPEN_SDO_CS_MASK ) != CANOPEN_SDO_CS_TX_UDS:
                 logging.error ('Bad response to SDO upload init') 
                 raise Exception('Bad response to SDO upload init')
 
            # number of data bytes in Byte 1..7 that do not contain data
             n = 7 - (( msgRet[0] >> 1 ) & 7 )
-            # add 7-n bytes to buf
-            buf = buf + msgRet[1:n+1]
+            end = received + n
+            if nDelivery >= 0 and end > nDelivery:
+                self.SDOAbort( nodeId , index , subindex , CANOPEN_SDO_ABORT_MEMORY )
+                raise Exception('Length of SDO upload not as expected')
+            # add n bytes to the data
+            if write is not None:
+                write( memoryview(msgRet)[1:n+1] )
+            elif view is None:
+                buf += msgRet[1:n+1]
+            elif end <= len(view):
+                view[received:end] = memoryview(msgRet)[1:n+1]
+            else:
+                self.SDOAbort( nodeId , index , subindex , CANOPEN_SDO_ABORT_MEMORY )
+                raise Exception('SDO upload does not fit in %d bytes' % len(view))
+            received = end
+            if progress is not None:
+                progress( received , size )
             # is all data sent?
-            if ( len( buf ) >= nDelivery + 8 ) or msgRet[0] & 1 : # Complete or already message length exceeded
+            if received == nDelivery or msgRet[0] & CANOPEN_SDO_CS_DS_C_FLAG : # Complete
                 break
-        # 0<=nDelivery
-        nDelivery = len(buf)-8 if nDelivery < 0 else nDelivery
-        if nDelivery !=  len(buf)-8 or nDelivery <= TypeLength[Type][0]:
+        if nDelivery >= 0 and nDelivery != received:
             raise Exception('Length of SDO upload not as expected')
-       
-        if Type == 'vis string' :#and decode:
-            return buf[8:].decode('ascii') 
-        else:
-            return buf[8:] 
-        return  struct.unpack_from(TypeLength[Type][2],buf,8)[0]
-
-
-        logging.error ('Unknown error') 
-        raise Exception('Unknown error')
-
+        return buf if sink is None else received
 
+    def SDOUploadStream(self, nodeId, index, subindex=None, sink=None, progress=None):
+        '''
+        Upload a domain without holding it twice in memory: into a bytearray of
+        the size indicated by the server, into a caller's buffer, or segment by
+        segment into a file
+        :param index    : index, name or OdEntry, see resolveObject
+        :param sink     : see SDOUploadSegments
+        :param progress : see SDOUploadSegments
+        :returns        : the uploaded data (bytearray) if sink is None, 
+                          else the number of bytes received
+        '''
+        return self._sdoRun( nodeId , self._sdoUploadStreamSteps( nodeId , index , subindex , sink , progress ) )
 
-    def SDODownload(self, nodeId, Index, SubIndex, data , Type,AbortMsg = None ):
+    def _sdoUploadStreamSteps(self, nodeId, index, subindex=None, sink=None, progress=None):
+        '''
+        Steps of SDOUploadStream, see _sdoRun
+        '''
+        index, subindex, Type = self.resolveObject(nodeId, index, subindex, 'domain')
+        msg = bytearray((CANOPEN_SDO_CS_RX_IDU, index & 0xFF, index >> 8, subindex, 0, 0, 0, 0))
+        msgRet = yield msg
+        if msgRet[0] == CANOPEN_SDO_CS_TX_ADT :
+            self.raiseSdoAbort( nodeId , index , subindex , msgRet )
+        if ( msgRet[0] & CANOPEN_SDO_CS_MASK ) != CANOPEN_SDO_CS_TX_IDU or msgRet[1:4] != msg[1:4] :
+            logging.error ('Bad response to SDO upload init')
+            raise Exception('Bad response to SDO upload init')
+        if not msgRet[0] & CANOPEN_SDO_CS_ID_E_FLAG :
+            return (yield from self._sdoUploadSegmentsSteps( nodeId , index , subindex , msgRet , sink , progress ))
+
+        # expedited
+        n = 4 - (( msgRet[0] >> 2 ) & 3 ) if ( msgRet[0] & CANOPEN_SDO_CS_ID_S_FLAG ) else 4
+        data = memoryview(msgRet)[4:4+n]
+        if progress is not None:
+            progress( n , n )
+        if sink is None:
+            return bytearray(data)
+        if hasattr(sink, 'write'):
+            sink.write(data)
+            return n
+        view = memoryview(sink).cast('B')
+        if n > len(view):
+            raise Exception('SDO upload of %d bytes does not fit in %d bytes' % (n, len(view)))
+        view[:n] = data
+        return n
+
+
+
+    def SDODownload(self, nodeId, Index, SubIndex=None, data=None , Type=None,AbortMsg = None ):
         """
         SetSdo~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -693,7 +1053,23 @@ class CanOpen():
 
         bit 7..5 - scs: Server Command Specifier = 3
         bit 4..0 - x: reserved
+
+        Index may be a name or OdEntry and Type None, see resolveObject.
+        data is an int (float for 'real32' / 'real64') for the numeric types;
+        for 'vis string' a str, any buffer-protocol object or a binary file,
+        sent segment by segment without copying it first, see _segmentSource.
+        The 8 byte numeric types are sent segmented.
         """
+        return self._sdoRun( nodeId , self._sdoDownloadSteps( nodeId , Index , SubIndex , data , Type , AbortMsg ) )
+
+    def _sdoDownloadSteps(self, nodeId, Index, SubIndex=None, data=None , Type=None,AbortMsg = None ):
+        '''
+        Steps of SDODownload, see _sdoRun
+        '''
+        Index, SubIndex, Type = self.resolveObject(nodeId, Index, SubIndex, Type)
+        if self.sdoCache is not None:
+            # the old value is stale even if the write fails half way
+            self.sdoCache.invalidate(nodeId, Index, SubIndex)
         # test type message  
         Type = Type.lower()
         if  Type not in TypeLength.keys():
@@ -701,26 +1077,29 @@ class CanOpen():
             raise Exception('SDO desired for ilegal type, found['+repr(Type)+'] , permitted: ' + repr(TypeLength.keys()))
         
         #test data on 'vis string' and create message
-        if Type == 'vis string': 
-            if not type(data)  is str:
-                #logging.error('Required visible string for non string data' )
-                raise Exception('Required visible string for non string data')
+        msg = bytearray(8)
+        msg[1] = Index & 0xFF
+        msg[2] = Index >> 8
+        msg[3] = SubIndex
+        source = None
+        size , signed , fmt = TypeLength[Type]
+        if Type == 'vis string' or size > 4: 
+            source = self._segmentSource( data if size < 0 else struct.pack(fmt,data) )
            # The Initiate SDO Download with indicated data size 
-            msg =  ((1<<5)+1).to_bytes(1,'little')+(Index).to_bytes(2,'little')+\
-                (SubIndex).to_bytes(1,'little')+(len(data)).to_bytes(4,'little') # SDO dnload init 
-           
+            msg[0] = CANOPEN_SDO_CS_RX_IDD|CANOPEN_SDO_CS_ID_S_FLAG # SDO dnload init 
+            struct.pack_into('<L',msg,4,source[0])
         else:
-            msg =  ((1<<5)+((4-TypeLength[Type][0])<<2)+(1<<1)+1).to_bytes(1,'little')+(Index).to_bytes(2,'little')+\
-                (SubIndex).to_bytes(1,'little')+data.to_bytes(4,'little') # SDO dnload init 
+            msg[0] = CANOPEN_SDO_CS_RX_IDD|((4-size)<<CANOPEN_SDO_CS_ID_N_SHIFT)|CANOPEN_SDO_CS_ID_E_FLAG|CANOPEN_SDO_CS_ID_S_FLAG # SDO dnload init 
+            struct.pack_into(fmt if fmt[0] == '<' else '<'+fmt,msg,4,data)
 
         #Sends SDO requests to each node by using message ID:600h + Node ID  
         #Expects reply in message ID: 580h + Node ID     
-        msgRet = self.pingCanMessage( nodeId + 0x600 ,  nodeId + 0x580 ,msg ) 
+        msgRet = yield msg
          
         # verify returned message~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
         #Test abort message
         if msgRet[0] & CANOPEN_SDO_CS_RX_ADT : 
-                AbortCode =  struct.unpack_from('L',msgRet,4)[0] # Return error code + abort 
+                AbortCode =  struct.unpack_from('<L',msgRet,4)[0] # Return error code + abort 
                 assert not (type(AbortMsg) is str), AbortMsg+ ': SetSdo Abort code [' + self.AnalyzeSdoAbort(AbortCode) + ']\
                 for object Node ID:{0} index {1} subindex {2} '.format( nodeId , Index , SubIndex) 
                 #logging.error ( 'Abort code [' + self.AnalyzeSdoAbort(AbortCode) + '] \
@@ -759,49 +1138,231 @@ class CanOpen():
        
            '''
          #Segmented
-        t = 1 ; 
-        while len(data) :
-            t = 1-t 
-            if len(data) > 7 : 
-                nNext = 7 
-                Complete = 0 
-                meser = data[:7]
-                data = data[7:]
-            else: 
-                nNext = len(data)  
-                meser  = data + chr(0) * (7-nNext) 
-                Complete = 1 
-                data = [] 
-
-            
-            msg =  ((t<<4)+((7-nNext)<<1)+Complete).to_bytes(1,'little')+ meser.encode('ascii')
-            #Sends SDO requests to each node by using message ID:600h + Node ID  
-            #Expects reply in message ID: 580h + Node ID     
-            msgRet = self.pingCanMessage( nodeId + 0x600 ,  nodeId + 0x580 ,msg ) 
-                
-            # verify returned message~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-            #Test abort message
-            if msgRet[0] & CANOPEN_SDO_CS_RX_ADT : 
-                    AbortCode =  struct.unpack_from('L',msgRet,4)[0] # Return error code + abort 
-                    logging.error ( 'Abort code [' + self.AnalyzeSdoAbort(AbortCode) + '] \
-                    for object Node ID:{0} index {1} subindex {2} '.format( NodeId , Index , SubIndex) )                
-                    raise Exception(  'Abort code [' + self.AnalyzeSdoAbort(AbortCode) + '] \
-                    for object Node ID:{0} index {1} subindex {2} '.format( NodeId , Index , SubIndex) )
-        
+        if source is not None:
+            yield from self._sdoDownloadSegmentsSteps( nodeId , Index , SubIndex , source , msg )
 
+        if self.sdoCache is not None:
+            self.sdoCache.written(nodeId, Index, SubIndex, Type, data)
         return 0 
 
+    def _segmentSource( self , data ):
+        '''
+        (size, fill) of the data of a segmented download, fill(dst, pos) copies
+        len(dst) bytes from position pos into the memoryview dst
+        :param data : str (ascii), any buffer-protocol object (bytes, bytearray,
+                      memoryview, mmap, array, NumPy array) or a binary file
+                      positioned at the start of the data
+        '''
+        if type(data) is str:
+            data = data.encode('ascii')
+        try:
+            view = memoryview(data)
+        except TypeError:
+            view = None
+        if view is not None:
+            if view.ndim != 1 or view.itemsize != 1 :
+                view = view.cast('B')
+            def fill( dst , pos ):
+                dst[:] = view[pos:pos+len(dst)]
+            return len(view) , fill
+        if not hasattr(data, 'readinto'):
+            raise Exception('Required visible string for non string data')
+        try:
+            # the rest of a seekable file
+            pos = data.tell()
+            size = data.seek(0, 2) - pos
+            data.seek(pos)
+        except (AttributeError, OSError, ValueError):
+            # a pipe or socket - read to the end first
+            return self._segmentSource( data.read() )
+        def fill( dst , pos ):
+            n = 0
+            while n < len(dst):
+                got = data.readinto( dst[n:] )
+                if not got:
+                    raise Exception('File ended before the SDO download was complete')
+                n += got
+        return size , fill
+
+    def SDODownloadSegments( self , nodeId , Index , SubIndex , source , msg = None ):
+        '''
+        Download the segments of a segmented transfer, in one reused frame
+        :param source : (size, fill) returned by _segmentSource
+        :param msg    : bytearray(8) to send the segments in, None - a new one
+        '''
+        return self._sdoRun( nodeId , self._sdoDownloadSegmentsSteps( nodeId , Index , SubIndex , source , msg ) )
+
+    def _sdoDownloadSegmentsSteps( self , nodeId , Index , SubIndex , source , msg = None ):
+        '''
+        Steps of SDODownloadSegments, see _sdoRun
+        '''
+        size , fill = source
+        msg = bytearray(8) if msg is None else msg
+        segment = memoryview(msg)[1:8]
+        pos = 0
+        t = 0
+        try:
+            while True:
+                nNext = min(7, size - pos)
+                Complete = CANOPEN_SDO_CS_DS_C_FLAG if pos + nNext >= size else 0
+                fill( segment[:nNext] , pos )
+                if nNext < 7:
+                    segment[nNext:] = bytes(7 - nNext)
+                msg[0] = CANOPEN_SDO_CS_RX_DDS|t|((7-nNext)<<CANOPEN_SDO_CS_DS_N_SHIFT)|Complete
+                #Sends SDO requests to each node by using message ID:600h + Node ID  
+                #Expects reply in message ID: 580h + Node ID     
+                msgRet = yield msg
+
+                # verify returned message~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+                #Test abort message
+                if msgRet[0] == CANOPEN_SDO_CS_TX_ADT : 
+                    self.raiseSdoAbort( nodeId , Index , SubIndex , msgRet )
+                if ( msgRet[0] & CANOPEN_SDO_CS_MASK ) != CANOPEN_SDO_CS_TX_DDS :
+                    self.SDOAbort( nodeId , Index , SubIndex , CANOPEN_SDO_ABORT_CS )
+                    logging.error ('Bad response to SDO download segment') 
+                    raise Exception('Bad response to SDO download segment')
+                if ( msgRet[0] & CANOPEN_SDO_CS_DS_T_FLAG ) != t :
+                    self.SDOAbort( nodeId , Index , SubIndex , CANOPEN_SDO_ABORT_TOGGLE )
+                    logging.error ('Toggle bit not alternated in SDO download segment') 
+                    raise Exception('Toggle bit not alternated in SDO download segment')
+                pos += nNext
+                t ^= CANOPEN_SDO_CS_DS_T_FLAG
+                if Complete:
+                    return 0
+        except Exception as ex:
+            if str(ex) == 'Timeout' :
+                self.SDOAbort( nodeId , Index , SubIndex , CANOPEN_SDO_ABORT_TIMEOUT )
+            raise
 
 
 
-    def SDOUploadBlock(self, node, index, subindex, size):
+    def SDOUploadBlock(self, node, index, subindex=None, size=CANOPEN_SDO_BLKSIZE_MAX, pst=0):
         """
         Block SDO upload.
+
+        Initiate Block Upload - Request
+        ===============================
+        bit 7..5 - ccs: Client Command Specifier = 5
+        bit 4..3 - x: Reserved
+        bit 2    - cc: Client CRC support
+        bit 1..0 - cs: Client subcommand = 0
+        byte 1-3 - Multiplexor
+        byte 4   - blksize: number of segments per block (1..127)
+        byte 5   - pst: Protocol Switch Threshold, the server may switch to the
+                   normal upload if the object is not larger than pst bytes
+                   
+        Initiate Block Upload - Response
+        ================================
+        bit 7..5 - scs: Server Command Specifier = 6
+        bit 2    - sc: Server CRC support
+        bit 1    - s: size indicated in byte 4..7
+        bit 0    - ss: Server subcommand = 0
+        
+        The client then sends Start Upload (ccs = 5 , cs = 3) and the server sends
+        blksize segments without confirmation:
+        bit 7    - c: set if this is the last segment
+        bit 6..0 - seqno: 1..blksize
+        byte 1-7 - data
+        After each block the client answers (ccs = 5 , cs = 2) with ackseq, the
+        last segment received in sequence, and the blksize of the next block.
+        The server repeats the block from ackseq+1.
+
+        End Block Upload - Request ( server )
+        ======================================
+        bit 7..5 - scs: Server Command Specifier = 6
+        bit 4..2 - n: number of bytes in the last segment that do not contain data
+        bit 0    - ss: Server subcommand = 1
+        byte 1-2 - CRC
+        The client confirms with ccs = 5 , cs = 1
+
+        :param index: index, name or OdEntry, see resolveObject
+        :param size : blksize [1..127] requested from the server
+        :param pst  : protocol switch threshold [bytes], 0 - no switch
+        :returns    : the uploaded data (bytes)
         """
+        return self._sdoRun( node , self._sdoUploadBlockSteps( node , index , subindex , size , pst ) )
+
+    def _sdoUploadBlockSteps(self, node, index, subindex=None, size=CANOPEN_SDO_BLKSIZE_MAX, pst=0):
+        '''
+        Steps of SDOUploadBlock, see _sdoRun
+        '''
+        index, subindex, Type = self.resolveObject(node, index, subindex, 'domain')
+        if not 0 < size <= CANOPEN_SDO_BLKSIZE_MAX :
+            raise Exception('Block size must be in the range [1,127], found ['+repr(size)+']')
+
+        msg =  (CANOPEN_SDO_CS_RX_BU|CANOPEN_SDO_CS_BD_CRC_FLAG|CANOPEN_SDO_CS_UB_CS_IBU).to_bytes(1,'little')+\
+            (index).to_bytes(2,'little')+(subindex).to_bytes(1,'little')+bytes((size,pst,0,0))
+        msgRet = yield msg
+
+        cs = msgRet[0] & CANOPEN_SDO_CS_MASK 
+        if cs == CANOPEN_SDO_CS_TX_ADT :
+            self.raiseSdoAbort( node , index , subindex , msgRet )
+        if msgRet[1:4] != msg[1:4] :
+            logging.error ('Bad response to SDO block upload init') 
+            raise Exception('Bad response to SDO block upload init')
+
+        #Protocol switch - the server answered with Initiate SDO Upload  
+        if cs == CANOPEN_SDO_CS_TX_IDU :
+            if msgRet[0] & CANOPEN_SDO_CS_ID_E_FLAG :
+                n = 4 - (( msgRet[0] >> 2 ) & 3 ) if ( msgRet[0] & CANOPEN_SDO_CS_ID_S_FLAG ) else 4
+                return bytes(msgRet[4:4+n])
+            return bytes((yield from self._sdoUploadSegmentsSteps( node , index , subindex , msgRet )))
+
+        if cs != CANOPEN_SDO_CS_TX_BU or (msgRet[0] & CANOPEN_SDO_CS_UB_SS_MASK) != CANOPEN_SDO_CS_UB_SS_IBU :
+            logging.error ('Bad response to SDO block upload init') 
+            raise Exception('Bad response to SDO block upload init')
+        crc = msgRet[0] & CANOPEN_SDO_CS_BD_CRC_FLAG
+        nDelivery = struct.unpack_from('<L',msgRet,4)[0] if ( msgRet[0] & CANOPEN_SDO_CS_BD_S_FLAG ) else -1
+
+        buf = bytearray()
+        ack = bytearray(8)
+        ack[0] = CANOPEN_SDO_CS_RX_BU|CANOPEN_SDO_CS_UB_CS_ACK
+        ack[2] = size
+        try:
+            seg = yield ( ((CANOPEN_SDO_CS_RX_BU|CANOPEN_SDO_CS_UB_CS_START).to_bytes(8,'little'),) , self.timeout )
+            last = False
+            while not last :
+                seqno = 0    # last segment of the block received in sequence
+                while True :
+                    if seg[0] == CANOPEN_SDO_CS_TX_ADT :
+                        self.raiseSdoAbort( node , index , subindex , seg )
+                    if ( seg[0] & CANOPEN_SDO_SEQNO_MASK ) == seqno + 1 :
+                        seqno += 1
+                        buf += seg[1:8]
+                        last = bool( seg[0] & CANOPEN_SDO_CS_BD_C_FLAG )
+                    # a segment lost - wait for the end of the block, the server repeats from ackseq+1
+                    if seg[0] & CANOPEN_SDO_CS_BD_C_FLAG or ( seg[0] & CANOPEN_SDO_SEQNO_MASK ) == size :
+                        break
+                    seg = yield ( () , self.timeout )
+                ack[1] = seqno
+                # the first segment of the next block, or the end after the last one
+                seg = yield ( (ack,) , self.timeout )
+            end = seg
+        except Exception as ex:
+            if str(ex) == 'Timeout' :
+                self.SDOAbort( node , index , subindex , CANOPEN_SDO_ABORT_TIMEOUT )
+            raise
+        if end[0] == CANOPEN_SDO_CS_TX_ADT :
+            self.raiseSdoAbort( node , index , subindex , end )
+        if ( end[0] & CANOPEN_SDO_CS_MASK ) != CANOPEN_SDO_CS_TX_BU or ( end[0] & CANOPEN_SDO_CS_UB_SS_MASK ) != CANOPEN_SDO_CS_UB_SS_EBU :
+            self.SDOAbort( node , index , subindex , CANOPEN_SDO_ABORT_CS )
+            logging.error ('Bad end of SDO block upload') 
+            raise Exception('Bad end of SDO block upload')
+        # number of bytes in the last segment that do not contain data
+        n = ( end[0] >> CANOPEN_SDO_CS_DB_N_SHIFT ) & CANOPEN_SDO_CS_DB_N_MASK
+        del buf[len(buf)-n:]
+        if crc and crc16(buf) != struct.unpack_from('<H',end,1)[0] :
+            self.SDOAbort( node , index , subindex , CANOPEN_SDO_ABORT_CRC )
+            logging.error ('CRC error in SDO block upload') 
+            raise Exception('CRC error in SDO block upload')
+        yield ( ((CANOPEN_SDO_CS_RX_BU|CANOPEN_SDO_CS_UB_CS_EBU).to_bytes(8,'little'),) , None )
+        if nDelivery >= 0 and nDelivery != len(buf) :
+            raise Exception('Length of SDO upload not as expected')
+        return bytes(buf)
 
 
 
-    def SDODownloadBlock(self, node, index, subindex, str_data, size):
+    def SDODownloadBlock(self, node, index, subindex=None, str_data=None, size=None):
         """
         Initiate Block Download
         =======================
@@ -817,16 +1378,397 @@ class CanOpen():
         byte 1-3 - The Multiplexor contains the Index and Subindex of the OD entry that the
                    client wants to write to
         byte 4-7 -size: Contains the size of the data block in bytes, if s is set
+
+        Message contents of the response
+        bit 7..5 - scs: Server Command Specifier = 5
+        bit 2    - sc: Server CRC support
+        bit 1..0 - ss: Server subcommand = 0
+        byte 4   - blksize: number of segments per block (1..127)
+
+        Download Block Segments
+        =======================
+        The client sends blksize segments without confirmation:
+        bit 7    - c: set if this is the last segment
+        bit 6..0 - seqno: 1..blksize
+        byte 1-7 - data
+        After each block the server answers (scs = 5 , ss = 2) with ackseq, the last
+        segment received in sequence, and the blksize of the next block.
+        The client repeats the segments after ackseq in the next block.
+
+        End Block Download
+        ==================
+        bit 7..5 - ccs: Client Command Specifier = 6
+        bit 4..2 - n: number of bytes in the last segment that do not contain data
+        bit 0    - cs: Client subcommand = 1
+        byte 1-2 - CRC
+        The server confirms with scs = 5 , ss = 1
+
+        :param index   : index, name or OdEntry, see resolveObject
+        :param str_data: data to write, str or bytes-like object
+        :param size    : number of bytes indicated to the server, len(str_data) if None
         """
-    
+        return self._sdoRun( node , self._sdoDownloadBlockSteps( node , index , subindex , str_data , size ) )
+
+    def _sdoDownloadBlockSteps(self, node, index, subindex=None, str_data=None, size=None):
+        '''
+        Steps of SDODownloadBlock, see _sdoRun
+        '''
+        index, subindex, Type = self.resolveObject(node, index, subindex, 'domain')
+        if self.sdoCache is not None:
+            self.sdoCache.invalidate(node, index, subindex)
+        data = memoryview(str_data.encode('ascii') if type(str_data) is str else str_data).cast('B')
+        total = len(data)
+        size = total if size is None else size
+
+        msg =  (CANOPEN_SDO_CS_RX_BD|CANOPEN_SDO_CS_BD_CRC_FLAG|CANOPEN_SDO_CS_BD_S_FLAG|CANOPEN_SDO_CS_DB_CS_IBD).to_bytes(1,'little')+\
+            (index).to_bytes(2,'little')+(subindex).to_bytes(1,'little')+(size).to_bytes(4,'little')
+        msgRet = yield msg
+
+        if ( msgRet[0] & CANOPEN_SDO_CS_MASK ) == CANOPEN_SDO_CS_TX_ADT :
+            self.raiseSdoAbort( node , index , subindex , msgRet )
+        if ( msgRet[0] & CANOPEN_SDO_CS_MASK ) != CANOPEN_SDO_CS_TX_BD or \
+           ( msgRet[0] & CANOPEN_SDO_CS_DB_SS_MASK ) != CANOPEN_SDO_CS_DB_SS_IBD_ACK or msgRet[1:4] != msg[1:4] :
+            logging.error ('Bad response to SDO block download init') 
+            raise Exception('Bad response to SDO block download init')
+        crcOn = msgRet[0] & CANOPEN_SDO_CS_BD_CRC_FLAG
+        blksize = msgRet[4]
+
+        crc = 0
+        pos = 0                 # first byte not yet acknowledged
+        # the frames of a block, all sent before the next step builds any
+        frames = memoryview(bytearray(8*CANOPEN_SDO_BLKSIZE_MAX))
+        try:
+            while True:
+                if not 0 < blksize <= CANOPEN_SDO_BLKSIZE_MAX :
+                    self.SDOAbort( node , index , subindex , 0x05040002 )
+                    raise Exception('Invalid block size ['+repr(blksize)+'] (block mode only)')
+                seqno = 0
+                end = pos
+                last = False
+                while seqno < blksize and not last :
+                    frame = frames[8*seqno:8*seqno+8]
+                    seqno += 1
+                    chunk = data[end:end+7]
+                    end += len(chunk)
+                    last = end >= total
+                    frame[0] = seqno | CANOPEN_SDO_CS_BD_C_FLAG if last else seqno
+                    frame[1:1+len(chunk)] = chunk
+                    frame[1+len(chunk):] = bytes(7-len(chunk))
+
+                # the acknowledge comes once the whole block went over the bus
+                msgRet = yield ( [frames[8*i:8*i+8] for i in range(seqno)] ,
+                                 self.timeout + seqno*CANOPEN_FRAME_BITS/float(self.bitrate) )
+                if ( msgRet[0] & CANOPEN_SDO_CS_MASK ) == CANOPEN_SDO_CS_TX_ADT :
+                    self.raiseSdoAbort( node , index , subindex , msgRet )
+                if ( msgRet[0] & CANOPEN_SDO_CS_MASK ) != CANOPEN_SDO_CS_TX_BD or \
+                   ( msgRet[0] & CANOPEN_SDO_CS_DB_SS_MASK ) != CANOPEN_SDO_CS_DB_SS_BD_ACK :
+                    self.SDOAbort( node , index , subindex , CANOPEN_SDO_ABORT_CS )
+                    logging.error ('Bad response to SDO download block') 
+                    raise Exception('Bad response to SDO download block')
+                ackseq = msgRet[1]
+                if ackseq > seqno :
+                    self.SDOAbort( node , index , subindex , CANOPEN_SDO_ABORT_SEQNO )
+                    raise Exception('Invalid sequence number (block mode only)')
+                acked = min( pos + 7*ackseq , total )
+                if crcOn :
+                    crc = crc16( data[pos:acked] , crc )
+                pos = acked
+                blksize = msgRet[2]
+                if last and ackseq == seqno :
+                    break
+
+            # bytes of the last segment that do not contain data 
+            n = 7 - ( total - 7*((total-1)//7) ) if total else 7
+            msg =  (CANOPEN_SDO_CS_RX_BD|(n<<CANOPEN_SDO_CS_DB_N_SHIFT)|CANOPEN_SDO_CS_DB_CS_EBD).to_bytes(1,'little')+\
+                (crc).to_bytes(2,'little')+bytes(5)
+            msgRet = yield msg
+        except Exception as ex:
+            if str(ex) == 'Timeout' :
+                self.SDOAbort( node , index , subindex , CANOPEN_SDO_ABORT_TIMEOUT )
+            raise
+        if ( msgRet[0] & CANOPEN_SDO_CS_MASK ) == CANOPEN_SDO_CS_TX_ADT :
+            self.raiseSdoAbort( node , index , subindex , msgRet )
+        if ( msgRet[0] & CANOPEN_SDO_CS_MASK ) != CANOPEN_SDO_CS_TX_BD or \
+           ( msgRet[0] & CANOPEN_SDO_CS_DB_SS_MASK ) != CANOPEN_SDO_CS_DB_SS_BD_END :
+            logging.error ('Bad response to SDO block download end') 
+            raise Exception('Bad response to SDO block download end')
+        return 0 
+
+
+    def _recordPlan(self, node, index, subindices, types):
+        '''
+        (subindex, Type, TypeLength entry) of every subindex, types resolved once
+        '''
+        plan = []
+        for subindex in subindices:
+            Type = types.get(subindex) if isinstance(types,dict) else types
+            index, subindex, Type = self.resolveObject(node, index, subindex, Type)
+            Type = Type.lower()
+            if Type not in TypeLength:
+                logging.error('SDO desired for ilegal type, found['+repr(Type)+'] , permitted: ' + repr(TypeLength.keys()) )
+                raise Exception('SDO desired for ilegal type, found['+repr(Type)+'] , permitted: ' + repr(TypeLength.keys()))
+            plan.append((subindex, Type, TypeLength[Type]))
+        return plan
+
+    def upload_record(self, node, index, subindices=None, types=None):
+        '''
+        Read sub-indices of an array or record with back-to-back requests.
+        Types and requests are prepared before the first request, so the
+        next request leaves as soon as a response is decoded.
+        'vis string' entries longer than CANOPEN_RECORD_PST bytes are read
+        by block upload if the node supports it.
+        :param index      : index, name or OdEntry of the object
+        :param subindices : iterable of sub-indices, None - 1 to the value of sub-index 0
+        :param types      : one type for all, {subindex: type}, or None - from the
+                            object dictionary
+        :returns          : {subindex: value} in the order of subindices
+        '''
+        return self._sdoRun( node , self._uploadRecordSteps( node , index , subindices , types ) )
+
+    def _uploadRecordSteps(self, node, index, subindices=None, types=None):
+        '''
+        Steps of upload_record, see _sdoRun
+        '''
+        if not isinstance(index,int):
+            index = self.resolveObject(node, index, 0, 'domain')[0]
+        if subindices is None:
+            subindices = range(1, (yield from self._sdoUploadSteps(node, index, 0, 'unsigned8')) + 1)
+        plan = self._recordPlan(node, index, subindices, types)
+        cache = self.sdoCache
+        values = {}
+        msg = bytearray((CANOPEN_SDO_CS_RX_IDU, index & 0xFF, index >> 8, 0, 0, 0, 0, 0))
+        for subindex, Type, (size, signed, fmt) in plan:
+            if cache is not None:
+                found, value = cache.lookup(node, index, subindex, Type, True)
+                if found:
+                    values[subindex] = value
+                    continue
+            if Type == 'vis string' and self.blockSupport.get(node, True):
+                value = yield from self._uploadStringSteps(node, index, subindex)
+            else:
+                msg[3] = subindex
+                msgRet = yield msg
+                cs = msgRet[0]
+                if cs == CANOPEN_SDO_CS_TX_ADT :
+                    self.raiseSdoAbort( node , index , subindex , msgRet )
+                if ( cs & CANOPEN_SDO_CS_MASK ) != CANOPEN_SDO_CS_TX_IDU or msgRet[1:4] != msg[1:4] :
+                    logging.error ('Bad response to SDO upload init')
+                    raise Exception('Bad response to SDO upload init')
+                if cs & CANOPEN_SDO_CS_ID_E_FLAG :
+                    n = 4 - (( cs >> 2 ) & 3 ) if ( cs & CANOPEN_SDO_CS_ID_S_FLAG ) else 4
+                    if Type == 'vis string' :
+                        value = msgRet[4:4+n].decode('ascii')
+                    elif n < size :
+                        logging.error('No enough bytes in the return message for the desired data type' )
+                        raise Exception('No enough bytes in the return message for the desired data type')
+                    else:
+                        value = struct.unpack_from(fmt,msgRet,4)[0]
+                else:
+                    value = bytes((yield from self._sdoUploadSegmentsSteps( node , index , subindex , msgRet )))
+                    if Type == 'vis string' :
+                        value = value.decode('ascii')
+                    elif len(value) < size :
+                        raise Exception('Length of SDO upload not as expected')
+                    else:
+                        value = struct.unpack_from(fmt,value)[0]
+            if cache is not None:
+                cache.store(node, index, subindex, Type, True, value)
+            values[subindex] = value
+        return values
+
+    def _uploadStringSteps(self, node, index, subindex):
+        '''
+        Steps uploading a 'vis string' by block transfer, the server switches to an
+        expedited or segmented upload below CANOPEN_RECORD_PST bytes.
+        Falls back to SDOUploadObject if the node does not support block transfers.
+        '''
+        try:
+            value = yield from self._sdoUploadBlockSteps( node , index , subindex , pst=CANOPEN_RECORD_PST )
+        except Exception as ex:
+            if str(ex) == 'Timeout' or self.blockSupport.get(node) :
+                raise
+            value = yield from self._sdoUploadObjectSteps( node , index , subindex , 'vis string' )
+            # only now it is clear the block transfer itself was refused
+            self.blockSupport[node] = False
+            return value
+        self.blockSupport[node] = True
+        return value.decode('ascii')
+
+    def download_record(self, node, index, values, types=None):
+        '''
+        Write sub-indices of an array or record with back-to-back requests.
+        Numbers up to 4 bytes are written expedited, 8 byte numbers segmented,
+        'vis string' entries by block download if the node supports it and
+        they are longer than CANOPEN_RECORD_PST bytes.
+        :param index  : index, name or OdEntry of the object
+        :param values : {subindex: value}, written in this order
+        :param types  : one type for all, {subindex: type}, or None - from the
+                        object dictionary
+        :returns      : 0
+        '''
+        return self._sdoRun( node , self._downloadRecordSteps( node , index , values , types ) )
+
+    def _downloadRecordSteps(self, node, index, values, types=None):
+        '''
+        Steps of download_record, see _sdoRun
+        '''
+        if not isinstance(index,int):
+            index = self.resolveObject(node, index, 0, 'domain')[0]
+        plan = self._recordPlan(node, index, list(values), types)
+        cache = self.sdoCache
+        msg = bytearray((0, index & 0xFF, index >> 8, 0, 0, 0, 0, 0))
+        for subindex, Type, (size, signed, fmt) in plan:
+            data = values[subindex]
+            if cache is not None:
+                cache.invalidate(node, index, subindex)
+            if Type == 'vis string':
+                yield from self._downloadStringSteps(node, index, subindex, data)
+                if cache is not None:
+                    cache.written(node, index, subindex, Type, data)
+                continue
+            if Type == 'vis string' or size > 4:
+                yield from self._sdoDownloadSteps(node, index, subindex, data, Type)
+                continue
+            msg[0] = CANOPEN_SDO_CS_RX_IDD|((4-size)<<CANOPEN_SDO_CS_ID_N_SHIFT)|CANOPEN_SDO_CS_ID_E_FLAG|CANOPEN_SDO_CS_ID_S_FLAG
+            msg[3] = subindex
+            msg[4:8] = struct.pack(fmt if fmt[0] == '<' else '<'+fmt, data).ljust(4, b'\0')
+            msgRet = yield msg
+            if msgRet[0] == CANOPEN_SDO_CS_TX_ADT :
+                self.raiseSdoAbort( node , index , subindex , msgRet )
+            if msgRet[0] & CANOPEN_SDO_CS_MASK != CANOPEN_SDO_CS_TX_IDD or msgRet[1:4] != msg[1:4] :
+                logging.error ('Bad response to SDO download init')
+                raise Exception('Bad response to SDO download init')
+            if cache is not None:
+                cache.written(node, index, subindex, Type, data)
+        return 0
+
+    def _downloadStringSteps(self, node, index, subindex, data):
+        '''
+        Steps downloading a 'vis string' (str or bytes-like), by block transfer if it
+        is longer than CANOPEN_RECORD_PST bytes and the node supports it
+        '''
+        if len(data) <= CANOPEN_RECORD_PST or not self.blockSupport.get(node, True):
+            return (yield from self._sdoDownloadSteps( node , index , subindex , data , 'vis string' ))
+        try:
+            yield from self._sdoDownloadBlockSteps( node , index , subindex , data )
+        except Exception as ex:
+            if str(ex) == 'Timeout' or self.blockSupport.get(node) :
+                raise
+            yield from self._sdoDownloadSteps( node , index , subindex , data , 'vis string' )
+            self.blockSupport[node] = False
+            return 0
+        self.blockSupport[node] = True
+        return 0
+
+    def _pdoObjects( self , PdoNum , FlagRxTxIn ):
+        '''
+        (communication parameter index, mapping parameter index) of a PDO
+        '''
+        FlagRxTx = FlagRxTxIn.lower()
+        if FlagRxTx not in MapOpt.keys() or PdoNum not in range(1,5) :
+            logging.error('Ilegal PDO : found ['+repr(FlagRxTxIn)+' '+repr(PdoNum)+']')
+            raise Exception('Ilegal PDO : found ['+repr(FlagRxTxIn)+' '+repr(PdoNum)+']')
+        return MapOpt[FlagRxTx][0] + PdoNum - 1 , MapOpt[FlagRxTx][1] + PdoNum - 1
+
+    def _mappingValue( self , node , entry ):
+        '''
+        Mapping entry index(16) : sub-index(8) : length(8), CiA DS301
+        :param entry : (index, subindex, bits), or name / (index, subindex) / OdEntry
+                       of a fixed size object in the object dictionary of the node
+        '''
+        if isinstance(entry,tuple) and len(entry) == 3 :
+            index , subindex , bits = entry
+        else:
+            od = self.objectDictionary(node)
+            odEntry = None if od is None else od.get(entry)
+            if odEntry is None or odEntry.bits is None :
+                logging.error('Cannot map %r on node %d' % (entry, node))
+                raise Exception('Cannot map %r on node %d' % (entry, node))
+            index , subindex , bits = odEntry.index , odEntry.subindex , odEntry.bits
+        return ( index << 16 ) | ( subindex << 8 ) | bits
+
+    def read_pdo_mapping( self , node , pdoNum , rxTx , refresh = False ):
+        '''
+        Current COB-ID, transmission type and mapping of a PDO, as read from the
+        node or as left by the last apply_pdo_mapping
+        :param rxTx    : 'Rx' or 'Tx'
+        :param refresh : if True always read from the node
+        :returns       : (COB-ID entry, transmission type, tuple of mapping entries)
+        '''
+        pdoPar , pdoMap = self._pdoObjects( pdoNum , rxTx )
+        mapping = None if refresh else self.pdoMappings.get( ( node , pdoPar ) )
+        if mapping is None:
+            par = self.upload_record( node , pdoPar , (1,2) , {1:'unsigned32',2:'unsigned8'} )
+            entries = self.upload_record( node , pdoMap , None , 'unsigned32' )
+            mapping = ( par[1] , par[2] , tuple(entries.values()) )
+            self.pdoMappings[( node , pdoPar )] = mapping
+        return mapping
+
+    def apply_pdo_mapping( self , node , pdoNum , rxTx , entries , transType = None , cobId = None , refresh = False ):
+        '''
+        Idempotent PDO mapping: the PDO is compared with its current mapping
+        (read once, then kept in self.pdoMappings) and only what differs is
+        written, nothing at all if the PDO is already mapped as desired.
+        A changed mapping is written with the PDO invalid (COB-ID bit 31) and
+        only the changed entries, the PDO is left valid.
+        The kept mapping is stale after a reset of the node or writes by other
+        functions than this one and SetPdoMapping, use refresh then.
+        :param rxTx      : 'Rx' or 'Tx'
+        :param entries   : iterable of mapped objects, see _mappingValue
+        :param transType : transmission type [0...255], None - leave as is
+        :param cobId     : PDO COB-ID, None - leave as is
+        :param refresh   : if True read the current mapping from the node
+        :returns         : True if anything was written
+        '''
+        pdoPar , pdoMap = self._pdoObjects( pdoNum , rxTx )
+        wanted = tuple( self._mappingValue( node , entry ) for entry in entries )
+        oldCobId , oldTransType , mapped = self.read_pdo_mapping( node , pdoNum , rxTx , refresh )
+        if cobId is None:
+            newCobId = oldCobId & ~(1<<31)
+        else:
+            # keep the RTR bit as the node has it
+            newCobId = ( oldCobId & (1<<30) ) | ( cobId & 0x1FFFFFFF )
+        if transType is None:
+            transType = oldTransType
+        remap = wanted != mapped
+        if not remap and newCobId == oldCobId and transType == oldTransType :
+            return False
+
+        try:
+            if ( remap or newCobId != oldCobId ) and not oldCobId & (1<<31) :
+                # mapping and COB-ID can only be changed while the PDO is invalid
+                self.download_record( node , pdoPar , {1: oldCobId | (1<<31)} , 'unsigned32' )
+            if transType != oldTransType :
+                self.download_record( node , pdoPar , {2: transType} , 'unsigned8' )
+            if remap :
+                changed = dict( ( subindex , value ) for subindex , value in enumerate( wanted , 1 )
+                                if subindex > len(mapped) or mapped[subindex-1] != value )
+                self.download_record( node , pdoMap , {0: 0} , 'unsigned8' )
+                self.download_record( node , pdoMap , changed , 'unsigned32' )
+                self.download_record( node , pdoMap , {0: len(wanted)} , 'unsigned8' )
+            if remap or newCobId != oldCobId :
+                self.download_record( node , pdoPar , {1: newCobId} , 'unsigned32' )
+        except Exception:
+            # state of the PDO unknown
+            self.pdoMappings.pop( ( node , pdoPar ) , None )
+            raise
+        self.pdoMappings[( node , pdoPar )] = ( newCobId , transType , wanted )
+        return True
+
+    def invalidatePdoMappings( self , node = None ):
+        '''
+        Forget the mappings kept by apply_pdo_mapping, of one node or all nodes,
+        e.g. after a reset of the node
+        '''
+        for key in [ key for key in self.pdoMappings if node is None or key[0] == node ] :
+            del self.pdoMappings[key]
 
     def SetPdoMapping( self , NodeId , PdoNum , FlagRxTxIn , TransType , IndexArr , SubIndexArr , LenArr , PdoCobId =None ):
-# function SetPdoMapping( h , NodeId , PdoNum , FlagRxTx , TransType , IndexArr , SubIndexArr , LenArr )
+# function SetPdoMapping( NodeId , PdoNum , FlagRxTx , TransType , IndexArr , SubIndexArr , LenArr )
 #
 # Purpose: Map the specified PDO 
 #
 # Arguments: 
-# h: Handle to opened communication port 
 # NodeId: Node ID
 # PdoNum: Number of PDO [1,4]
 # FlagRxTx: If PDO Rx then 'Rx', if PDO Tx then 'Tx' 
@@ -835,131 +1777,126 @@ class CanOpen():
 # SubIndexArr: Array of sub-indices of objects to be mapped
 # LenArr: Array of lengths of objects to be mapped [bites]
 # PdoCobId: Not obligatory, if exists, set PDO cob-id parameter
-        FlagRxTx = FlagRxTxIn.tolower()
-        assert FlagRxTx in FlagRxTx.keys() ,'Ilegal Tx Rx type : found ['+repr(FlagRxTxIn) +']' 
-        assert PdoNum in range(4) ,'Ilegal PdoNum'
-        pdoPar = MapOpt[FlagRxTx][0]
-        pdoMap = MapOpt[FlagRxTx][1]
-        cobId = PdoNum*256 + MapOpt[FlagRxTx][2]
-#For changing the PDO mapping the previous PDO must be deleted, the sub-index 0 must be set to 0. 	
-        self.SDODownload( NodeId , pdoMap, 0 , 0 , 'unsigned8' , AbortMsg = 'Cannot delete previous mapping') ;
+#
+# Every entry is rewritten, see apply_pdo_mapping to write only what changed
+        return self._sdoRun( NodeId , self._setPdoMappingSteps( NodeId , PdoNum , FlagRxTxIn , TransType , IndexArr , SubIndexArr , LenArr , PdoCobId ) )
+
+    def _setPdoMappingSteps( self , NodeId , PdoNum , FlagRxTxIn , TransType , IndexArr , SubIndexArr , LenArr , PdoCobId =None ):
+# Steps of SetPdoMapping, see _sdoRun
+        pdoPar , pdoMap = self._pdoObjects( PdoNum , FlagRxTxIn )
+        self.pdoMappings.pop( ( NodeId , pdoPar ) , None )
 
         if PdoCobId != None : 
-            Value,AbortFlag= self.SDOUpload(  NodeId , pdoPar, 1 , 'unsigned32' ) ;
-            if AbortFlag: 
-                error( 'Cannot program PDO parameters' )
-                pdoCobId = PdoCobId | (3<<30) # No RTR allowed
-                self.SDODownload( h , NodeId , pdoPar , 1 , pdoCobId , 'unsigned32' ,'Cannot set transmission type') 
+# The COB-ID can only be changed while the PDO is invalid (bit 31)
+            cobId = yield from self._sdoUploadSteps( NodeId , pdoPar , 1 , 'unsigned32' , cached = False )
+            yield from self._downloadRecordSteps( NodeId , pdoPar , {1: cobId | (1<<31)} , 'unsigned32' )
+
+#For changing the PDO mapping the previous PDO must be deleted, the sub-index 0 must be set to 0. 	
+        yield from self._downloadRecordSteps( NodeId , pdoMap , {0: 0} , 'unsigned8' )
 
 # Send SDO download to set transmission type.
 # Transmission type resides at the sub-index 2h of the PDO Communication Parameter record.				
-        self.SDODownload( h , NodeId , pdoPar , 2 , TransType , 'unsigned8' ,'Cannot set transmission type') ;
-
-# Mapping loop for all PDO objects to be mapped
-        for subIndex in range(len(IndexArr)):
-        # The sub-indices from 1 to n contain the information about the mapped objects.
-        # Every entry  describes the PDO by its index, sub-index and length
-        # according to the Fig.66 CiA DS301 : 
-        # 16 most significant bits is object index
-        # 8 next bits is sub-index
-        # 8 least significant bits is length of object	
-            data = IndexArr(subIndex)*65536 + SubIndexArr(subIndex)*256 + LenArr(subIndex) ;
-            AbortFlag = self.SDODownload( h , NodeId , pdoMap , subIndex , data , 'unsigned32' ) ;
-            if AbortFlag:
-                err = self.AnalyzeSdoAbort( AbortFlag ) ;
-                error( 'Cannot set mapping: '+err) 
-
-# Send SDO download to set number of entries of the PDO mapped objects 
+        yield from self._downloadRecordSteps( NodeId , pdoPar , {2: TransType} , 'unsigned8' )
+
+# Mapping of all PDO objects to be mapped
+# The sub-indices from 1 to n contain the information about the mapped objects.
+# Every entry  describes the PDO by its index, sub-index and length
+# according to the Fig.66 CiA DS301 : 
+# 16 most significant bits is object index
+# 8 next bits is sub-index
+# 8 least significant bits is length of object	
+        yield from self._downloadRecordSteps( NodeId , pdoMap ,
+                              dict( ( subIndex + 1 , IndexArr[subIndex]*65536 + SubIndexArr[subIndex]*256 + LenArr[subIndex] )
+                                    for subIndex in range(len(IndexArr)) ) , 'unsigned32' )
+
 # Subindex 0 is number of mapped objects in PDO
-# For changing the PDO mapping the previous PDO must be deleted, the sub-index 0 must be set to 0. 	
-        AbortFlag = self.SDODownload( h , NodeId , pdoMap, 0 , length(IndexArr) , 'unsigned8' ) 
-        if AbortFlag:
-            err = self.AnalyzeSdoAbort( AbortFlag ) ;
-            error( 'Cannot delete previous mapping: {0}'+err) 
+        yield from self._downloadRecordSteps( NodeId , pdoMap , {0: len(IndexArr)} , 'unsigned8' )
 
+        if PdoCobId != None : 
+# valid, no RTR allowed
+            yield from self._downloadRecordSteps( NodeId , pdoPar , {1: PdoCobId | (1<<30)} , 'unsigned32' )
 
-        AbortFlag = self.SDOUpload( h , NodeId , pdoMap, 0 , 'unsigned8' ) 
-        if AbortFlag:
-            err = self.AnalyzeSdoAbort( AbortFlag ) ;
-            error('Cannot delete previous mapping: '+err ) ;
+        if ( yield from self._sdoUploadSteps( NodeId , pdoMap , 0 , 'unsigned8' , cached = False ) ) != len(IndexArr) :
+            logging.error('Cannot set mapping')
+            raise Exception('Cannot set mapping')
 
 #Get a recorder vector 
  #h: Communication handle 
  #NodeId: Node Id to bring the data from 
  #BitNumber: The index of the recorded value 
  #unsign: 1 if numbers are to be brought unsigned  
+ #out: Not obligatory, NumPy array of the vector length to decode into
+ #The vector is returned as a NumPy array, as a list if NumPy is not installed
         
-    def GetBH( self , NodeId = None , BitNumber = 0 , unsign = 0  ) :
+    def GetBH( self , NodeId = None , BitNumber = 0 , unsign = 0 , out = None ) :
 # function Arr = GetBH( h , NodeId , BitNumber , usign ) 
 
-        Value,AbortFlag = self.SDOUpload( NodeId , 8240 , BitNumber , 'vis string' , 3 , decode = False); # 8240 = 0x2030
+        Value = self.SDOUpload( NodeId , 8240 , BitNumber , 'vis string' , decode = False); # 8240 = 0x2030
         
         Value0 = struct.unpack_from('<B',Value)[0] 
         recorderTsMultiplier = Value0 & 0xf 
         dataLength = struct.unpack_from('<H',Value,1)[0] ;
-        Arr = [0] * dataLength 
         factor = struct.unpack_from('f',Value,3)[0]  
-        outType = (Value0 ,0x30) >> 4  ; #48 = 0x30
+        outType = (Value0 & 0x30) >> 4  ; #48 = 0x30
         dataType = (Value0 &0xc0) >> 6 ; # 192 = 0xc0
         dataTypeLen = [2,4,8]   
 
         assert dataType in [0,1,2],'Unknown data type for recorder'
         assert len(Value) == 7 + dataLength * dataTypeLen[dataType] ,'Recorder data stream had incorrect length'
-        if ( dataType == 0 ) and (not unsign):
-# short signed 
-            return [struct.unpack_from('<h',Value,7+i*2)[0] for i in range(dataLength) ]
-        elif ( dataType == 0 ) and  unsign:
-# short usigned 
-            return [struct.unpack_from('<H',Value,7+i*2)[0] for i in range(dataLength) ]
-        elif ( dataType == 1 ) and  (not unsign) and (outType != 3) :
-# long signed 
-            return [struct.unpack_from('<l',Value,7+i*4)[0] for i in range(dataLength) ]
-        elif ( dataType == 1 ) and unsign and (outType != 3) :
-# long usigned 
-            return [struct.unpack_from('<L',Value,7+i*4)[0] for i in range(dataLength) ]
-        elif ( dataType == 1 ) : 
+        if dataType == 0 :
+# short signed / unsigned 
+            dtype = '<u2' if unsign else '<i2'
+        elif ( dataType == 1 ) and (outType != 3) :
+# long signed / unsigned 
+            dtype = '<u4' if unsign else '<i4'
+        elif dataType == 1 :
 # float 
-            return [struct.unpack_from('<f',Value,7+i*4)[0] for i in range(dataLength) ]
+            dtype = '<f4'
         else:
 # double 
-            return [struct.unpack_from('<d',Value,7+i*8)[0] for i in range(dataLength) ]
+            dtype = '<f8'
+        return self._recorderVector( Value , dtype , dataLength , None , out )
 
-    def GetRU( self, NodeId = None , BitNumber = 0 , unsign = 0 , bDmdRec = 0 ) :
+    def GetRU( self, NodeId = None , BitNumber = 0 , unsign = 0 , bDmdRec = 0 , out = None ) :
 # function Arr = GetBH( h , NodeId , BitNumber , usign ) 
 
-        Value = self.SDOUpload(  NodeId , 8277 if bDmdRec else 8240 , BitNumber , 'vis string' , 3 , decode = False); # 8240 = 0x2030
+        Value = self.SDOUpload(  NodeId , 8277 if bDmdRec else 8240 , BitNumber , 'vis string' , decode = False); # 8240 = 0x2030
         
-        dataType = struct.unpack_from('<B',Value)[0] # 0 = short , 1 = long , 2 = float , 3 = double , 4 = __int64
+        dataType = struct.unpack_from('<B',Value)[0] # 0 = short , 1 = long , 2 = float , 3 = __int64 , 4 = double
         dataLength = struct.unpack_from('<H',Value,1)[0]
-        Arr = [0] * dataLength 
         fac = struct.unpack_from('f',Value,3)[0]
         dataTypeLen = [2,4,4,8,8]   
 
         assert dataType in [0,1,2,3,4],'Unknown data type for recorder'
         assert len(Value) == 7 + dataLength * dataTypeLen[dataType] ,'Recorder data stream had incorrect length'
-        if ( dataType == 0 ) and (not unsign):
-# short signed 
-            return [struct.unpack_from('<h',Value,7+i*2)[0] for i in range(dataLength) ]
-        elif ( dataType == 0 ) and  unsign:
-# short usigned 
-            return [struct.unpack_from('<H',Value,7+i*2)[0] for i in range(dataLength) ]
-        elif ( dataType == 1 ) and  (not unsign) :
-# long signed 
-            return [struct.unpack_from('<l',Value,7+i*4)[0] for i in range(dataLength) ]
-        elif ( dataType == 1 ) and unsign :
-# long usigned 
-            return [struct.unpack_from('<L',Value,7+i*4)[0] for i in range(dataLength) ]
-        elif ( dataType == 2 ) : 
-# float 
-            return [struct.unpack_from('<f',Value,7+i*4)[0] * fac  for i in range(dataLength) ]
-        elif ( dataType == 3 )  and  unsign:
-            return [struct.unpack_from('<Q',Value,7+i*8)[0]   for i in range(dataLength) ]
-        elif ( dataType == 3 )  :
-            return [struct.unpack_from('<q',Value,7+i*8)[0]   for i in range(dataLength) ]
-        elif ( dataType == 4 ) : 
-            return [struct.unpack_from('<d',Value,7+i*8)[0] for i in range(dataLength) ]
-        else:
-            error ('Bad data type in RU message') 
+        dtype = RecorderTypes[dataType][1 if unsign else 0]
+# only float samples are scaled
+        return self._recorderVector( Value , dtype , dataLength , fac if dataType == 2 else None , out )
+
+    def _recorderVector( self , Value , dtype , dataLength , factor = None , out = None ) :
+        '''
+        Decode the samples following the 7 bytes recorder header in one operation
+        :param dtype  : little endian NumPy type of a sample, e.g. '<i2'
+        :param factor : scale of the samples, None - not scaled
+        :param out    : NumPy array to decode into, None - a new array
+        :returns      : NumPy array, list if NumPy is not installed
+        '''
+        if np is None :
+            if out is not None :
+                raise ImportError('out requires numpy')
+            Arr = list( struct.unpack_from( '<%d%s' % ( dataLength , RecorderFormats[dtype] ) , Value , 7 ) )
+            return Arr if factor is None else [ sample * factor for sample in Arr ]
+        Arr = np.frombuffer( Value , dtype , dataLength , 7 )
+        if out is not None :
+            if factor is None :
+                np.copyto( out , Arr )
+            else:
+                np.multiply( Arr , factor , out = out )
+            return out
+        if factor is not None :
+            return Arr * factor
+        # a view of a bytearray is used as it is, one of immutable bytes is copied
+        return Arr if Arr.flags.writeable else Arr.copy()
 
 
     def SetOsIntCmd( self , str   ): 
@@ -974,8 +1911,12 @@ class CanOpen():
     #
     # Returns: 
     # str: Received string
+        return self._sdoRun( self.nodeId , self._setOsIntCmdSteps( self.nodeId , str ) )
+
+    def _setOsIntCmdSteps( self , nodeId , str ):
+    # Steps of SetOsIntCmd, see _sdoRun
     # Set object 0x1024 (OS mode) to execute immediate      
-        self.SDODownload( self.nodeId , 4131 , 1 , str , 'vis string' , 'OS interpreter send cmd'); # 4131 = 0x1023
+        yield from self._sdoDownloadSteps( nodeId , 4131 , 1 , str , 'vis string' , 'OS interpreter send cmd'); # 4131 = 0x1023
 
     #Wait till target is ready 
     #Result = 0 for completed, no reply 
@@ -984,11 +1925,11 @@ class CanOpen():
     #3 error , reply there 
         Value = 255 ;
         while Value == 255 : 
-           Value = self.SDOUpload( self.nodeId , 4131 , 2 , 'unsigned8' , 'OS interpreter wait ready ');# 4131 = 0x1023
+           Value = yield from self._sdoUploadSteps( nodeId , 4131 , 2 , 'unsigned8' , cached = False );# 4131 = 0x1023
 
         assert Value & 1 , 'Os interpreter failed' 
 
-        Value = self.SDOUpload(  self.nodeId , 4131 , 3 , 'vis string' ,'OS interpreter get result ');# 4131 = 0x1023
+        Value = yield from self._sdoUploadSteps( nodeId , 4131 , 3 , 'vis string' , cached = False );# 4131 = 0x1023
         return Value.replace(chr(0),'') 
         #return ''.join(([chr(i) for i in Value if i]))
 
@@ -1,3 +1,19 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# record layout returned by the read_many of every driver: timestamp of the
+# driver, CAN identifier without flag bits, canlib.canMSG_xxx flags, dlc and
+# the data, zero beyond dlc
+if np is not None:
+    canFrameDtype = np.dtype([('timestamp', '<u8'),
+                              ('id', '<u4'),
+                              ('flags', '<u4'),
+                              ('dlc', 'u1'),
+                              ('data', 'u1', (8,))])
+
+
 
 class CanopenClientMixin(object):
     '''
@@ -119,4 +135,4 @@ class CanopenClientMixin(object):
 #---------------------------------------------------------------------------#
 # Exported symbols
 #---------------------------------------------------------------------------#
-__all__ = [ 'CanopenClientMixin' ]
+__all__ = [ 'CanopenClientMixin', 'canFrameDtype' ]
@@ -0,0 +1,286 @@
+'''
+Receive Dispatcher
+------------------
+
+A single background thread owns ``canChannel.read`` and routes every
+received frame by its COB-ID, either into a per-ID queue or to the
+callbacks registered for that ID.  SDO, PDO, NMT and EMCY consumers then
+wait on their own queue with a real blocking timeout instead of polling
+the channel and throwing away frames meant for somebody else.
+
+Frames are handed on as the channel returned them, element 0 is always
+the COB-ID and element 1 the data; data the driver returned as a list
+(canlib, ni8473a) is converted to bytes once here, so no consumer has to.
+
+With a channel that filters in the kernel (socketcan.canChannel.setFilters)
+the subscribed COB-IDs are installed as its receive filters, so frames
+nobody waits for never wake the receive thread; stop restores the channel
+to receive everything.
+
+A failing driver read is retried with a growing pause; after maxErrors
+failures in a row the thread stops and keeps the last error, which
+CanOpen.waitCanMessage then raises instead of a timeout.
+'''
+import threading
+import queue
+import time
+import canlib
+import ni8473a
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger(__name__)
+
+# exceptions raised by the drivers when the read timeout expired
+NoMessage = (canlib.canNoMsg, ni8473a.canNoMsg)
+# pause [sec] after the first failed read, doubled with every further one
+ERROR_BACKOFF = 0.001
+ERROR_BACKOFF_MAX = 0.5
+
+
+#---------------------------------------------------------------------------#
+# Dispatcher
+#---------------------------------------------------------------------------#
+class CanDispatcher(object):
+    ''' Background receiver demultiplexing frames by COB-ID
+
+    Typical use::
+
+        dispatcher = CanDispatcher(ch)
+        dispatcher.start()
+        sdo = dispatcher.subscribe(0x581)
+        dispatcher.write(0x601, msg)
+        frame = sdo.get(timeout=0.002)
+    '''
+
+    def __init__(self, channel, pollTimeout=0.1, maxErrors=10, kernelFilters=True):
+        ''' Initialize the dispatcher
+
+        :param channel: opened channel (canlib or ni8473a canChannel)
+        :param pollTimeout: time [sec] the receive thread blocks in the
+                            driver before it re-checks for a stop request
+        :param maxErrors: consecutive failed reads after which the receive
+                          thread gives up, see error
+        :param kernelFilters: install the COB-IDs of the queues and callbacks
+                              as filters of a channel with setFilters, this
+                              replaces filters the caller set on the channel
+        '''
+        self.channel = channel
+        self.pollTimeout = int(pollTimeout*1000)
+        self.maxErrors = maxErrors
+        # the read error the receive thread stopped on, None while it is fine
+        self.error = None
+        self.queues = {}
+        self.callbacks = {}
+        self.unrouted = 0
+        self.dropped = 0
+        self.writeLock = threading.Lock()
+        self.kernelFilters = kernelFilters and hasattr(channel, 'setFilters')
+        self.filterLock = threading.Lock()
+        # the COB-IDs installed by _updateFilters, None for no filter
+        self.filtered = None
+        self.thread = None
+        self.running = False
+
+    #-----------------------------------------------------------------------#
+    # Thread control
+    #-----------------------------------------------------------------------#
+    def start(self):
+        ''' Start the receive thread (no-op if it is already running)
+        '''
+        if self.running:
+            return
+        if self.thread is not None:
+            # stopped by an error, collect it before the restart
+            self.thread.join()
+        self.error = None
+        self.running = True
+        self._updateFilters()
+        self.thread = threading.Thread(target=self._run, name='CanDispatcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        ''' Stop the receive thread and wait for it to leave the driver
+        '''
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+        if self.filtered is not None:
+            # direct reads of the channel see every frame again
+            with self.filterLock:
+                self.channel.setFilters(None)
+                self.filtered = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, klass, value, traceback):
+        self.stop()
+
+    def check(self):
+        ''' Raise if the receive thread stopped on a driver error
+        '''
+        if self.error is not None:
+            _logger.error('CAN dispatcher stopped: %s' % self.error)
+            raise Exception('CAN dispatcher stopped: %s' % self.error)
+
+    #-----------------------------------------------------------------------#
+    # Consumers
+    #-----------------------------------------------------------------------#
+    def subscribe(self, cobId, maxsize=0):
+        ''' Return the receive queue of a COB-ID, creating it on first use
+
+        When a bounded queue is full the oldest frame is discarded, so a slow
+        consumer never stalls the receive thread.
+
+        :param cobId: COB-ID to route into the queue
+        :param maxsize: queue bound, 0 for unbounded
+        :returns: queue.Queue receiving the frames of cobId
+        '''
+        q = self.queues.get(cobId)
+        if q is None:
+            # atomic, two threads subscribing at once get the same queue
+            q = self.queues.setdefault(cobId, queue.Queue(maxsize))
+            self._updateFilters()
+        return q
+
+    def unsubscribe(self, cobId):
+        ''' Remove the receive queue of a COB-ID
+
+        :param cobId: COB-ID to stop queueing
+        '''
+        self.queues.pop(cobId, None)
+        self._updateFilters()
+
+    def addCallback(self, cobIds, callback):
+        ''' Register callback(frame) for one or several COB-IDs
+
+        Callbacks run in the receive thread and must not block.
+
+        :param cobIds: a COB-ID or an iterable of COB-IDs (e.g. range(0x81,0x100))
+        :param callback: function called with every frame of these ids
+        '''
+        if isinstance(cobIds, int):
+            cobIds = (cobIds,)
+        for cobId in cobIds:
+            # copy on write - the receive thread iterates without locking
+            self.callbacks[cobId] = self.callbacks.get(cobId, ()) + (callback,)
+        self._updateFilters()
+
+    def removeCallback(self, cobIds, callback):
+        ''' Unregister a callback added by addCallback
+
+        :param cobIds: a COB-ID or an iterable of COB-IDs
+        :param callback: function to remove
+        '''
+        if isinstance(cobIds, int):
+            cobIds = (cobIds,)
+        for cobId in cobIds:
+            callbacks = tuple(cb for cb in self.callbacks.get(cobId, ()) if cb != callback)
+            if callbacks:
+                self.callbacks[cobId] = callbacks
+            else:
+                self.callbacks.pop(cobId, None)
+        self._updateFilters()
+
+    def _updateFilters(self):
+        ''' Install the routed COB-IDs as kernel filters of the channel
+        while the receive thread runs
+        '''
+        if not self.kernelFilters or not self.running:
+            return
+        with self.filterLock:
+            cobIds = sorted(set(self.queues) | set(self.callbacks))
+            if cobIds != self.filtered:
+                self.channel.setFilters(cobIds)
+                self.filtered = cobIds
+
+    def flush(self, cobId):
+        ''' Discard the frames waiting in the queue of a COB-ID
+
+        :param cobId: COB-ID whose queue is emptied
+        '''
+        q = self.queues.get(cobId)
+        if q is None:
+            return
+        try:
+            while True:
+                q.get_nowait()
+        except queue.Empty:
+            pass
+
+    def write(self, id, msg):
+        ''' Send a frame, serialized against writers in other threads
+
+        :param id: COB-ID of the frame
+        :param msg: data bytes
+        '''
+        with self.writeLock:
+            self.channel.write(id, msg)
+
+    #-----------------------------------------------------------------------#
+    # Receive thread
+    #-----------------------------------------------------------------------#
+    def dispatch(self, frame):
+        ''' Route one received frame to its queue and callbacks
+
+        :param frame: frame tuple as returned by canChannel.read
+        '''
+        cobId = frame[0]
+        if type(frame[1]) is not bytes:
+            frame = (cobId, bytes(frame[1])) + tuple(frame[2:])
+        q = self.queues.get(cobId)
+        callbacks = self.callbacks.get(cobId)
+        if q is None and callbacks is None:
+            self.unrouted += 1
+            return
+        if q is not None:
+            try:
+                q.put_nowait(frame)
+            except queue.Full:
+                self.dropped += 1
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                q.put_nowait(frame)
+        if callbacks is not None:
+            for callback in callbacks:
+                try:
+                    callback(frame)
+                except Exception as ex:
+                    _logger.error('Callback for COB-ID 0x%x failed: %s' % (cobId, ex))
+
+    def _run(self):
+        read = self.channel.read
+        errors = 0
+        while self.running:
+            try:
+                frame = read(self.pollTimeout)
+            except NoMessage:
+                errors = 0
+                continue
+            except Exception as ex:
+                errors += 1
+                _logger.error(ex)
+                if errors >= self.maxErrors:
+                    _logger.error('CAN dispatcher stopped after %d failed reads' % errors)
+                    self.error = ex
+                    self.running = False
+                    return
+                # a persistent failure must not spin the thread
+                time.sleep(min(ERROR_BACKOFF * 2 ** (errors - 1), ERROR_BACKOFF_MAX))
+                continue
+            errors = 0
+            self.dispatch(frame)
+
+
+#---------------------------------------------------------------------------#
+# Exported symbols
+#---------------------------------------------------------------------------#
+__all__ = ['CanDispatcher', 'NoMessage']
@@ -0,0 +1,252 @@
+'''
+Emergency Consumer
+------------------
+
+Collects the emergency messages (80h + Node ID) of all nodes::
+
+    UNSIGNED16 emergency error code, UNSIGNED8 error register (1001h),
+    5 bytes manufacturer specific error field
+
+Every node has a fixed size ring buffer of its last emergencies, so a
+fault storm costs bounded memory and the oldest entries are overwritten.
+The receive path only decodes, stores and hands the record on without
+blocking: subscriber queues drop their oldest record when full and the
+callbacks run in a notifier thread of their own::
+
+    consumer = EmcyConsumer(canopen)
+    consumer.addCallback(lambda emcy: print(emcyText(emcy.code)))
+    events = consumer.subscribe()
+    consumer.start()
+    ...
+    emcy = events.get()
+    history = consumer.readErrorHistory(3)      # 1003h of node 3
+'''
+import queue
+import struct
+import threading
+import collections
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger(__name__)
+
+EMCY_COB_ID = 0x80
+NODES = 128
+
+Emergency = collections.namedtuple('Emergency', 'nodeId code register data timestamp')
+
+# error code classes, by high byte of the error code (CiA 301)
+EmcyClasses = {
+    0x00: 'Error reset or no error',
+    0x10: 'Generic error',
+    0x20: 'Current',
+    0x21: 'Current, device input side',
+    0x22: 'Current inside the device',
+    0x23: 'Current, device output side',
+    0x30: 'Voltage',
+    0x31: 'Mains voltage',
+    0x32: 'Voltage inside the device',
+    0x33: 'Output voltage',
+    0x40: 'Temperature',
+    0x41: 'Ambient temperature',
+    0x42: 'Device temperature',
+    0x50: 'Device hardware',
+    0x60: 'Device software',
+    0x61: 'Internal software',
+    0x62: 'User software',
+    0x63: 'Data set',
+    0x70: 'Additional modules',
+    0x80: 'Monitoring',
+    0x81: 'Communication',
+    0x82: 'Protocol error',
+    0x90: 'External error',
+    0xF0: 'Additional functions',
+    0xFF: 'Device specific',
+}
+
+
+def emcyText(code):
+    ''' Description of an emergency error code by its class '''
+    text = EmcyClasses.get(code >> 8)
+    if text is None:
+        text = EmcyClasses.get(code >> 8 & 0xF0, 'Unknown error')
+    return text
+
+
+class EmcyConsumer(object):
+    ''' Emergency consumer with a ring buffered history per node
+    '''
+
+    def __init__(self, canopen, history=64, backlog=1024):
+        ''' Initialize the consumer
+
+        :param canopen: CanOpen object, its dispatcher delivers the frames
+        :param history: number of emergencies kept per node
+        :param backlog: emergencies waiting for the callbacks before new
+                        ones are dropped
+        '''
+        self.canopen = canopen
+        self.history = [collections.deque(maxlen=history) for i in range(NODES)]
+        self.counts = [0] * NODES
+        self.callbacks = []
+        self.subscribers = []
+        self.pending = queue.Queue(backlog)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+
+    #-----------------------------------------------------------------------#
+    # Receive path
+    #-----------------------------------------------------------------------#
+    def receive(self, frame):
+        ''' Dispatcher callback for 81h to FFh '''
+        nodeId = frame[0] - EMCY_COB_ID
+        data = bytes(frame[1]).ljust(8, b'\0')
+        code, register, field = struct.unpack_from('<HB5s', data)
+        emcy = Emergency(nodeId, code, register, field, frame[4] if len(frame) > 4 else None)
+        self.history[nodeId].append(emcy)
+        self.counts[nodeId] += 1
+        for subscriber in self.subscribers:
+            self._put(subscriber, emcy)
+        if self.callbacks:
+            try:
+                self.pending.put_nowait(emcy)
+            except queue.Full:
+                self.dropped += 1
+
+    def _put(self, q, emcy):
+        try:
+            q.put_nowait(emcy)
+        except queue.Full:
+            # keep the latest, drop the oldest
+            self.dropped += 1
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+            q.put_nowait(emcy)
+
+    #-----------------------------------------------------------------------#
+    # Consumers
+    #-----------------------------------------------------------------------#
+    def subscribe(self, maxsize=256):
+        ''' Queue receiving every emergency as an Emergency record
+
+        :param maxsize: queue length, the oldest record is dropped when full
+        '''
+        q = queue.Queue(maxsize)
+        with self.lock:
+            self.subscribers = self.subscribers + [q]
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s is not q]
+
+    def addCallback(self, callback):
+        ''' Call callback(emcy) for every emergency, from the notifier thread
+        '''
+        with self.lock:
+            self.callbacks = self.callbacks + [callback]
+
+    def removeCallback(self, callback):
+        with self.lock:
+            self.callbacks = [cb for cb in self.callbacks if cb is not callback]
+
+    def _notify(self):
+        while True:
+            emcy = self.pending.get()
+            if emcy is None:
+                return
+            for callback in self.callbacks:
+                try:
+                    callback(emcy)
+                except Exception as ex:
+                    _logger.error('EMCY callback for node %d failed: %s' % (emcy.nodeId, ex))
+
+    #-----------------------------------------------------------------------#
+    # History
+    #-----------------------------------------------------------------------#
+    def last(self, nodeId):
+        ''' Latest Emergency of a node, None if there was none '''
+        history = self.history[nodeId]
+        return history[-1] if history else None
+
+    def errors(self):
+        ''' {Node ID: Emergency} of the nodes whose latest emergency is not
+        an error reset
+        '''
+        return dict((nodeId, history[-1]) for nodeId, history in enumerate(self.history)
+                    if history and history[-1].code != 0)
+
+    def clear(self, nodeId=None):
+        ''' Forget the history of one or all nodes '''
+        for history in self.history if nodeId is None else (self.history[nodeId],):
+            history.clear()
+
+    def readErrorHistory(self, nodeId):
+        ''' Upload the pre-defined error field (1003h) of a node
+
+        :returns: list of (error code, manufacturer specific info), newest first
+        '''
+        errors = self.canopen.upload_record(nodeId, 0x1003, None, 'unsigned32')
+        return [(value & 0xFFFF, value >> 16) for value in errors.values()]
+
+    def readErrorHistories(self, nodeIds, scheduler=None):
+        ''' Upload the pre-defined error field of many nodes
+
+        :param scheduler: SdoScheduler, reads all nodes concurrently if given
+        :returns: {Node ID: readErrorHistory(Node ID) or the exception raised}
+        '''
+        if scheduler is None:
+            histories = {}
+            for nodeId in nodeIds:
+                try:
+                    histories[nodeId] = self.readErrorHistory(nodeId)
+                except Exception as ex:
+                    histories[nodeId] = ex
+            return histories
+        nodeIds = list(nodeIds)
+        futures = [scheduler.submit(nodeId, self.readErrorHistory, nodeId) for nodeId in nodeIds]
+        return dict(zip(nodeIds, scheduler.gather(futures, returnExceptions=True)))
+
+    #-----------------------------------------------------------------------#
+    # Start / stop
+    #-----------------------------------------------------------------------#
+    def start(self):
+        ''' Start consuming, the dispatcher of canopen is started if needed
+        '''
+        if self.running:
+            return
+        self.thread = threading.Thread(target=self._notify, name='EmcyConsumer')
+        self.thread.daemon = True
+        self.thread.start()
+        dispatcher = self.canopen.startDispatcher()
+        dispatcher.addCallback(range(EMCY_COB_ID + 1, EMCY_COB_ID + NODES), self.receive)
+        self.running = True
+
+    def stop(self):
+        if not self.running:
+            return
+        if self.canopen.dispatcher is not None:
+            self.canopen.dispatcher.removeCallback(range(EMCY_COB_ID + 1, EMCY_COB_ID + NODES), self.receive)
+        self.pending.put(None)
+        self.thread.join()
+        self.thread = None
+        self.running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, klass, value, traceback):
+        self.stop()
+
+
+#---------------------------------------------------------------------------#
+# Exported symbols
+#---------------------------------------------------------------------------#
+__all__ = ['EmcyConsumer', 'Emergency', 'EmcyClasses', 'emcyText']
@@ -0,0 +1,262 @@
+'''
+Micro-benchmarks
+----------------
+
+Per-frame costs of the frame codec and of the ctypes binding layer, in
+nanoseconds per operation:
+
+* building SDO requests (int.to_bytes chains against struct)
+* parsing SDO responses (struct.unpack_from, int.from_bytes)
+* canlib.canChannel / canFastChannel read and write, including the list
+  conversion of the received data and inspect.stack()
+* ni8473a.canChannel read and write, including NCTYPE_CAN_FRAME construction
+* the errcheck dispatch (_canErrorCheck) on success and on canNoMsg
+
+The vendor libraries are replaced by a stub library compiled from the C
+source below (cc must be on the PATH), so the numbers contain the real
+argtypes conversion and errcheck of the bindings but no driver time::
+
+    python microbenchmark.py --json micro.json
+    python microbenchmark.py --baseline micro.json
+'''
+import os
+import sys
+import json
+import time
+import struct
+import timeit
+import inspect
+import platform
+import argparse
+import tempfile
+import subprocess
+from ctypes import CDLL, sizeof, c_uint8, c_ubyte, c_long, c_uint, c_ulong, byref
+import canlib
+import ni8473a
+import benchmark
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger(__name__)
+
+#---------------------------------------------------------------------------#
+# Stub library
+#---------------------------------------------------------------------------#
+STUB_SOURCE = r'''
+#include <string.h>
+#include <stddef.h>
+
+static long rdId = 0x181;
+static unsigned char rdMsg[8] = {1, 2, 3, 4, 5, 6, 7, 8};
+static unsigned rdDlc = 8;
+static int rdResult = 0;
+static unsigned char ncFrame[64];
+static unsigned ncFrameSize = 0;
+
+void stubSetMessage(long id, const unsigned char *msg, unsigned dlc, int result)
+{ rdId = id; memcpy(rdMsg, msg, 8); rdDlc = dlc; rdResult = result; }
+void stubSetNcFrame(const void *frame, unsigned size)
+{ ncFrameSize = size < sizeof(ncFrame) ? size : sizeof(ncFrame); memcpy(ncFrame, frame, ncFrameSize); }
+
+/* Kvaser canlib */
+int canInitializeLibrary(void) { return 0; }
+int canUnloadLibrary(void) { return 0; }
+short canGetVersion(void) { return 0x0805; }
+int canGetNumberOfChannels(int *n) { *n = 1; return 0; }
+int canGetChannelData(int ch, int item, void *buf, size_t n) { memset(buf, 0, n); return 0; }
+int canGetErrorText(int err, char *buf, unsigned n) { strncpy(buf, "stub", n); return 0; }
+int canOpenChannel(int ch, int flags) { return 0; }
+int canClose(int h) { return 0; }
+int canSetBusParams(int h, long f, unsigned t1, unsigned t2, unsigned sjw, unsigned ns, unsigned sm) { return 0; }
+int canGetBusParams(int h, long *f, unsigned *t1, unsigned *t2, unsigned *sjw, unsigned *ns, unsigned *sm)
+{ *f = 1000000; *t1 = *t2 = *sjw = *ns = *sm = 0; return 0; }
+int canBusOn(int h) { return 0; }
+int canBusOff(int h) { return 0; }
+int canSetBusOutputControl(int h, unsigned long t) { return 0; }
+int canIoCtl(int h, unsigned f, void *buf, unsigned n) { return 0; }
+int canWrite(int h, long id, void *msg, unsigned dlc, unsigned flag) { return 0; }
+int canWriteWait(int h, long id, void *msg, unsigned dlc, unsigned flag, unsigned long t) { return 0; }
+int canReadWait(int h, long *id, void *msg, unsigned *dlc, unsigned *flag, unsigned long *time, unsigned long t)
+{
+    if (rdResult) return rdResult;
+    *id = rdId; memcpy(msg, rdMsg, 8); *dlc = rdDlc; *flag = 2; *time = 0;
+    return 0;
+}
+int canReadSpecificSkip(int h, long id, void *msg, unsigned *dlc, unsigned *flag, unsigned long *time)
+{ memcpy(msg, rdMsg, 8); *dlc = rdDlc; *flag = 2; *time = 0; return rdResult; }
+int canReadSyncSpecific(int h, long id, unsigned long t) { return 0; }
+int kvReadDeviceCustomerData(int h, int u, int i, void *buf, size_t n) { memset(buf, 0, n); return 0; }
+int kvScriptSendEvent(int h, int s, int t, int e, unsigned d) { return 0; }
+
+/* NI-CAN */
+int ncGetHardwareInfo(unsigned c, unsigned p, unsigned a, unsigned s, void *buf) { memset(buf, 0, s); return 0; }
+int ncConfig(char *name, unsigned long n, unsigned long *ids, unsigned long *values) { return 0; }
+int ncOpenObject(char *name, unsigned long *h) { *h = 1; return 0; }
+int ncCloseObject(unsigned long h) { return 0; }
+int ncGetAttribute(unsigned long h, unsigned id, unsigned size, void *p) { memset(p, 0, size); return 0; }
+int ncSetAttribute(unsigned long h, unsigned id, unsigned size, void *p) { return 0; }
+int ncAction(unsigned long h, unsigned long op, unsigned long param) { return 0; }
+int ncWrite(unsigned long h, unsigned size, void *p) { return 0; }
+int ncRead(unsigned long h, unsigned size, void *p)
+{ memcpy(p, ncFrame, size < ncFrameSize ? size : ncFrameSize); return 0; }
+int ncWaitForState(unsigned long h, unsigned long state, unsigned long t, unsigned long *current)
+{ *current = state; return 0; }
+int ncReadMult(unsigned long h, unsigned long size, void *p, unsigned long *actual) { *actual = 0; return 0; }
+int ncStatusToString(int status, unsigned size, char *buf) { strncpy(buf, "stub", size); return 0; }
+'''
+
+
+def buildStub(directory=None):
+    ''' Compile the stub library
+
+    :param directory: output directory, a new temporary one if None
+    :returns: path of the library, None if no compiler is available
+    '''
+    directory = directory or tempfile.mkdtemp(prefix='canstub')
+    source = os.path.join(directory, 'canstub.c')
+    path = os.path.join(directory, 'libcanstub.so')
+    with open(source, 'w') as f:
+        f.write(STUB_SOURCE)
+    try:
+        subprocess.check_call([os.environ.get('CC', 'cc'), '-O2', '-shared', '-fPIC', '-o', path, source])
+    except (OSError, subprocess.CalledProcessError) as ex:
+        _logger.error('Cannot build the stub library: %s' % ex)
+        return None
+    return path
+
+
+#---------------------------------------------------------------------------#
+# Benchmarks
+#---------------------------------------------------------------------------#
+def measure(statement, number, repeat=5, **namespace):
+    ''' Best time of statement [ns per execution] '''
+    timer = timeit.Timer(statement, globals=namespace)
+    return min(timer.repeat(repeat, number)) / number * 1e9
+
+
+def benchCodec(results, number):
+    index, subindex = 0x1018, 4
+    sdoRequest = struct.Struct('<BHBL')
+    results['sdo_request_to_bytes'] = measure(
+        "(64).to_bytes(1,'little')+(index).to_bytes(2,'little')+(subindex).to_bytes(5,'little')",
+        number, index=index, subindex=subindex)
+    results['sdo_request_struct'] = measure(
+        'pack(0x40, index, subindex, 0)', number, pack=sdoRequest.pack, index=index, subindex=subindex)
+    results['sdo_download_init_to_bytes'] = measure(
+        "((1<<5)+((4-4)<<2)+(1<<1)+1).to_bytes(1,'little')+(index).to_bytes(2,'little')+"
+        "(subindex).to_bytes(1,'little')+data.to_bytes(4,'little')",
+        number, index=index, subindex=subindex, data=0x12345678)
+    msgRet = bytearray(b'\x43\x18\x10\x04\x78\x56\x34\x12')
+    results['sdo_response_unpack_from'] = measure(
+        "unpack_from('<L', msgRet, 4)[0]", number, unpack_from=struct.unpack_from, msgRet=msgRet)
+    results['sdo_response_struct_unpack_from'] = measure(
+        'unpack_from(msgRet, 4)[0]', number, unpack_from=struct.Struct('<L').unpack_from, msgRet=msgRet)
+    results['sdo_response_from_bytes'] = measure(
+        "from_bytes(msgRet[4:8], 'little')", number, from_bytes=int.from_bytes, msgRet=msgRet)
+    msg = (c_uint8 * 8)(1, 2, 3, 4, 5, 6, 7, 8)
+    results['ctypes_msg_list'] = measure('[msg[i] for i in range(len(msg))]', number, msg=msg)
+    results['ctypes_msg_bytes'] = measure('bytes(msg)', number, msg=msg)
+    results['inspect_stack_fn'] = measure('stack()[0][3]', max(number // 100, 10), stack=inspect.stack)
+
+
+def benchCanlib(results, stub, number):
+    cl = canlib.canlib(dll=stub)
+    stubDll = CDLL(stub)
+    ch = cl.openChannel(0)
+    fast = cl.openChannel(0, fastPath=True)
+    msg = bytes(range(8))
+    # inspect.stack() makes the plain channel much slower, fewer loops
+    slow = max(number // 100, 10)
+    results['canlib_read'] = measure('read(0)', slow, read=ch.read)
+    results['canlib_fast_read'] = measure('read(0)', number, read=fast.read)
+    results['canlib_write'] = measure('write(0x601, msg)', slow, write=ch.write, msg=msg)
+    results['canlib_fast_write'] = measure('write(0x601, msg)', number, write=fast.write, msg=msg)
+
+    # errcheck dispatch: the same function with and without _canErrorCheck
+    results['errcheck_ok'] = measure('busOn(0)', number, busOn=cl.dll.canBusOn)
+    results['errcheck_none'] = measure('busOn(0)', number, busOn=stubDll.canBusOn)
+    stubDll.stubSetMessage(0x181, msg, 8, canlib.canERR_NOMSG)
+    try:
+        results['errcheck_nomsg'] = measure(
+            'try:\n    read(0)\nexcept canNoMsg:\n    pass', number, read=fast.read, canNoMsg=canlib.canNoMsg)
+    finally:
+        stubDll.stubSetMessage(0x181, msg, 8, 0)
+
+
+def benchNi(results, stub, number):
+    cl = ni8473a.canlib(dll=stub)
+    stubDll = CDLL(stub)
+    ch = ni8473a.canChannel(cl, 'CAN0')
+    ch.open()
+    frame = ni8473a.NCTYPE_CAN_STRUCT(ArbitrationId=0x181, DataLength=8,
+                                      Data=(c_uint8 * 8)(*range(8)))
+    stubDll.stubSetNcFrame(byref(frame), sizeof(frame))
+    data = list(range(8))
+    results['ni_frame_build'] = measure(
+        'NCTYPE_CAN_FRAME(IsRemote=0, ArbitrationId=0x601, Data=(c_uint8*8)(*data), DataLength=len(data))',
+        number, NCTYPE_CAN_FRAME=ni8473a.NCTYPE_CAN_FRAME, c_uint8=c_uint8, data=data)
+    results['ni_write'] = measure('write(0x601, data)', number, write=ch.write, data=data)
+    results['ni_read'] = measure('read()', number, read=ch.read)
+
+
+METRICS = [(name, 'ns', False) for name in (
+    'sdo_request_to_bytes', 'sdo_request_struct', 'sdo_download_init_to_bytes',
+    'sdo_response_unpack_from', 'sdo_response_struct_unpack_from', 'sdo_response_from_bytes',
+    'ctypes_msg_list', 'ctypes_msg_bytes', 'inspect_stack_fn',
+    'canlib_read', 'canlib_fast_read', 'canlib_write', 'canlib_fast_write',
+    'errcheck_ok', 'errcheck_none', 'errcheck_nomsg',
+    'ni_frame_build', 'ni_write', 'ni_read')]
+
+
+def run(quick=False, stub=None):
+    ''' Run all micro-benchmarks
+
+    :param stub: path of the stub library, built if None
+    :returns: {metric: ns per operation}
+    '''
+    number = 2000 if quick else 50000
+    results = {}
+    benchCodec(results, number)
+    stub = stub or buildStub()
+    if stub is None:
+        _logger.error('No stub library, binding benchmarks skipped')
+        return results
+    benchCanlib(results, stub, number)
+    benchNi(results, stub, number)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='CanOpen micro-benchmarks')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare against this results file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed relative deterioration (default 0.1)')
+    parser.add_argument('--stub', help='prebuilt stub library')
+    parser.add_argument('--quick', action='store_true', help='short smoke run')
+    args = parser.parse_args(argv)
+
+    results = run(args.quick, args.stub)
+    document = {'meta': {'python': platform.python_version(),
+                         'platform': platform.platform(),
+                         'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                         'quick': args.quick},
+                'results': results}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+
+    if not args.baseline:
+        benchmark.report(results, metrics=METRICS)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    rows = benchmark.compare(results, baseline, args.tolerance, METRICS)
+    benchmark.report(results, rows, METRICS)
+    return 1 if any(row[4] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
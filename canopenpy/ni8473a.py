@@ -41,6 +41,12 @@ import struct
 import logging
 import inspect
 import time
+import math
+from canlib import canMSG_RTR, canMSG_STD, canMSG_EXT
+try:
+    import numpy as np
+except ImportError:
+    np = None
 #------------------------------------------------------------------#
 # NiCan constants                                                 #
 #------------------------------------------------------------------#
@@ -201,6 +207,9 @@ NC_DURATION_1MIN = 60000         # /* one minute */
 
 NC_FL_CAN_ARBID_XTD = 0x20000000
 
+# NCTYPE_STATUS of a function that did not complete within its timeout
+CanErrFunctionTimeout = -1074388991   # 0xBFF62001
+
 
 NC_FRMTYPE_DATA = 0x00
 NC_FRMTYPE_REMOTE = 0x01
@@ -233,6 +242,14 @@ class canError(Exception):
     def __str__(self):
         return "[canError] %s: %s (%d)" % (self.canlib.fn, self.__canGetErrorText(), self.canERR)
 
+class canNoMsg(Exception):
+    def __init__(self, canlib, canERR):
+        self.canlib = canlib
+        self.canERR = canERR
+
+    def __str__(self):
+        return "No messages available"
+
 class canWarning:
     def __init__(self,canlib,canWarn):
          self.canlib = canlib
@@ -304,6 +321,16 @@ class NCTYPE_CAN_STRUCT(Structure) : #size of structure is 22 bytes (8,4,2,8)
         ]
 
 
+# NumPy view of NCTYPE_CAN_STRUCT, converted to common.canFrameDtype by canChannel.read_many
+if np is not None:
+    from common import canFrameDtype
+    _ncFrameDtype = np.dtype({
+        'names'   : ['timestamp', 'id', 'flags', 'dlc', 'data'],
+        'formats' : ['<u8', '<u%d' % sizeof(c_ulong), 'u1', 'u1', ('u1', 8)],
+        'offsets' : [NCTYPE_CAN_STRUCT.TimeStamp.offset, NCTYPE_CAN_STRUCT.ArbitrationId.offset,
+                     NCTYPE_CAN_STRUCT.FrameType.offset, NCTYPE_CAN_STRUCT.DataLength.offset,
+                     NCTYPE_CAN_STRUCT.Data.offset],
+        'itemsize': sizeof(NCTYPE_CAN_STRUCT)})
 
 #----------------------------------------------------------------------#
 # Canlib class                                                         #
@@ -318,7 +345,12 @@ class canlib(object):
     #AttrDict = {  NC_ATTR_BAUD_RATE:1000000,NC_ATTR_START_ON_OPEN: NC_FALSE }
 
 
-    def __init__(self, debug=None):
+    def __init__(self, debug=None, dll=None):
+        '''
+        :param debug: log at DEBUG level
+        :param dll  : path of a library to load instead of nican,
+                      e.g. a stub exporting the same functions for benchmarks
+        '''
         fmt = '[%(levelname)s] %(funcName)s: %(message)s'
         if debug:
             logging.basicConfig(stream=sys.stderr,
@@ -329,7 +361,9 @@ class canlib(object):
                                 level=logging.ERROR,
                                 format=fmt)
         
-        if sys.platform.startswith('win'):
+        if dll is not None:
+            self.dll = CDLL(dll)
+        elif sys.platform.startswith('win'):
             try:
                 self.dll = WinDLL('nican')
             except Exception as ex:
@@ -378,12 +412,12 @@ class canlib(object):
         self.dll.ncRead.errcheck = self._canErrorCheck
 
         self.dll.ncWaitForState.argtypes = (c_ulong,c_ulong,c_ulong,POINTER(c_ulong))
-        self.dll.ncRead.restype = c_int32
-        self.dll.ncRead.errcheck = self._canErrorCheck
+        self.dll.ncWaitForState.restype = c_int32
+        self.dll.ncWaitForState.errcheck = self._canErrorCheck
 
         self.dll.ncReadMult.argtypes = (c_ulong,c_ulong, POINTER(None), POINTER(c_ulong))
-        self.dll.ncRead.restype = c_int32
-        self.dll.ncRead.errcheck = self._canErrorCheck
+        self.dll.ncReadMult.restype = c_int32
+        self.dll.ncReadMult.errcheck = self._canErrorCheck
 
 
 
@@ -392,6 +426,8 @@ class canlib(object):
         if result == 0: #OK
             status += "OK Status:" + str(result )
             logging.debug(status)
+        elif result == CanErrFunctionTimeout:
+            raise canNoMsg(self, result)
         elif result < 0: #ERROR
             raise canError(self, result)
         elif result > 0:  # Warning
@@ -553,14 +589,19 @@ class canChannel(object):
         self.dll.ncWrite(self.aCanObjHandle.contents, sizeof(frame), byref(frame))
 
 
-    def read (self):
+    def read (self, timeout=None):
         ''' ---- direct call func from Nican.dll --------------
         ~~~~~~~~~~~~~~~~~~C API~~~~~~~~~~~~~~~
         NCTYPE_STATUS ncRead(
                         NCTYPE_OBJH ObjHandle,
                         NCTYPE_UINT32 DataSize,
                         NCTYPE_ANY_P DataPtr);
+
+        :param timeout: if given, wait up to timeout [ms] for a frame
+                        and raise canNoMsg if none arrived
         '''      
+        if timeout is not None:
+            self.waitForState(NC_ST_READ_AVAIL, timeout)
         canStruct =  NCTYPE_CAN_STRUCT()
         self.dll.ncRead(self.aCanObjHandle.contents, CAN_STRUCT_SIZE, byref (canStruct))
         data = [ d for d in canStruct.Data]
@@ -569,7 +610,22 @@ class canChannel(object):
         return canStruct.ArbitrationId,data[:canStruct.DataLength],canStruct.DataLength
    
 
-    def waitForState(self,canState):
+    def readSpecific(self, id, timeout=0):
+        '''Waits up to timeout [ms] for a frame with the specified identifier.
+        Frames with other identifiers received meanwhile are discarded.
+        The wait is done by ncWaitForState, so the call returns as soon as the
+        frame arrives; the timeout is a deadline over all discarded frames.
+        Returns the frame in the format of read(), raises canNoMsg on timeout'''
+        deadline = time.monotonic() + timeout/1000.0
+        while True:
+            remaining = int(math.ceil((deadline - time.monotonic())*1000))
+            if remaining <= 0:
+                raise canNoMsg(self.canlib, CanErrFunctionTimeout)
+            frame = self.read(remaining)
+            if frame[0] == id:
+                return frame
+
+    def waitForState(self,canState,timeout=NC_DURATION_1SEC):
         '''---- direct call func from Nican.dll --------------
         ~~~~~~~~~~~~~~~~~~C API~~~~~~~~~~~~~~~
         NCTYPE_STATUS ncWaitForState(
@@ -577,11 +633,12 @@ class canChannel(object):
                     NCTYPE_STATE DesiredState,
                     NCTYPE_UINT32 Timeout,
                     NCTYPE_STATE_P StatePtr);
+        raises canNoMsg if the state did not occur within timeout [ms]
         '''
         #res_type = c_uint
         #statePtr = res_type()
         statePtr = c_ulong()
-        self.dll.ncWaitForState(self.aCanObjHandle.contents,canState,NC_DURATION_1SEC,byref(statePtr))
+        self.dll.ncWaitForState(self.aCanObjHandle.contents,canState,timeout,byref(statePtr))
         return statePtr
 
 
@@ -596,13 +653,41 @@ class canChannel(object):
         canStructArr_Type =  NCTYPE_CAN_STRUCT*BUFF
         canStructArr = canStructArr_Type()
         ActualDataSize =  c_ulong()
-        self.dll.ncReadMult(self.aCanObjHandle.contents,CAN_STRUCT_SIZE*BUFF,byref(canStructArr),byref(ActualDataSize)) #sizeof( NCTYPE_CAN_STRUCT())
+        self.dll.ncReadMult(self.aCanObjHandle.contents,sizeof(canStructArr),byref(canStructArr),byref(ActualDataSize))
 
-        dataSize = ActualDataSize/CAN_STRUCT_SIZE
+        dataSize = ActualDataSize.value//sizeof(NCTYPE_CAN_STRUCT)
 
-        data = [(frame.ArbitrationId,frame.DataLength,data[:frame.DataLength])  for frame in canStructArr[i] for i  in  range( dataSize )]
+        data = [(frame.ArbitrationId,frame.DataLength,list(frame.Data)[:frame.DataLength])  for frame in canStructArr[:dataSize]]
         return data
 
+    def read_many(self, max_frames=BUFF, timeout=0):
+        '''Drains the read queue with a single ncReadMult.
+        Waits up to timeout [ms] for the first frame if the queue is empty.
+        Returns a NumPy structured array of common.canFrameDtype with the fields
+        timestamp, id, flags, dlc, data[8], the same records the other drivers
+        return: the id without NC_FL_CAN_ARBID_XTD, canlib.canMSG_xxx flags
+        and data beyond dlc zeroed.
+        '''
+        if np is None:
+            raise ImportError('read_many requires numpy')
+        canStructArr = (NCTYPE_CAN_STRUCT*max_frames)()
+        if timeout:
+            try:
+                self.waitForState(NC_ST_READ_AVAIL, timeout)
+            except canNoMsg:
+                return np.zeros(0, dtype=canFrameDtype)
+        ActualDataSize =  c_ulong()
+        self.dll.ncReadMult(self.aCanObjHandle.contents,sizeof(canStructArr),byref(canStructArr),byref(ActualDataSize))
+        raw = np.frombuffer(canStructArr, dtype=_ncFrameDtype, count=ActualDataSize.value//sizeof(NCTYPE_CAN_STRUCT))
+        frames = np.zeros(len(raw), dtype=canFrameDtype)
+        frames['timestamp'] = raw['timestamp']
+        frames['id'] = raw['id'] & 0x1FFFFFFF           # 29 bit identifier without NC_FL_CAN_ARBID_XTD
+        frames['flags'] = (np.where(raw['id'] & NC_FL_CAN_ARBID_XTD, canMSG_EXT, canMSG_STD) |
+                           np.where(raw['flags'] == NC_FRMTYPE_REMOTE, canMSG_RTR, 0))
+        frames['dlc'] = raw['dlc']
+        frames['data'] = np.where(np.arange(8) < raw['dlc'][:, None], raw['data'], 0)
+        return frames
+
     #def createNotificationForReadMult(self,RefData):
     #    ''' ---- direct call func from Nican.dll --------------
     #    ~~~~~~~~~~~~~~~~~~C API~~~~~~~~~~~~~~~
@@ -694,7 +779,10 @@ if __name__=='__main__':
     #ch.filter(0X5)
     while True:
         
-        ch.waitForState(NC_ST_READ_AVAIL)
+        try:
+            ch.waitForState(NC_ST_READ_AVAIL)
+        except canNoMsg:
+            continue
         res = ch.read()
         if ch.isExtended(res[0]):
             print('X')
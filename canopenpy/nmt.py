@@ -0,0 +1,272 @@
+'''
+NMT Master and Heartbeat Monitor
+--------------------------------
+
+NmtMonitor consumes the heartbeat messages (700h + Node ID) of all
+nodes and sends the NMT module control commands (COB-ID 0)::
+
+    monitor = NmtMonitor(canopen)
+    monitor.supervise(range(1, 101), timeout=0.3)
+    monitor.addCallback(onEvent)
+    monitor.start()
+    monitor.startRemoteNode()          # all nodes operational
+    ...
+    if monitor.states[5] != NMT_OPERATIONAL: ...
+
+The last state and the last time a heartbeat was seen are kept in two
+flat 128 entry lists indexed by Node ID, so a heartbeat costs one
+table index and two stores.  Timeouts are detected by one timer wheel:
+every supervised node sits in the slot of its expected expiry.  A
+heartbeat does not touch the wheel; when the slot comes up the node is
+either reported as lost or moved to the slot of its new expiry, so a
+node costs at most one wheel operation per heartbeat consumer time.
+'''
+import time
+import threading
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger(__name__)
+
+NMT_COB_ID = 0x000
+HEARTBEAT_COB_ID = 0x700
+NODES = 128
+
+# heartbeat states
+NMT_BOOTUP = 0x00
+NMT_STOPPED = 0x04
+NMT_OPERATIONAL = 0x05
+NMT_PRE_OPERATIONAL = 0x7F
+NmtStates = {NMT_BOOTUP: 'boot-up', NMT_STOPPED: 'stopped',
+             NMT_OPERATIONAL: 'operational', NMT_PRE_OPERATIONAL: 'pre-operational'}
+
+# module control command specifiers
+NMT_CS_START = 0x01
+NMT_CS_STOP = 0x02
+NMT_CS_PRE_OPERATIONAL = 0x80
+NMT_CS_RESET_NODE = 0x81
+NMT_CS_RESET_COMMUNICATION = 0x82
+
+# events passed to the callbacks
+EVENT_BOOTUP = 'bootup'
+EVENT_STATE = 'state'
+EVENT_TIMEOUT = 'timeout'
+EVENT_RECOVERED = 'recovered'
+
+
+class NmtMonitor(object):
+    ''' Heartbeat consumer and NMT master
+    '''
+
+    def __init__(self, canopen, tick=0.01, slots=256):
+        ''' Initialize the monitor
+
+        :param canopen: CanOpen object, its dispatcher delivers the heartbeats
+        :param tick: resolution of the timeout detection [sec]
+        :param slots: number of timer wheel slots; timeouts longer than
+                      slots * tick are checked again after one turn
+        '''
+        self.canopen = canopen
+        self.tick = tick
+        # indexed by Node ID, index 0 unused
+        self.states = [None] * NODES
+        self.lastSeen = [0.0] * NODES
+        self.timeouts = [0.0] * NODES
+        self.lost = [False] * NODES
+        self.scheduled = [False] * NODES
+        self.wheel = [[] for i in range(slots)]
+        self.cursor = 0
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopEvent = threading.Event()
+        self.running = False
+
+    #-----------------------------------------------------------------------#
+    # Supervision
+    #-----------------------------------------------------------------------#
+    def supervise(self, nodeIds, timeout):
+        ''' Supervise the heartbeat of nodes (consumer heartbeat time)
+
+        The timeout starts now, so a node that never sends a heartbeat is
+        reported once timeout has elapsed.
+
+        :param nodeIds: Node ID or iterable of Node IDs [1,127]
+        :param timeout: heartbeat consumer time [sec], 0 to stop supervising
+        '''
+        if isinstance(nodeIds, int):
+            nodeIds = (nodeIds,)
+        now = time.monotonic()
+        with self.lock:
+            for nodeId in nodeIds:
+                if not 1 <= nodeId < NODES:
+                    logging.error('Node ID %d out of range [1,127]' % nodeId)
+                    raise Exception('Node ID %d out of range [1,127]' % nodeId)
+                self.timeouts[nodeId] = timeout
+                self.lost[nodeId] = False
+                if self.states[nodeId] is None:
+                    self.lastSeen[nodeId] = now
+                if timeout > 0 and not self.scheduled[nodeId]:
+                    self._schedule(nodeId, self.lastSeen[nodeId] + timeout - now)
+
+    def _schedule(self, nodeId, delay):
+        # with self.lock held
+        ticks = max(1, min(int(delay / self.tick) + 1, len(self.wheel) - 1))
+        self.scheduled[nodeId] = True
+        self.wheel[(self.cursor + ticks) % len(self.wheel)].append(nodeId)
+
+    def _advance(self, now):
+        # one tick of the wheel, returns the events to report
+        events = []
+        with self.lock:
+            self.cursor = (self.cursor + 1) % len(self.wheel)
+            slot = self.wheel[self.cursor]
+            if not slot:
+                return events
+            self.wheel[self.cursor] = []
+            for nodeId in slot:
+                self.scheduled[nodeId] = False
+                timeout = self.timeouts[nodeId]
+                if timeout <= 0:
+                    # no longer supervised
+                    continue
+                remaining = self.lastSeen[nodeId] + timeout - now
+                if remaining > 0:
+                    self._schedule(nodeId, remaining)
+                    continue
+                if not self.lost[nodeId]:
+                    self.lost[nodeId] = True
+                    events.append((nodeId, EVENT_TIMEOUT, self.states[nodeId]))
+                # checked again every timeout until the node is back
+                self._schedule(nodeId, timeout)
+        return events
+
+    #-----------------------------------------------------------------------#
+    # Heartbeat consumer
+    #-----------------------------------------------------------------------#
+    def receive(self, frame):
+        ''' Dispatcher callback for 701h to 77Fh '''
+        nodeId = frame[0] - HEARTBEAT_COB_ID
+        state = frame[1][0] & 0x7F
+        # against _advance, which could else mark the node lost from the
+        # lastSeen before this heartbeat
+        with self.lock:
+            self.lastSeen[nodeId] = time.monotonic()
+            old = self.states[nodeId]
+            self.states[nodeId] = state
+            recovered = self.lost[nodeId]
+            self.lost[nodeId] = False
+        if recovered:
+            self._notify(nodeId, EVENT_RECOVERED, state)
+        if state != old:
+            self._notify(nodeId, EVENT_BOOTUP if state == NMT_BOOTUP else EVENT_STATE, state)
+
+    def addCallback(self, callback):
+        ''' Call callback(nodeId, event, state) on every EVENT_xxx
+
+        Heartbeat events are reported from the dispatcher thread, timeouts
+        from the monitor thread.
+        '''
+        with self.lock:
+            self.callbacks = self.callbacks + [callback]
+
+    def removeCallback(self, callback):
+        with self.lock:
+            self.callbacks = [cb for cb in self.callbacks if cb is not callback]
+
+    def _notify(self, nodeId, event, state):
+        for callback in self.callbacks:
+            try:
+                callback(nodeId, event, state)
+            except Exception as ex:
+                _logger.error('NMT callback for node %d failed: %s' % (nodeId, ex))
+
+    def isAlive(self, nodeId):
+        ''' True if the node sent a heartbeat and did not time out '''
+        return self.states[nodeId] is not None and not self.lost[nodeId]
+
+    def nodes(self):
+        ''' {Node ID: state} of all nodes seen so far '''
+        return dict((nodeId, state) for nodeId, state in enumerate(self.states) if state is not None)
+
+    #-----------------------------------------------------------------------#
+    # Monitor thread
+    #-----------------------------------------------------------------------#
+    def start(self):
+        ''' Start consuming heartbeats, the dispatcher of canopen is started if needed
+        '''
+        if self.thread is not None:
+            return
+        dispatcher = self.canopen.startDispatcher()
+        dispatcher.addCallback(range(HEARTBEAT_COB_ID + 1, HEARTBEAT_COB_ID + NODES), self.receive)
+        self.running = True
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self._run, name='NmtMonitor')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        if self.canopen.dispatcher is not None:
+            self.canopen.dispatcher.removeCallback(range(HEARTBEAT_COB_ID + 1, HEARTBEAT_COB_ID + NODES),
+                                                   self.receive)
+        self.stopEvent.set()
+        self.thread.join()
+        self.thread = None
+        self.running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, klass, value, traceback):
+        self.stop()
+
+    def _run(self):
+        deadline = time.monotonic() + self.tick
+        while not self.stopEvent.wait(max(deadline - time.monotonic(), 0)):
+            now = time.monotonic()
+            # catch up on ticks lost to a busy interpreter
+            while deadline <= now:
+                for event in self._advance(now):
+                    self._notify(*event)
+                deadline += self.tick
+
+    #-----------------------------------------------------------------------#
+    # NMT master
+    #-----------------------------------------------------------------------#
+    def command(self, cs, nodeId=0):
+        ''' Send an NMT module control command
+
+        :param cs: NMT_CS_xxx command specifier
+        :param nodeId: Node ID, 0 addresses all nodes with one frame
+        '''
+        self.canopen.writeCanMessage(NMT_COB_ID, bytes((cs, nodeId)))
+
+    def startRemoteNode(self, nodeId=0):
+        self.command(NMT_CS_START, nodeId)
+
+    def stopRemoteNode(self, nodeId=0):
+        self.command(NMT_CS_STOP, nodeId)
+
+    def enterPreOperational(self, nodeId=0):
+        self.command(NMT_CS_PRE_OPERATIONAL, nodeId)
+
+    def resetNode(self, nodeId=0):
+        self.command(NMT_CS_RESET_NODE, nodeId)
+
+    def resetCommunication(self, nodeId=0):
+        self.command(NMT_CS_RESET_COMMUNICATION, nodeId)
+
+
+#---------------------------------------------------------------------------#
+# Exported symbols
+#---------------------------------------------------------------------------#
+__all__ = ['NmtMonitor', 'NmtStates',
+           'NMT_BOOTUP', 'NMT_STOPPED', 'NMT_OPERATIONAL', 'NMT_PRE_OPERATIONAL',
+           'NMT_CS_START', 'NMT_CS_STOP', 'NMT_CS_PRE_OPERATIONAL',
+           'NMT_CS_RESET_NODE', 'NMT_CS_RESET_COMMUNICATION',
+           'EVENT_BOOTUP', 'EVENT_STATE', 'EVENT_TIMEOUT', 'EVENT_RECOVERED']
@@ -0,0 +1,389 @@
+'''
+Object Dictionary
+-----------------
+
+Reads the object dictionary of a device from its EDS or DCF file (CiA 306)
+into typed entries::
+
+    od = loadObjectDictionary('drive.eds')
+    entry = od['Identity object.Serial number']
+    entry.index, entry.subindex, entry.Type, entry.access, entry.pdoMapping
+
+Variables are named by their ParameterName, sub-indices of arrays and
+records by 'Object name.Sub-index name'.  Entries are also found by
+index, (index, subindex) or hexadecimal text such as '1018sub4'.
+
+Parsing an EDS of some thousand entries takes a noticeable time at every
+start, so the compiled dictionary is pickled to a cache directory keyed
+by the SHA-1 of the file; the next load of an unchanged file only reads
+the pickle.  Loading a pickle runs code, so the cache lives in a private
+per-user directory and is ignored if anybody else could write to it.
+
+Once a dictionary is attached to a CanOpen object the SDO and PDO
+functions accept names or entries in place of index, subindex and type::
+
+    canopen.addObjectDictionary(od)
+    serial = canopen.SDOUpload(3, 'Identity object.Serial number')
+'''
+import os
+import re
+import pickle
+import hashlib
+import collections
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger(__name__)
+
+# bumped whenever the pickled form changes
+CACHE_VERSION = 1
+
+# object types
+OD_VAR = 0x7
+OD_ARRAY = 0x8
+OD_RECORD = 0x9
+
+# CiA 301 data types, as the type names used by the SDO and PDO functions
+DataTypes = {
+    0x01: 'boolean',
+    0x02: 'integer8',
+    0x03: 'integer16',
+    0x04: 'integer32',
+    0x05: 'unsigned8',
+    0x06: 'unsigned16',
+    0x07: 'unsigned32',
+    0x08: 'real32',
+    0x09: 'vis string',
+    0x0A: 'octet string',
+    0x0B: 'unicode string',
+    0x0F: 'domain',
+    0x11: 'real64',
+    0x15: 'integer64',
+    0x1B: 'unsigned64',
+}
+# bits of the fixed size types, as mapped into a PDO
+DataTypeBits = {0x01: 1, 0x02: 8, 0x03: 16, 0x04: 32, 0x05: 8, 0x06: 16, 0x07: 32,
+                0x08: 32, 0x11: 64, 0x15: 64, 0x1B: 64}
+# types transferred as one of the TypeLength types by SDOUpload / SDODownload
+SdoTypes = {'boolean': 'unsigned8', 'octet string': 'vis string',
+            'unicode string': 'vis string', 'domain': 'vis string'}
+
+
+#---------------------------------------------------------------------------#
+# Entries
+#---------------------------------------------------------------------------#
+class OdEntry(collections.namedtuple('OdEntry', 'index subindex name dataType access '
+                                     'pdoMapping default low high value')):
+    ''' One sub-index of the object dictionary
+
+    default, low, high and value (the ParameterValue of a DCF) are int,
+    float or str as written in the file; a value relative to the Node ID
+    ('$NODEID+0x180') stays str, see evaluate.
+    '''
+    __slots__ = ()
+
+    @property
+    def Type(self):
+        ''' Type name, 'domain' for an unknown data type '''
+        return DataTypes.get(self.dataType, 'domain')
+
+    @property
+    def sdoType(self):
+        ''' Type passed to SDOUpload / SDODownload '''
+        return SdoTypes.get(self.Type, self.Type)
+
+    @property
+    def bits(self):
+        ''' Length when mapped into a PDO, None for a variable length type '''
+        return DataTypeBits.get(self.dataType)
+
+    @property
+    def readable(self):
+        return self.access != 'wo'
+
+    @property
+    def writable(self):
+        return self.access not in ('ro', 'const')
+
+
+def evaluate(value, nodeId=None):
+    ''' Value of an entry field, '$NODEID+...' evaluated for nodeId '''
+    if not isinstance(value, str) or '$NODEID' not in value.upper():
+        return value
+    if nodeId is None:
+        logging.error('Value %s depends on the Node ID' % value)
+        raise Exception('Value %s depends on the Node ID' % value)
+    # a sum of terms, e.g. '$NODEID+0x180'
+    return sum(nodeId if term.strip().upper() == '$NODEID' else _number(term)
+               for term in value.split('+'))
+
+
+def _number(text):
+    text = text.strip().lstrip('+')
+    if text.lower().startswith('0x'):
+        return int(text, 16)
+    if text.lower().startswith('-0x'):
+        return -int(text[1:], 16)
+    return int(text, 10)
+
+
+def _value(text, dataType):
+    # field of the file as int / float / str, None if empty
+    text = text.strip()
+    if not text:
+        return None
+    if dataType in (0x09, 0x0A, 0x0B, 0x0F) or '$NODEID' in text.upper():
+        return text
+    try:
+        if dataType in (0x08, 0x11):
+            return float(text)
+        return _number(text)
+    except ValueError:
+        return text
+
+
+#---------------------------------------------------------------------------#
+# Dictionary
+#---------------------------------------------------------------------------#
+class ObjectDictionary(object):
+    ''' Entries of one device type, by (index, subindex) and by name
+    '''
+
+    def __init__(self, entries=(), nodeId=None, fileName=None):
+        ''' Initialize the dictionary
+
+        :param entries: iterable of OdEntry
+        :param nodeId: Node ID of a DCF, None for an EDS
+        :param fileName: file the entries were read from
+        '''
+        self.entries = {}
+        self.names = {}
+        self.objectNames = {}
+        self.nodeId = nodeId
+        self.fileName = fileName
+        for entry in entries:
+            self.add(entry)
+
+    def add(self, entry, objectName=None):
+        ''' Add an entry
+
+        :param objectName: name of the array or record entry belongs to,
+                           its name is then objectName.entry.name
+        '''
+        self.entries[(entry.index, entry.subindex)] = entry
+        if objectName is not None and entry.index not in self.objectNames:
+            self.objectNames[entry.index] = objectName
+            # the object name alone stands for its first sub-index
+            self.names.setdefault(objectName, entry)
+            self.names.setdefault(objectName.lower(), entry)
+        objectName = self.objectNames.get(entry.index)
+        name = entry.name if objectName is None else objectName + '.' + entry.name
+        self.names.setdefault(name, entry)
+        self.names.setdefault(name.lower(), entry)
+
+    def __getitem__(self, key):
+        ''' Entry by name, OdEntry, index, (index, subindex) or text 'iiii[sub<s>]'
+        '''
+        entry = self.get(key)
+        if entry is None:
+            logging.error('Object %r not in the object dictionary' % (key,))
+            raise KeyError(key)
+        return entry
+
+    def get(self, key, default=None):
+        if isinstance(key, OdEntry):
+            return key
+        if isinstance(key, tuple):
+            return self.entries.get(key, default)
+        if isinstance(key, int):
+            return self.entries.get((key, 0), default)
+        entry = self.names.get(key)
+        if entry is None:
+            entry = self.names.get(key.lower())
+        if entry is None:
+            match = re.match(r'^(?:0x)?([0-9a-fA-F]{1,4})(?:sub([0-9a-fA-F]{1,2}))?$', key)
+            if match:
+                entry = self.entries.get((int(match.group(1), 16), int(match.group(2) or '0', 16)))
+        return default if entry is None else entry
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __iter__(self):
+        return iter(sorted(self.entries.values()))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def object(self, index):
+        ''' All sub-indices of an object, by subindex '''
+        return [entry for key, entry in sorted(self.entries.items()) if key[0] == index]
+
+    def objectName(self, index):
+        ''' Name of an array or record, of the variable for any other index '''
+        name = self.objectNames.get(index)
+        if name is None and (index, 0) in self.entries:
+            name = self.entries[(index, 0)].name
+        return name
+
+
+#---------------------------------------------------------------------------#
+# EDS / DCF parser
+#---------------------------------------------------------------------------#
+_sectionRe = re.compile(r'^([0-9a-fA-F]{4})(?:sub([0-9a-fA-F]{1,2}))?$')
+
+
+def _sections(text):
+    # {section name: {key (lower case): value}} of an INI text
+    sections = {}
+    current = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line[0] in ';#':
+            continue
+        if line[0] == '[' and line[-1] == ']':
+            current = sections.setdefault(line[1:-1].strip(), {})
+            continue
+        if current is None or '=' not in line:
+            continue
+        key, value = line.split('=', 1)
+        current[key.strip().lower()] = value.strip()
+    return sections
+
+
+def _entry(index, subindex, fields, dataType=None):
+    if dataType is None:
+        dataType = _number(fields.get('datatype', '0x0007'))
+    return OdEntry(index, subindex,
+                   fields.get('parametername', '%04Xsub%X' % (index, subindex)),
+                   dataType,
+                   fields.get('accesstype', 'rw').lower(),
+                   fields.get('pdomapping', '0').strip() not in ('0', ''),
+                   _value(fields.get('defaultvalue', ''), dataType),
+                   _value(fields.get('lowlimit', ''), dataType),
+                   _value(fields.get('highlimit', ''), dataType),
+                   _value(fields.get('parametervalue', ''), dataType))
+
+
+def parseEds(text, fileName=None):
+    ''' Build the dictionary of an EDS or DCF text
+
+    :returns: ObjectDictionary
+    '''
+    sections = _sections(text)
+    objects = {}
+    subs = collections.defaultdict(dict)
+    for name, fields in sections.items():
+        match = _sectionRe.match(name)
+        if not match:
+            continue
+        index = int(match.group(1), 16)
+        if match.group(2) is None:
+            objects[index] = fields
+        else:
+            subs[index][int(match.group(2), 16)] = fields
+
+    nodeId = None
+    commissioning = sections.get('DeviceComissioning') or sections.get('DeviceCommissioning')
+    if commissioning and commissioning.get('nodeid'):
+        nodeId = _number(commissioning['nodeid'])
+
+    od = ObjectDictionary(nodeId=nodeId, fileName=fileName)
+    for index in sorted(objects):
+        fields = objects[index]
+        objectType = _number(fields.get('objecttype', '0x7'))
+        if objectType not in (OD_ARRAY, OD_RECORD):
+            od.add(_entry(index, 0, fields))
+            continue
+        name = fields.get('parametername', '%04X' % index)
+        compact = _number(fields.get('compactsubobj', '0') or '0')
+        if compact:
+            # the sub-indices are not listed, all of them have the object's type
+            od.add(OdEntry(index, 0, 'Number of entries', 0x05, 'ro', False, compact, None, None, None), name)
+            dataType = _number(fields.get('datatype', '0x0007'))
+            for subindex in range(1, compact + 1):
+                sub = dict(fields)
+                sub['parametername'] = '%d' % subindex
+                od.add(_entry(index, subindex, sub, dataType), name)
+            continue
+        for subindex in sorted(subs[index]):
+            od.add(_entry(index, subindex, subs[index][subindex]), name)
+    return od
+
+
+#---------------------------------------------------------------------------#
+# Compiled cache
+#---------------------------------------------------------------------------#
+def defaultCacheDir():
+    ''' Per-user cache directory, %LOCALAPPDATA%\\canopenpy\\od on Windows,
+    $XDG_CACHE_HOME/canopenpy/od or ~/.cache/canopenpy/od elsewhere
+    '''
+    base = os.environ.get('LOCALAPPDATA') if os.name == 'nt' else None
+    base = base or os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'canopenpy', 'od')
+
+
+def _private(st):
+    # owned by the current user and not writable by group or others
+    if not hasattr(os, 'getuid'):
+        return True
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+def _privateDir(path):
+    # create the cache directory 0700, False if it is not safe to use
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        if _private(os.stat(path)):
+            return True
+    except OSError as ex:
+        _logger.warning('Object dictionary cache %s not usable: %s' % (path, ex))
+        return False
+    _logger.warning('Object dictionary cache %s ignored, it is not private to the user' % path)
+    return False
+
+
+def loadObjectDictionary(fileName, cacheDir=None):
+    ''' Read an EDS / DCF file, from the compiled cache if it is unchanged
+
+    :param cacheDir: directory of the compiled dictionaries, defaultCacheDir()
+                     if None, False to always parse.  It must belong to the
+                     user and not be writable by others, else it is not used
+    :returns: ObjectDictionary
+    '''
+    with open(fileName, 'rb') as f:
+        raw = f.read()
+    path = None
+    cacheDir = defaultCacheDir() if cacheDir is None else cacheDir
+    if cacheDir is not False and _privateDir(cacheDir):
+        key = hashlib.sha1(raw).hexdigest()
+        # the pickle refers to OdEntry by module name
+        path = os.path.join(cacheDir, '%s-%s-%d.pickle' % (key, __name__, CACHE_VERSION))
+        try:
+            with open(path, 'rb') as f:
+                if not _private(os.fstat(f.fileno())):
+                    raise ValueError('not private')
+                od = ObjectDictionary(fileName=fileName)
+                od.nodeId, od.entries, od.names, od.objectNames = pickle.load(f)
+            return od
+        except (OSError, EOFError, ValueError, AttributeError, ImportError, pickle.UnpicklingError):
+            pass
+
+    od = parseEds(raw.decode('latin-1'), fileName)
+    if path is not None:
+        try:
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+                pickle.dump((od.nodeId, od.entries, od.names, od.objectNames), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except OSError as ex:
+            _logger.warning('Object dictionary cache not written: %s' % ex)
+    return od
+
+
+#---------------------------------------------------------------------------#
+# Exported symbols
+#---------------------------------------------------------------------------#
+__all__ = ['ObjectDictionary', 'OdEntry', 'DataTypes', 'loadObjectDictionary', 'parseEds', 'evaluate']
@@ -0,0 +1,411 @@
+'''
+Process Data Objects
+--------------------
+
+A PDO mapping (1600h/1A00h + PDO number - 1) lists the objects a PDO
+carries as index(16) : sub-index(8) : length(8) entries.  Every mapping is
+compiled once into a struct.Struct, so decoding a received TPDO is a
+single unpack_from whose values are stored into the process image with a
+single slice assignment, however many objects the PDO carries::
+
+    image = ProcessImage()
+    consumer = TpdoConsumer(canopen, image)
+    consumer.readMapping(1, 1, types={(0x6064, 0): 'integer32'})
+    consumer.start()
+    ...
+    position = image[1, 0x6064, 0]
+
+The other way round RpdoProducer packs the process image into
+preallocated frames and transmits them every period::
+
+    producer = RpdoProducer(canopen, image, period=0.002)
+    producer.readMapping(1, 1, types={(0x607A, 0): 'integer32'})
+    producer.start()
+    image[1, 0x607A, 0] = target
+
+Entries must be 8, 16, 32 or 64 bits wide; dummy entries (index below
+1000h) are skipped as padding.
+'''
+import time
+import struct
+import threading
+from canopenpy import TypeLength
+from objectdictionary import OdEntry
+from periodic import PeriodicProducer
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger(__name__)
+
+# unsigned default by length [bits]
+PdoUnsigned = {8: 'B', 16: 'H', 32: 'L', 64: 'Q'}
+
+
+def pdoFormat(entries, types=None):
+    ''' Build the struct format of a mapping
+
+    :param entries: list of (index, subindex, bits)
+    :param types: {(index, subindex): type}, type a TypeLength name or a
+                  struct code; unsigned if not given
+    :returns: (format, keys) keys being the (index, subindex) of every value
+    '''
+    types = types or {}
+    fmt = '<'
+    keys = []
+    for index, subindex, bits in entries:
+        if bits % 8 or bits == 0:
+            raise Exception('PDO entry 0x%04x:%d of %d bits is not byte aligned' % (index, subindex, bits))
+        if index < 0x1000:
+            # dummy entry
+            fmt += '%dx' % (bits // 8)
+            continue
+        Type = types.get((index, subindex))
+        if Type is None:
+            if bits not in PdoUnsigned:
+                raise Exception('PDO entry 0x%04x:%d of %d bits needs a type' % (index, subindex, bits))
+            code = PdoUnsigned[bits]
+        elif Type.lower() in TypeLength:
+            code = TypeLength[Type.lower()][2].lstrip('<')
+        else:
+            code = Type
+        if struct.calcsize('<' + code) * 8 != bits:
+            raise Exception('PDO entry 0x%04x:%d: type %s does not have %d bits' % (index, subindex, Type, bits))
+        fmt += code
+        keys.append((index, subindex))
+    if struct.calcsize(fmt) > 8:
+        raise Exception('PDO mapping longer than 8 bytes')
+    return fmt, keys
+
+
+def resolveEntries(od, entries, types=None):
+    ''' Mapping entries given by name or OdEntry as (index, subindex, bits)
+
+    The types of entries found in the object dictionary are added to types
+    unless given there.
+
+    :param od: ObjectDictionary of the node, None if there is none
+    :param entries: list of (index, subindex, bits), names or OdEntry
+    :returns: (entries, types)
+    '''
+    types = dict(types or {})
+    resolved = []
+    for item in entries:
+        if isinstance(item, tuple) and not isinstance(item, OdEntry):
+            index, subindex, bits = item
+            entry = od.get((index, subindex)) if od is not None and index >= 0x1000 else None
+        else:
+            if od is None and not isinstance(item, OdEntry):
+                raise Exception('No object dictionary to resolve PDO entry %r' % (item,))
+            entry = od[item] if od is not None else item
+            index, subindex, bits = entry.index, entry.subindex, entry.bits
+            if bits is None:
+                raise Exception('PDO entry %s has no fixed length' % entry.name)
+        if entry is not None and entry.bits == bits and (index, subindex) not in types \
+                and entry.Type in TypeLength:
+            types[(index, subindex)] = entry.Type
+        resolved.append((index, subindex, bits))
+    return resolved, types
+
+
+#---------------------------------------------------------------------------#
+# Process image
+#---------------------------------------------------------------------------#
+class ProcessImage(object):
+    ''' Flat list of the mapped values of all nodes
+
+    Every PDO owns a contiguous range of slots, so it is read or written
+    with one slice.  Values are addressed by (node, index, subindex).
+    '''
+
+    def __init__(self):
+        self.values = []
+        self.slots = {}
+
+    def allocate(self, nodeId, keys):
+        ''' Reserve slots for the values of one PDO
+
+        :param keys: list of (index, subindex)
+        :returns: first slot
+        '''
+        start = len(self.values)
+        self.values.extend([0] * len(keys))
+        for i, (index, subindex) in enumerate(keys):
+            self.slots[(nodeId, index, subindex)] = start + i
+        return start
+
+    def slot(self, nodeId, index, subindex):
+        return self.slots[(nodeId, index, subindex)]
+
+    def __getitem__(self, key):
+        return self.values[self.slots[key]]
+
+    def __setitem__(self, key, value):
+        self.values[self.slots[key]] = value
+
+    def __contains__(self, key):
+        return key in self.slots
+
+
+#---------------------------------------------------------------------------#
+# PDO
+#---------------------------------------------------------------------------#
+class Pdo(object):
+    ''' One PDO compiled against a process image
+    '''
+
+    def __init__(self, image, nodeId, cobId, entries, types=None):
+        ''' Compile the mapping
+
+        :param image: ProcessImage holding the values
+        :param nodeId: Node ID, part of the process image key
+        :param cobId: COB-ID of the PDO
+        :param entries: list of (index, subindex, bits)
+        :param types: see pdoFormat
+        '''
+        fmt, keys = pdoFormat(entries, types)
+        self.image = image
+        self.nodeId = nodeId
+        self.cobId = cobId
+        self.entries = list(entries)
+        self.keys = keys
+        self.struct = struct.Struct(fmt)
+        self.start = image.allocate(nodeId, keys)
+        self.stop = self.start + len(keys)
+        self.count = 0
+        self.errors = 0
+        self.timestamp = None
+        self.callbacks = ()
+        # transmit side
+        self.buffer = bytearray(self.struct.size)
+        self.inhibit = 0.0
+        self.lastSent = None
+        self.inhibited = 0
+
+    def decode(self, data):
+        ''' Store the values of a received frame into the process image
+        '''
+        self.image.values[self.start:self.stop] = self.struct.unpack_from(data)
+
+    def encode(self):
+        ''' Pack the values of the process image into the frame buffer
+
+        :returns: the buffer, reused by the next encode
+        '''
+        self.struct.pack_into(self.buffer, 0, *self.image.values[self.start:self.stop])
+        return self.buffer
+
+    def receive(self, frame):
+        ''' Dispatcher callback '''
+        try:
+            self.image.values[self.start:self.stop] = self.struct.unpack_from(frame[1])
+        except struct.error:
+            # frame shorter than the mapping
+            self.errors += 1
+            return
+        self.count += 1
+        if len(frame) > 4:
+            self.timestamp = frame[4]
+        for callback in self.callbacks:
+            callback(self)
+
+    def values(self):
+        ''' Current values as {(index, subindex): value} '''
+        return dict(zip(self.keys, self.image.values[self.start:self.stop]))
+
+
+#---------------------------------------------------------------------------#
+# TPDO consumer
+#---------------------------------------------------------------------------#
+class TpdoConsumer(object):
+    ''' Decodes the TPDOs of any number of nodes into a process image
+    '''
+
+    def __init__(self, canopen, image=None):
+        ''' Initialize the consumer
+
+        :param canopen: CanOpen object, its dispatcher delivers the frames
+        :param image: ProcessImage, a new one if None
+        '''
+        self.canopen = canopen
+        self.image = ProcessImage() if image is None else image
+        self.pdos = {}
+        self.running = False
+
+    def addPdo(self, nodeId, pdoNum, entries, types=None, cobId=None):
+        ''' Add a TPDO with a known mapping
+
+        :param pdoNum: Number of PDO [1,4]
+        :param entries: list of (index, subindex, bits), names or OdEntry
+        :param types: see pdoFormat, completed from the object dictionary
+        :param cobId: COB-ID, the predefined 180h + 100h * (pdoNum - 1) + Node ID if None
+        :returns: the compiled Pdo
+        '''
+        if cobId is None:
+            cobId = 0x180 + 0x100 * (pdoNum - 1) + nodeId
+        entries, types = resolveEntries(self.canopen.objectDictionary(nodeId), entries, types)
+        pdo = Pdo(self.image, nodeId, cobId, entries, types)
+        self.pdos[cobId] = pdo
+        if self.running:
+            self.canopen.dispatcher.addCallback(cobId, pdo.receive)
+        return pdo
+
+    def readMapping(self, nodeId, pdoNum, types=None, refresh=False):
+        ''' Add a TPDO with the mapping (1A00h) and COB-ID (1800h) of the node
+
+        :param refresh: see CanOpen.read_pdo_mapping
+        :returns: the compiled Pdo
+        '''
+        entries, cobId = readPdoMapping(self.canopen, nodeId, pdoNum, 'Tx', refresh)
+        return self.addPdo(nodeId, pdoNum, entries, types, cobId)
+
+    def start(self):
+        ''' Start decoding, the dispatcher of canopen is started if needed
+        '''
+        dispatcher = self.canopen.startDispatcher()
+        for cobId, pdo in self.pdos.items():
+            dispatcher.addCallback(cobId, pdo.receive)
+        self.running = True
+
+    def stop(self):
+        if self.running and self.canopen.dispatcher is not None:
+            for cobId, pdo in self.pdos.items():
+                self.canopen.dispatcher.removeCallback(cobId, pdo.receive)
+        self.running = False
+
+
+#---------------------------------------------------------------------------#
+# RPDO producer
+#---------------------------------------------------------------------------#
+class RpdoProducer(PeriodicProducer):
+    ''' Transmits the RPDOs of any number of nodes from a process image
+
+    The cycle is scheduled on absolute monotonic deadlines (start + k *
+    period), so the period does not drift with the time spent sending.
+    Cycles that are missed completely are skipped rather than sent in a
+    burst; see PeriodicProducer.stats for overruns and skipped.
+    '''
+
+    def __init__(self, canopen, image=None, period=0.001, spin=0.0):
+        ''' Initialize the producer
+
+        :param canopen: CanOpen object used to send the frames
+        :param image: ProcessImage, a new one if None
+        :param period: cycle time [sec]
+        :param spin: the last part of every wait [sec] is busy waiting,
+                     trading CPU time for less jitter
+        '''
+        self.canopen = canopen
+        self.image = ProcessImage() if image is None else image
+        self.pdos = []
+        self.lock = threading.Lock()
+        PeriodicProducer.__init__(self, period, spin)
+
+    def addPdo(self, nodeId, pdoNum, entries, types=None, cobId=None, inhibit=0.0):
+        ''' Add an RPDO with a known mapping
+
+        :param pdoNum: Number of PDO [1,4]
+        :param entries: list of (index, subindex, bits), names or OdEntry
+        :param types: see pdoFormat, completed from the object dictionary
+        :param cobId: COB-ID, the predefined 200h + 100h * (pdoNum - 1) + Node ID if None
+        :param inhibit: minimum time between two frames of this PDO [sec]
+        :returns: the compiled Pdo
+        '''
+        if cobId is None:
+            cobId = 0x200 + 0x100 * (pdoNum - 1) + nodeId
+        entries, types = resolveEntries(self.canopen.objectDictionary(nodeId), entries, types)
+        pdo = Pdo(self.image, nodeId, cobId, entries, types)
+        pdo.inhibit = inhibit
+        with self.lock:
+            self.pdos.append(pdo)
+        return pdo
+
+    def readMapping(self, nodeId, pdoNum, types=None, inhibit=0.0, refresh=False):
+        ''' Add an RPDO with the mapping (1600h) and COB-ID (1400h) of the node
+
+        :param refresh: see CanOpen.read_pdo_mapping
+        :returns: the compiled Pdo
+        '''
+        entries, cobId = readPdoMapping(self.canopen, nodeId, pdoNum, 'Rx', refresh)
+        return self.addPdo(nodeId, pdoNum, entries, types, cobId, inhibit)
+
+    def send(self, pdo, now=None):
+        ''' Send one PDO now unless its inhibit time has not elapsed
+
+        :returns: True if the frame was sent
+        '''
+        if now is None:
+            now = time.monotonic()
+        if pdo.lastSent is not None and now - pdo.lastSent < pdo.inhibit:
+            pdo.inhibited += 1
+            return False
+        self.canopen.writeCanMessage(pdo.cobId, pdo.encode())
+        pdo.lastSent = now
+        pdo.count += 1
+        return True
+
+    def cycle(self, now=None):
+        ''' Send all PDOs once '''
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            pdos = list(self.pdos)
+        for pdo in pdos:
+            self.send(pdo, now)
+
+    #-----------------------------------------------------------------------#
+    # Cyclic transmission
+    #-----------------------------------------------------------------------#
+    def _run(self):
+        period = self.period
+        deadline = time.monotonic() + period
+        while not self._wait(deadline):
+            now = time.monotonic()
+            try:
+                self.cycle(now)
+            except Exception as ex:
+                _logger.error('RPDO cycle failed: %s' % ex)
+            self._record(now, deadline)
+            deadline += period
+            now = time.monotonic()
+            if now >= deadline:
+                # skip the cycles that can no longer be met, keep the phase
+                missed = int((now - deadline) // period) + 1
+                self._overrun(missed, missed)
+                deadline += missed * period
+
+    #-----------------------------------------------------------------------#
+    # Statistics
+    #-----------------------------------------------------------------------#
+    def stats(self):
+        ''' Achieved timing since start or resetStats
+
+        :returns: PeriodicProducer.stats and inhibited, the frames held
+                  back by the inhibit time
+        '''
+        stats = PeriodicProducer.stats(self)
+        with self.lock:
+            stats['inhibited'] = sum(pdo.inhibited for pdo in self.pdos)
+        return stats
+
+
+def readPdoMapping(canopen, nodeId, pdoNum, rxTx, refresh=False):
+    ''' Mapping of a PDO by CanOpen.read_pdo_mapping, as read from the node or
+    as left by the last apply_pdo_mapping
+
+    :param pdoNum: Number of PDO [1,4]
+    :param rxTx: 'Rx' or 'Tx'
+    :param refresh: if True always read from the node
+    :returns: (entries, cobId) entries being a list of (index, subindex, bits)
+    '''
+    cobId, transType, mapping = canopen.read_pdo_mapping(nodeId, pdoNum, rxTx, refresh)
+    entries = [(value >> 16, (value >> 8) & 0xFF, value & 0xFF) for value in mapping]
+    return entries, cobId & 0x7FF
+
+
+#---------------------------------------------------------------------------#
+# Exported symbols
+#---------------------------------------------------------------------------#
+__all__ = ['ProcessImage', 'Pdo', 'TpdoConsumer', 'RpdoProducer', 'pdoFormat', 'resolveEntries',
+           'readPdoMapping']
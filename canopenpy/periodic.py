@@ -0,0 +1,157 @@
+'''
+Periodic Producer
+-----------------
+
+Base of the threads transmitting on a fixed period, RpdoProducer and
+SyncProducer.  It owns the thread, the wait for an absolute monotonic
+deadline (optionally busy waiting the last ``spin`` seconds) and the
+timing statistics; a subclass implements ``_run`` with its own catch-up
+policy, calls ``_wait`` and ``_record`` once per cycle and ``_overrun``
+whenever a cycle ends after the next deadline::
+
+    class Producer(PeriodicProducer):
+        def _run(self):
+            deadline = time.monotonic() + self.period
+            while not self._wait(deadline):
+                now = time.monotonic()
+                ...
+                self._record(now, deadline)
+                deadline += self.period
+                late = time.monotonic() - deadline
+                if late >= 0:
+                    missed = int(late // self.period) + 1
+                    self._overrun(missed, missed)
+                    deadline += missed * self.period
+'''
+import time
+import threading
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger(__name__)
+
+
+class PeriodicProducer(object):
+    ''' Thread and timing statistics of a periodic transmission
+    '''
+
+    def __init__(self, period, spin=0.0):
+        ''' Initialize the producer
+
+        :param period: cycle time [sec]
+        :param spin: the last part of every wait [sec] is busy waiting,
+                     trading CPU time for less jitter
+        '''
+        self.period = period
+        self.spin = spin
+        self.thread = None
+        self.stopEvent = threading.Event()
+        self.resetStats()
+
+    #-----------------------------------------------------------------------#
+    # Thread control
+    #-----------------------------------------------------------------------#
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopEvent.clear()
+        self.thread = threading.Thread(target=self._run, name=type(self).__name__)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopEvent.set()
+        self.thread.join()
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, klass, value, traceback):
+        self.stop()
+
+    def _wait(self, deadline):
+        # True if stopped before the deadline
+        remaining = deadline - time.monotonic() - self.spin
+        if remaining > 0 and self.stopEvent.wait(remaining):
+            return True
+        while time.monotonic() < deadline:
+            pass
+        return self.stopEvent.is_set()
+
+    def _run(self):
+        raise NotImplementedError
+
+    #-----------------------------------------------------------------------#
+    # Statistics
+    #-----------------------------------------------------------------------#
+    def resetStats(self):
+        self.cycles = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.lastCycle = None
+        self.periodSum = 0.0
+        self.periodSquares = 0.0
+        self.periodMin = None
+        self.periodMax = None
+        self.latenessMax = 0.0
+
+    def _record(self, now, deadline):
+        ''' Account one cycle started at now for the deadline
+
+        :returns: lateness [sec], the time the cycle started after its deadline
+        '''
+        self.cycles += 1
+        lateness = max(now - deadline, 0.0)
+        if lateness > self.latenessMax:
+            self.latenessMax = lateness
+        if self.lastCycle is not None:
+            period = now - self.lastCycle
+            self.periodSum += period
+            self.periodSquares += period * period
+            if self.periodMin is None or period < self.periodMin:
+                self.periodMin = period
+            if self.periodMax is None or period > self.periodMax:
+                self.periodMax = period
+        self.lastCycle = now
+        return lateness
+
+    def _overrun(self, missed, skipped):
+        ''' Account one overrun: a cycle ended after the next deadline
+
+        :param missed: number of deadlines that had passed
+        :param skipped: number of them not sent at all (the catch-up policy
+                        may send some late instead)
+        '''
+        self.overruns += 1
+        self.skipped += skipped
+
+    def stats(self):
+        ''' Achieved timing since start or resetStats
+
+        :returns: dict, times in [sec]: cycles, overruns (the times the
+                  producer fell behind, one per overrun however many
+                  deadlines it missed), skipped (the cycles never sent),
+                  period (mean), periodMin, periodMax, jitter (standard
+                  deviation of the period), latenessMax (worst start after
+                  the deadline)
+        '''
+        n = self.cycles - 1 if self.cycles else 0
+        mean = self.periodSum / n if n else None
+        jitter = None
+        if n:
+            jitter = max(self.periodSquares / n - mean * mean, 0.0) ** 0.5
+        return {'cycles': self.cycles, 'overruns': self.overruns, 'skipped': self.skipped,
+                'period': mean, 'periodMin': self.periodMin, 'periodMax': self.periodMax,
+                'jitter': jitter, 'latenessMax': self.latenessMax}
+
+
+#---------------------------------------------------------------------------#
+# Exported symbols
+#---------------------------------------------------------------------------#
+__all__ = ['PeriodicProducer']
@@ -0,0 +1,156 @@
+'''
+SDO Scheduler
+-------------
+
+Every node has its own SDO channel (600h + Node ID / 580h + Node ID), so
+transfers to different nodes can be in flight at the same time.  The
+scheduler keeps one outstanding transfer per node: requests for the same
+node are queued behind each other, requests for different nodes run
+concurrently.  Responses are correlated by COB-ID through the receive
+dispatcher of the CanOpen object.
+
+Reading the same parameter from 30 drives::
+
+    scheduler = SdoScheduler(canopen)
+    values = scheduler.upload_many([(node, 0x1018, 1, 'unsigned32')
+                                    for node in range(1, 31)])
+'''
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger(__name__)
+
+
+#---------------------------------------------------------------------------#
+# Scheduler
+#---------------------------------------------------------------------------#
+class SdoScheduler(object):
+    ''' Runs SDO transfers to many nodes concurrently over one channel
+    '''
+
+    def __init__(self, canopen):
+        ''' Initialize the scheduler
+
+        The receive dispatcher of canopen is started if it is not running,
+        it is what routes each response to the transfer waiting for it.
+
+        :param canopen: CanOpen object owning the channel
+        '''
+        self.canopen = canopen
+        self.canopen.startDispatcher()
+        self.executors = {}
+        self.lock = threading.Lock()
+
+    def _executor(self, node):
+        # one single-threaded worker per node serializes its transfers
+        with self.lock:
+            executor = self.executors.get(node)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=1)
+                self.executors[node] = executor
+        return executor
+
+    def submit(self, node, function, *args, **kwargs):
+        ''' Queue function(*args, **kwargs) as the next transfer of a node
+
+        :param node: Node ID the transfer talks to
+        :param function: CanOpen method performing the transfer
+        :returns: concurrent.futures.Future of the result
+        '''
+        return self._executor(node).submit(function, *args, **kwargs)
+
+    def upload(self, node, index, subindex=None, Type=None):
+        ''' Queue an SDOUpload
+
+        :param index: index, name or OdEntry, see CanOpen.resolveObject
+        :returns: concurrent.futures.Future of the uploaded value
+        '''
+        return self.submit(node, self.canopen.SDOUpload, node, index, subindex, Type)
+
+    def download(self, node, index, subindex=None, data=None, Type=None):
+        ''' Queue an SDODownload
+
+        :param index: index, name or OdEntry, see CanOpen.resolveObject
+        :returns: concurrent.futures.Future of the SDODownload result
+        '''
+        return self.submit(node, self.canopen.SDODownload, node, index, subindex, data, Type)
+
+    def upload_many(self, requests, returnExceptions=False):
+        ''' Upload a batch of objects, all nodes in parallel
+
+        :param requests: iterable of (node, index, subindex, type)
+        :param returnExceptions: if True a failed transfer puts its exception
+                                 in the result list instead of raising it
+        :returns: list of values in the order of requests
+        '''
+        return self.gather([self.upload(*request) for request in requests], returnExceptions)
+
+    def download_many(self, requests, returnExceptions=False):
+        ''' Download a batch of objects, all nodes in parallel
+
+        :param requests: iterable of (node, index, subindex, data, type)
+        :param returnExceptions: see upload_many
+        :returns: list of SDODownload results in the order of requests
+        '''
+        return self.gather([self.download(*request) for request in requests], returnExceptions)
+
+    def apply_pdo_mappings(self, requests, returnExceptions=False):
+        ''' Apply a batch of PDO mappings, all nodes in parallel
+
+        The PDOs of one node are mapped one after the other, and each one
+        writes only what differs, see CanOpen.apply_pdo_mapping.
+
+        :param requests: iterable of (node, pdoNum, rxTx, entries[, transType[, cobId]])
+        :param returnExceptions: see upload_many
+        :returns: list of apply_pdo_mapping results (True if written) in the
+                  order of requests
+        '''
+        return self.gather([self.submit(request[0], self.canopen.apply_pdo_mapping, *request)
+                            for request in requests], returnExceptions)
+
+    def gather(self, futures, returnExceptions=False):
+        ''' Wait for all futures
+
+        All transfers are finished before the first error is raised, so a
+        failing node never leaves transfers of other nodes running.
+
+        :param futures: futures returned by submit/upload/download
+        :param returnExceptions: see upload_many
+        :returns: list of results in the order of futures
+        '''
+        results = []
+        error = None
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as ex:
+                _logger.debug('SDO transfer failed: %s' % ex)
+                results.append(ex)
+                error = ex if error is None else error
+        if error is not None and not returnExceptions:
+            raise error
+        return results
+
+    def close(self):
+        ''' Wait for the queued transfers and release the worker threads
+        '''
+        with self.lock:
+            executors, self.executors = self.executors, {}
+        for executor in executors.values():
+            executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, klass, value, traceback):
+        self.close()
+
+
+#---------------------------------------------------------------------------#
+# Exported symbols
+#---------------------------------------------------------------------------#
+__all__ = ['SdoScheduler']
@@ -0,0 +1,202 @@
+'''
+SDO Read Cache
+--------------
+
+An optional cache in front of CanOpen.SDOUpload.  Every object has a
+policy:
+
+* ``POLICY_PINNED`` the first value read is kept until invalidated, for
+  constant objects such as the identity (1018h) or the device type (1000h)
+* a number, the time to live [sec] of a value read, for slow changing
+  objects
+* ``POLICY_NEVER`` every read goes to the node, for volatile objects
+
+Pinned are the objects of DefaultPinned and every object the object
+dictionary of the node declares 'const'.  'ro' objects are not: read-only
+is the access of the SDO client, the device itself updates them, e.g. the
+statusword (6041h) or the error register (1001h).  Any other object has
+the default policy unless a rule is set::
+
+    cache = canopen.enableSdoCache(maxsize=4096, default=POLICY_NEVER)
+    cache.setPolicy(0x2030, policy=5.0)         # 5 s on every node
+    cache.setPolicy(0x6041, policy=POLICY_NEVER, nodeId=3)
+    ...
+    print(cache.stats())
+
+Values with a time to live are held in a bounded LRU, pinned values apart
+from it.  SDODownload invalidates the written object, or stores the
+written value with ``writeThrough=True``.  ``SDOUpload(..., cached=False)``
+always reads from the node and refreshes the cache.
+'''
+import time
+import threading
+import collections
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger(__name__)
+
+POLICY_PINNED = 'pinned'
+POLICY_NEVER = 'never'
+
+# constant objects of CiA 301: device type, device name, hardware and
+# software version, identity
+DefaultPinned = (0x1000, 0x1008, 0x1009, 0x100A, 0x1018)
+
+
+class SdoCache(object):
+    ''' Cache of uploaded objects, keyed by (node, index, subindex)
+    '''
+
+    def __init__(self, canopen, maxsize=1024, default=POLICY_NEVER, writeThrough=False,
+                 pinned=DefaultPinned):
+        ''' Initialize the cache
+
+        :param canopen: CanOpen object, its object dictionaries provide the
+                        'const' objects
+        :param maxsize: number of values with a time to live kept
+        :param default: policy of objects without rule
+        :param writeThrough: if True SDODownload stores the written value,
+                             else it drops the cached one
+        :param pinned: indices pinned on every node
+        '''
+        self.canopen = canopen
+        self.maxsize = maxsize
+        self.default = default
+        self.writeThrough = writeThrough
+        self.rules = dict(((None, index, None), POLICY_PINNED) for index in pinned)
+        self.values = collections.OrderedDict()
+        self.pinned = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    #-----------------------------------------------------------------------#
+    # Policies
+    #-----------------------------------------------------------------------#
+    def setPolicy(self, index, subindex=None, policy=POLICY_NEVER, nodeId=None):
+        ''' Set the policy of an object
+
+        :param subindex: None for all sub-indices
+        :param policy: POLICY_PINNED, POLICY_NEVER or time to live [sec]
+        :param nodeId: None for all nodes
+        '''
+        with self.lock:
+            self.rules[(nodeId, index, subindex)] = policy
+
+    def policy(self, nodeId, index, subindex):
+        ''' Policy of an object, the most specific rule wins '''
+        rules = self.rules
+        for key in ((nodeId, index, subindex), (nodeId, index, None),
+                    (None, index, subindex), (None, index, None)):
+            policy = rules.get(key)
+            if policy is not None:
+                return policy
+        od = self.canopen.objectDictionary(nodeId)
+        if od is not None:
+            entry = od.get((index, subindex))
+            if entry is not None and entry.access == 'const':
+                return POLICY_PINNED
+        return self.default
+
+    #-----------------------------------------------------------------------#
+    # Cache access
+    #-----------------------------------------------------------------------#
+    def lookup(self, nodeId, index, subindex, Type, decode=True):
+        ''' Cached value of an object
+
+        :returns: (True, value) on a hit, (False, None) on a miss; raw data
+                  (decode False) as a new bytearray, like SDOUpload returns it
+        '''
+        key = (nodeId, index, subindex)
+        with self.lock:
+            item = self.pinned.get(key)
+            if item is None:
+                item = self.values.get(key)
+                if item is not None:
+                    if item[3] is not None and item[3] <= time.monotonic():
+                        del self.values[key]
+                        item = None
+                    else:
+                        self.values.move_to_end(key)
+            if item is None or item[0] != Type or item[1] != decode:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+        value = item[2]
+        if isinstance(value, bytes):
+            # the caller owns it, as an uploaded buffer
+            value = bytearray(value)
+        return True, value
+
+    def store(self, nodeId, index, subindex, Type, decode, value):
+        ''' Keep a value read from the node, as its policy allows '''
+        policy = self.policy(nodeId, index, subindex)
+        if policy == POLICY_NEVER:
+            return
+        if isinstance(value, bytearray):
+            # the caller owns the uploaded buffer
+            value = bytes(value)
+        key = (nodeId, index, subindex)
+        with self.lock:
+            if policy == POLICY_PINNED:
+                self.pinned[key] = (Type, decode, value, None)
+                return
+            self.values[key] = (Type, decode, value, time.monotonic() + policy)
+            self.values.move_to_end(key)
+            while len(self.values) > self.maxsize:
+                self.values.popitem(last=False)
+                self.evictions += 1
+
+    def written(self, nodeId, index, subindex, Type, data):
+        ''' Called by SDODownload after a successful write '''
+        # buffers and files are not kept, they may change after the write
+        if self.writeThrough and isinstance(data, (int, float, str)):
+            self.store(nodeId, index, subindex, Type, True, data)
+        else:
+            self.invalidate(nodeId, index, subindex)
+
+    def invalidate(self, nodeId=None, index=None, subindex=None):
+        ''' Drop cached values, None matches everything
+
+        e.g. invalidate(nodeId) after a reset of the node
+        '''
+        with self.lock:
+            if nodeId is not None and index is not None and subindex is not None:
+                # the case of every SDODownload, no scan
+                key = (nodeId, index, subindex)
+                for values in (self.values, self.pinned):
+                    if values.pop(key, None) is not None:
+                        self.invalidations += 1
+                return
+            for values in (self.values, self.pinned):
+                keys = [key for key in values
+                        if (nodeId is None or key[0] == nodeId) and
+                           (index is None or key[1] == index) and
+                           (subindex is None or key[2] == subindex)]
+                for key in keys:
+                    del values[key]
+                self.invalidations += len(keys)
+
+    def stats(self):
+        ''' Counters and sizes as a dict, ratio is the share of hits '''
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'ratio': self.hits / float(total) if total else 0.0,
+                    'evictions': self.evictions, 'invalidations': self.invalidations,
+                    'size': len(self.values), 'pinned': len(self.pinned)}
+
+    def resetStats(self):
+        with self.lock:
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+
+
+#---------------------------------------------------------------------------#
+# Exported symbols
+#---------------------------------------------------------------------------#
+__all__ = ['SdoCache', 'POLICY_PINNED', 'POLICY_NEVER', 'DefaultPinned']
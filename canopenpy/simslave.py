@@ -0,0 +1,468 @@
+'''
+Simulated CANopen Slaves
+------------------------
+
+SDO servers emulating CANopen nodes, for measuring the client without
+drives attached.  Every SdoServer serves its own object dictionary with
+expedited, segmented and block transfers and answers with the abort codes
+of canopenpy.SdoAbortCode.  Faults of a block transfer (a lost segment, a
+wrong CRC, a server without block transfers) are injected by setFaults.  A SimNetwork runs any number of them (up to
+the 127 node IDs) on one channel, typically an endpoint of a VirtualBus
+or a SocketCAN ``vcan`` interface::
+
+    bus = VirtualBus(zeroLatency=True)
+    network = SimNetwork(bus.openChannel(1))
+    for node in range(1, 128):
+        network.addNode(node, delay=0.0002, jitter=0.0001)
+    network.start()
+    canopen = CanOpen(bus.openChannel(0))
+
+All servers share one receive thread and one timer thread which sends the
+delayed responses, so a 127 node network costs two threads.
+'''
+import struct
+import heapq
+import random
+import threading
+import time
+from canopenpy import TypeLength, crc16, CANOPEN_SDO_BLKSIZE_MAX
+from dispatcher import CanDispatcher
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger(__name__)
+
+#---------------------------------------------------------------------------#
+# Abort codes (canopenpy.SdoAbortCode)
+#---------------------------------------------------------------------------#
+ABORT_TOGGLE = 0x05030000
+ABORT_CS = 0x05040001
+ABORT_BLKSIZE = 0x05040002
+ABORT_SEQNO = 0x05040003
+ABORT_CRC = 0x05040004
+ABORT_READONLY = 0x06010002
+ABORT_NO_OBJECT = 0x06020000
+ABORT_LENGTH = 0x06070010
+ABORT_NO_SUBINDEX = 0x06090011
+
+
+class SdoAbort(Exception):
+    ''' Raised inside the server to answer with Abort SDO Transfer '''
+
+    def __init__(self, code):
+        Exception.__init__(self, '0x%08x' % code)
+        self.code = code
+
+
+#---------------------------------------------------------------------------#
+# SDO server
+#---------------------------------------------------------------------------#
+class SdoServer(object):
+    ''' SDO server state machine of one node
+
+    handle() takes a request frame and returns the response frames, so the
+    server can be driven without any bus as well.
+    '''
+
+    def __init__(self, nodeId, objects=None, delay=0, jitter=0, blksize=CANOPEN_SDO_BLKSIZE_MAX):
+        ''' Initialize the server
+
+        :param nodeId: Node ID [1,127], the server answers on 0x580 + nodeId
+        :param objects: initial {(index, subindex): bytes} dictionary
+        :param delay: response delay [sec]
+        :param jitter: additional random delay [sec], uniform in [0, jitter]
+        :param blksize: number of segments per block offered in block download
+        '''
+        self.nodeId = nodeId
+        self.objects = {} if objects is None else dict(objects)
+        self.readOnly = set()
+        self.fixed = set()
+        self.aborts = {}
+        self.delay = delay
+        self.jitter = jitter
+        self.blksize = blksize
+        self.transfer = None
+        self.requests = 0
+        self.setFaults()
+        self.setObject(0x1000, 0, 0x00020192, 'unsigned32', readOnly=True)
+        self.setObject(0x1018, 0, 4, 'unsigned8', readOnly=True)
+        for sub, value in enumerate((0, 0, 0, nodeId), 1):
+            self.setObject(0x1018, sub, value, 'unsigned32', readOnly=True)
+
+    #-----------------------------------------------------------------------#
+    # Object dictionary
+    #-----------------------------------------------------------------------#
+    def setObject(self, index, subindex, value, Type='unsigned32', readOnly=False):
+        ''' Create or overwrite an object
+
+        :param value: int for the numeric types, str or bytes for 'vis string'
+        :param Type: one of canopenpy.TypeLength
+        '''
+        Type = Type.lower()
+        if Type == 'vis string':
+            value = value.encode('ascii') if isinstance(value, str) else bytes(value)
+            self.fixed.discard((index, subindex))
+        else:
+            value = struct.pack(TypeLength[Type][2], value)
+            self.fixed.add((index, subindex))
+        self.objects[(index, subindex)] = value
+        if readOnly:
+            self.readOnly.add((index, subindex))
+
+    def getObject(self, index, subindex):
+        ''' Raw bytes of an object
+        '''
+        return self.objects[(index, subindex)]
+
+    def setAbort(self, index, subindex, code):
+        ''' Answer every access to an object with the given abort code
+
+        :param code: abort code, None to remove
+        '''
+        if code is None:
+            self.aborts.pop((index, subindex), None)
+        else:
+            self.aborts[(index, subindex)] = code
+
+    def setFaults(self, dropSegment=None, corruptCrc=False, refuseBlock=None):
+        ''' Inject faults into the block transfers, no arguments to remove them
+
+        :param dropSegment: number of the segment lost in every block transfer,
+                            counted from 1 over all blocks; a segment sent by
+                            the server is not sent, one sent by the client is
+                            not received
+        :param corruptCrc: True to send a wrong CRC at the end of a block
+                           upload and to find the CRC of a block download wrong
+        :param refuseBlock: abort code answering every block initiate, as
+                            a server without block transfers does
+        '''
+        self.dropSegment = dropSegment
+        self.corruptCrc = corruptCrc
+        self.refuseBlock = refuseBlock
+        self.segments = 0
+
+    def _dropped(self):
+        # count a block segment, True if it is the one to lose
+        self.segments += 1
+        return self.segments == self.dropSegment
+
+    def _crc(self, data):
+        return crc16(data) ^ (0xFFFF if self.corruptCrc else 0)
+
+    def _lookup(self, index, subindex, write=False):
+        key = (index, subindex)
+        if key in self.aborts:
+            raise SdoAbort(self.aborts[key])
+        if key not in self.objects:
+            if any(i == index for i, s in self.objects):
+                raise SdoAbort(ABORT_NO_SUBINDEX)
+            raise SdoAbort(ABORT_NO_OBJECT)
+        if write and key in self.readOnly:
+            raise SdoAbort(ABORT_READONLY)
+        return key
+
+    def _store(self, key, value):
+        # numeric objects keep their size, strings take any size
+        if key in self.fixed and len(value) != len(self.objects[key]):
+            raise SdoAbort(ABORT_LENGTH)
+        self.objects[key] = bytes(value)
+
+    #-----------------------------------------------------------------------#
+    # Protocol
+    #-----------------------------------------------------------------------#
+    def handle(self, msg):
+        ''' Process one request frame
+
+        :param msg: data of a frame received on 0x600 + nodeId
+        :returns: list of response frames (8 bytes each)
+        '''
+        self.requests += 1
+        msg = bytes(msg).ljust(8, b'\0')
+        index, subindex = struct.unpack_from('<HB', msg, 1)
+        transfer = self.transfer
+        try:
+            if msg[0] == 0x80:
+                # Abort SDO Transfer from the client, no response
+                self.transfer = None
+                return []
+            if transfer is not None and transfer[0] == 'bdown' and transfer[-1] == 'block':
+                return self._blockDownloadSegment(msg)
+            ccs = msg[0] >> 5
+            if ccs == 2:
+                return self._initUpload(msg, index, subindex)
+            if ccs == 3:
+                return self._uploadSegment(msg)
+            if ccs == 1:
+                return self._initDownload(msg, index, subindex)
+            if ccs == 0:
+                return self._downloadSegment(msg)
+            if ccs == 5:
+                return self._blockUpload(msg, index, subindex)
+            if ccs == 6:
+                return self._blockDownload(msg, index, subindex)
+            raise SdoAbort(ABORT_CS)
+        except SdoAbort as ab:
+            if transfer is not None:
+                index, subindex = transfer[1]
+            self.transfer = None
+            return [struct.pack('<BHBL', 0x80, index, subindex, ab.code)]
+
+    # Upload (expedited / segmented) ---------------------------------------#
+    def _initUpload(self, msg, index, subindex):
+        key = self._lookup(index, subindex)
+        data = self.objects[key]
+        if 0 < len(data) <= 4:
+            # expedited, size indicated; n can not express an empty object,
+            # that one goes segmented with size 0
+            self.transfer = None
+            return [struct.pack('<BHB', 0x43 | ((4 - len(data)) << 2), index, subindex) + data.ljust(4, b'\0')]
+        self.transfer = ['up', key, data, 0, 0]
+        return [struct.pack('<BHBL', 0x41, index, subindex, len(data))]
+
+    def _uploadSegment(self, msg):
+        transfer = self.transfer
+        if transfer is None or transfer[0] != 'up':
+            raise SdoAbort(ABORT_CS)
+        kind, key, data, pos, toggle = transfer
+        if (msg[0] & 0x10) != toggle:
+            raise SdoAbort(ABORT_TOGGLE)
+        seg = data[pos:pos + 7]
+        pos += len(seg)
+        last = pos >= len(data)
+        transfer[3] = pos
+        transfer[4] = toggle ^ 0x10
+        if last:
+            self.transfer = None
+        return [bytes((toggle | ((7 - len(seg)) << 1) | last,)) + seg.ljust(7, b'\0')]
+
+    # Download (expedited / segmented) -------------------------------------#
+    def _initDownload(self, msg, index, subindex):
+        key = self._lookup(index, subindex, write=True)
+        response = struct.pack('<BHB', 0x60, index, subindex) + bytes(4)
+        if msg[0] & 2:
+            n = 4 - ((msg[0] >> 2) & 3) if msg[0] & 1 else 4
+            self.transfer = None
+            self._store(key, msg[4:4 + n])
+            return [response]
+        size = struct.unpack_from('<L', msg, 4)[0] if msg[0] & 1 else -1
+        self.transfer = ['down', key, bytearray(), 0, size]
+        return [response]
+
+    def _downloadSegment(self, msg):
+        transfer = self.transfer
+        if transfer is None or transfer[0] != 'down':
+            raise SdoAbort(ABORT_CS)
+        kind, key, buf, toggle, size = transfer
+        if (msg[0] & 0x10) != toggle:
+            raise SdoAbort(ABORT_TOGGLE)
+        buf += msg[1:8 - ((msg[0] >> 1) & 7)]
+        transfer[3] = toggle ^ 0x10
+        if msg[0] & 1:
+            self.transfer = None
+            if size >= 0 and size != len(buf):
+                raise SdoAbort(ABORT_LENGTH)
+            self._store(key, buf)
+        return [bytes((0x20 | toggle,)) + bytes(7)]
+
+    # Block upload ---------------------------------------------------------#
+    def _blockUpload(self, msg, index, subindex):
+        cs = msg[0] & 3
+        transfer = self.transfer
+        if cs == 0:
+            if self.refuseBlock is not None:
+                raise SdoAbort(self.refuseBlock)
+            key = self._lookup(index, subindex)
+            data = self.objects[key]
+            blksize, pst = msg[4], msg[5]
+            if not 0 < blksize <= CANOPEN_SDO_BLKSIZE_MAX:
+                raise SdoAbort(ABORT_BLKSIZE)
+            if pst and len(data) <= pst:
+                # protocol switch to the normal upload
+                return self._initUpload(msg, index, subindex)
+            crc = msg[0] & 4
+            self.segments = 0
+            # kind, key, data, acknowledged bytes, block start, blksize, crc, phase
+            self.transfer = ['bup', key, data, 0, 0, blksize, crc, 'init']
+            return [struct.pack('<BHBL', 0xC0 | crc | 2, index, subindex, len(data))]
+        if transfer is None or transfer[0] != 'bup':
+            raise SdoAbort(ABORT_CS)
+        kind, key, data, pos, start, blksize, crc, phase = transfer
+        if cs == 3 and phase == 'init':
+            return self._uploadBlock(transfer)
+        if cs == 2 and phase == 'block':
+            ackseq, blksize = msg[1], msg[2]
+            if ackseq > CANOPEN_SDO_BLKSIZE_MAX:
+                raise SdoAbort(ABORT_SEQNO)
+            if not 0 < blksize <= CANOPEN_SDO_BLKSIZE_MAX:
+                raise SdoAbort(ABORT_BLKSIZE)
+            pos = min(start + 7 * ackseq, len(data))
+            transfer[3] = pos
+            transfer[5] = blksize
+            if ackseq and pos >= len(data):
+                transfer[7] = 'end'
+                n = (7 - len(data) % 7) % 7 if data else 7
+                return [bytes((0xC1 | (n << 2),)) + struct.pack('<H', self._crc(data) if crc else 0) + bytes(5)]
+            return self._uploadBlock(transfer)
+        if cs == 1 and phase == 'end':
+            self.transfer = None
+            return []
+        raise SdoAbort(ABORT_CS)
+
+    def _uploadBlock(self, transfer):
+        kind, key, data, pos, start, blksize, crc, phase = transfer
+        frames = []
+        transfer[4] = pos
+        transfer[7] = 'block'
+        for seqno in range(1, blksize + 1):
+            seg = data[pos:pos + 7]
+            pos += 7
+            last = pos >= len(data)
+            if not self._dropped():
+                frames.append(bytes((seqno | (0x80 if last else 0),)) + seg.ljust(7, b'\0'))
+            if last:
+                break
+        return frames
+
+    # Block download -------------------------------------------------------#
+    def _blockDownload(self, msg, index, subindex):
+        cs = msg[0] & 1
+        transfer = self.transfer
+        if cs == 0:
+            if self.refuseBlock is not None:
+                raise SdoAbort(self.refuseBlock)
+            key = self._lookup(index, subindex, write=True)
+            size = struct.unpack_from('<L', msg, 4)[0] if msg[0] & 2 else -1
+            crc = msg[0] & 4
+            self.segments = 0
+            # kind, key, data, expected seqno, size, crc, complete, phase
+            self.transfer = ['bdown', key, bytearray(), 1, size, crc, False, 'block']
+            return [struct.pack('<BHBB', 0xA0 | crc, index, subindex, self.blksize) + bytes(3)]
+        if transfer is None or transfer[0] != 'bdown' or transfer[7] != 'end':
+            raise SdoAbort(ABORT_CS)
+        kind, key, buf, seqno, size, crc, complete, phase = transfer
+        n = (msg[0] >> 2) & 7
+        del buf[len(buf) - n:]
+        self.transfer = None
+        if crc and self._crc(buf) != struct.unpack_from('<H', msg, 1)[0]:
+            raise SdoAbort(ABORT_CRC)
+        if size >= 0 and size != len(buf):
+            raise SdoAbort(ABORT_LENGTH)
+        self._store(key, buf)
+        return [bytes((0xA1,)) + bytes(7)]
+
+    def _blockDownloadSegment(self, msg):
+        transfer = self.transfer
+        if self._dropped():
+            return []
+        seqno = msg[0] & 0x7F
+        if seqno == transfer[3]:
+            transfer[2] += msg[1:8]
+            transfer[3] += 1
+            transfer[6] = bool(msg[0] & 0x80)
+        elif seqno == 0:
+            raise SdoAbort(ABORT_SEQNO)
+        # end of the block: the last segment, or blksize segments sent
+        if msg[0] & 0x80 or seqno == self.blksize:
+            ackseq = transfer[3] - 1
+            transfer[3] = 1
+            if transfer[6]:
+                transfer[7] = 'end'
+            return [bytes((0xA2, ackseq, self.blksize)) + bytes(5)]
+        return []
+
+
+#---------------------------------------------------------------------------#
+# Network
+#---------------------------------------------------------------------------#
+class SimNetwork(object):
+    ''' Runs SdoServers on one channel
+    '''
+
+    def __init__(self, channel, pollTimeout=0.1, seed=None):
+        ''' Initialize the network
+
+        :param channel: opened channel the servers receive and send on
+        :param pollTimeout: see CanDispatcher
+        :param seed: seed of the jitter random generator, for reproducible runs
+        '''
+        self.dispatcher = CanDispatcher(channel, pollTimeout)
+        self.servers = {}
+        self.random = random.Random(seed)
+        self.pending = []
+        self.counter = 0
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+
+    def addNode(self, nodeId, objects=None, delay=0, jitter=0):
+        ''' Create the SdoServer of a node
+
+        :returns: the SdoServer, to populate its object dictionary
+        '''
+        return self.addServer(SdoServer(nodeId, objects, delay, jitter))
+
+    def addServer(self, server):
+        self.servers[server.nodeId] = server
+        self.dispatcher.addCallback(0x600 + server.nodeId, self._request)
+        return server
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='SimNetwork')
+        self.thread.daemon = True
+        self.thread.start()
+        self.dispatcher.start()
+
+    def stop(self):
+        self.dispatcher.stop()
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, klass, value, traceback):
+        self.stop()
+
+    def _request(self, frame):
+        # receive thread
+        server = self.servers[frame[0] - 0x600]
+        responses = server.handle(frame[1])
+        if not responses:
+            return
+        delay = server.delay + (self.random.uniform(0, server.jitter) if server.jitter else 0)
+        cobId = 0x580 + server.nodeId
+        if delay <= 0:
+            for msg in responses:
+                self.dispatcher.write(cobId, msg)
+            return
+        due = time.monotonic() + delay
+        with self.cond:
+            for msg in responses:
+                self.counter += 1
+                heapq.heappush(self.pending, (due, self.counter, cobId, msg))
+            self.cond.notify()
+
+    def _run(self):
+        with self.cond:
+            while self.running:
+                now = time.monotonic()
+                while self.pending and self.pending[0][0] <= now:
+                    due, counter, cobId, msg = heapq.heappop(self.pending)
+                    self.dispatcher.write(cobId, msg)
+                self.cond.wait(self.pending[0][0] - now if self.pending else None)
+
+
+#---------------------------------------------------------------------------#
+# Exported symbols
+#---------------------------------------------------------------------------#
+__all__ = ['SdoServer', 'SimNetwork', 'SdoAbort']
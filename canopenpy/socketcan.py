@@ -0,0 +1,269 @@
+'''
+SocketCAN Backend
+-----------------
+
+Linux SocketCAN channel with the read/write surface of canlib.canChannel,
+so CanOpen, CanDispatcher and the other consumers run on it unchanged::
+
+    ch = canChannel('can0')
+    ch.open()
+    ch.setFilters([0x581, 0x701])      # only without a dispatcher
+    canopen = CanOpen(ch)
+
+The bit rate is a property of the network interface and is configured
+outside the process (``ip link set can0 type can bitrate 1000000``); a
+``vcan`` interface gives a hardware-free bus.
+
+Receiving is done in batches: one poll wakes the reader, then every frame
+already queued in the socket is drained without blocking into a local
+buffer which the following reads are served from.  Python has no
+``recvmmsg``, so the drain is a short loop of ``recvmsg`` calls with
+MSG_DONTWAIT, but the thread sleeps and wakes once per burst instead of
+once per frame.  Frames carry the kernel receive time stamp (SO_TIMESTAMPNS).
+
+The socket itself stays blocking.  When the transmit queue of the
+interface is full the kernel still refuses a frame with ENOBUFS, so write
+retries until the queue drains or writeTimeout expired.
+'''
+import socket
+import select
+import struct
+import collections
+import errno
+import math
+import time
+from canlib import canNoMsg, canERR_NOMSG, canMSG_RTR, canMSG_STD, canMSG_EXT
+try:
+    import numpy as np
+    from common import canFrameDtype
+except ImportError:
+    np = None
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger(__name__)
+
+#---------------------------------------------------------------------------#
+# Constants (linux/can.h, asm/socket.h)
+#---------------------------------------------------------------------------#
+CAN_EFF_FLAG = 0x80000000
+CAN_RTR_FLAG = 0x40000000
+CAN_ERR_FLAG = 0x20000000
+CAN_SFF_MASK = 0x000007FF
+CAN_EFF_MASK = 0x1FFFFFFF
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0x40)
+# pause between two attempts to queue a frame [sec], about one frame at 1 Mbit/s
+TX_RETRY = 0.0002
+
+# struct can_frame { canid_t can_id; __u8 can_dlc; __u8 pad[3]; __u8 data[8]; }
+canFrame = struct.Struct('=IB3x8s')
+# struct can_filter { canid_t can_id; canid_t can_mask; }
+canFilter = struct.Struct('=II')
+# struct timespec
+timeSpec = struct.Struct('@ll')
+
+
+#---------------------------------------------------------------------------#
+# Channel
+#---------------------------------------------------------------------------#
+class canChannel(object):
+    ''' Raw CAN socket bound to one network interface
+
+    read returns the frames in the format of canlib.canChannel.read:
+        (id, data, dlc, flag, time, returns)
+    with data as bytes of length dlc, flag a combination of canlib.canMSG_xxx
+    and time the kernel time stamp [ns].
+    '''
+
+    def __init__(self, channel='can0', batch=64, writeTimeout=1.0):
+        ''' Initialize the channel, the socket is created by open
+
+        :param channel: network interface name ('can0', 'vcan0', ...)
+        :param batch: maximum number of frames drained per wakeup
+        :param writeTimeout: time [sec] write waits for room in a full
+                             transmit queue before it gives up
+        '''
+        self.channel = channel
+        self.batch = batch
+        self.writeTimeout = writeTimeout
+        self.sock = None
+        self.poller = None
+        self.filters = None
+        self.rxFrames = collections.deque()
+        self._rxBuf = bytearray(canFrame.size)
+        self._txBuf = bytearray(canFrame.size)
+        self._ancSize = socket.CMSG_SPACE(timeSpec.size)
+
+    def open(self, bitrate=None):
+        ''' Create the socket and bind it to the interface
+
+        :param bitrate: ignored, set by the interface configuration
+        '''
+        if bitrate is not None:
+            _logger.debug('SocketCAN bit rate is set by ip link, %s ignored' % bitrate)
+        self.sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+        self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        self.sock.bind((self.channel,))
+        self.poller = select.poll()
+        self.poller.register(self.sock, select.POLLIN)
+        if self.filters is not None:
+            self.setFilters(self.filters)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.poller = None
+        self.rxFrames.clear()
+
+    def fileno(self):
+        ''' Socket descriptor, e.g. for loop.add_reader
+        '''
+        return self.sock.fileno()
+
+    def setFilters(self, cobIds, mask=CAN_SFF_MASK):
+        ''' Let the kernel deliver only the given identifiers (CAN_RAW_FILTER)
+
+        Frames of other identifiers are dropped in the kernel and never wake
+        the reader.  A running CanDispatcher installs the COB-IDs it routes
+        itself; a channel read directly is filtered by its caller.
+
+        :param cobIds: iterable of COB-IDs, None to receive everything
+        :param mask: identifier bits compared, CAN_SFF_MASK for an exact match
+        '''
+        self.filters = None if cobIds is None else list(cobIds)
+        if self.sock is None:
+            return
+        if self.filters is None:
+            # the default filter of a new socket: everything
+            value = canFilter.pack(0, 0)
+        else:
+            value = b''.join(canFilter.pack(cobId, mask | CAN_EFF_FLAG | CAN_RTR_FLAG)
+                             for cobId in self.filters)
+        self.sock.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_FILTER, value)
+
+    #-----------------------------------------------------------------------#
+    # Transmit
+    #-----------------------------------------------------------------------#
+    def write(self, id, msg, flag=0):
+        ''' Send a frame
+
+        :param id: CAN identifier, extended if above 0x7FF or flag has canMSG_EXT
+        :param msg: data bytes (up to 8)
+        :param flag: canlib.canMSG_xxx flags
+        '''
+        if id > CAN_SFF_MASK or flag & canMSG_EXT:
+            id |= CAN_EFF_FLAG
+        if flag & canMSG_RTR:
+            id |= CAN_RTR_FLAG
+        canFrame.pack_into(self._txBuf, 0, id, len(msg), bytes(msg))
+        deadline = None
+        while True:
+            try:
+                self.sock.send(self._txBuf)
+                return
+            except OSError as ex:
+                # transmit queue full, it drains at the bus rate
+                if ex.errno not in (errno.ENOBUFS, errno.EAGAIN):
+                    raise
+                now = time.monotonic()
+                if deadline is None:
+                    deadline = now + self.writeTimeout
+                elif now >= deadline:
+                    _logger.error('SocketCAN transmit queue of %s full' % self.channel)
+                    raise
+            time.sleep(TX_RETRY)
+
+    #-----------------------------------------------------------------------#
+    # Receive
+    #-----------------------------------------------------------------------#
+    def _fill(self, timeout):
+        ''' Wait up to timeout [ms] and drain the socket into rxFrames
+
+        :returns: number of frames received
+        '''
+        if not self.poller.poll(timeout):
+            return 0
+        recv = self.sock.recvmsg_into
+        bufs = [self._rxBuf]
+        n = 0
+        while n < self.batch:
+            try:
+                nbytes, ancdata, flags, addr = recv(bufs, self._ancSize, MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            if nbytes < canFrame.size:
+                continue
+            stamp = 0
+            for level, kind, value in ancdata:
+                if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS:
+                    sec, nsec = timeSpec.unpack_from(value)
+                    stamp = sec * 1000000000 + nsec
+            canId, dlc, data = canFrame.unpack_from(self._rxBuf)
+            if canId & CAN_EFF_FLAG:
+                flag = canMSG_EXT
+                id = canId & CAN_EFF_MASK
+            else:
+                flag = canMSG_STD
+                id = canId & CAN_SFF_MASK
+            if canId & CAN_RTR_FLAG:
+                flag |= canMSG_RTR
+            dlc = min(dlc, 8)
+            self.rxFrames.append((id, data[:dlc], dlc, flag, stamp, 0))
+            n += 1
+        return n
+
+    def read(self, timeout=0):
+        ''' Return the next frame, waiting up to timeout [ms]
+
+        :param timeout: [ms], 0 to return immediately, None to wait forever
+        :returns: (id, data, dlc, flag, time, returns)
+        '''
+        if not self.rxFrames and not self._fill(-1 if timeout is None else timeout):
+            raise canNoMsg(None, canERR_NOMSG)
+        return self.rxFrames.popleft()
+
+    def readSpecific(self, id, timeout=0):
+        ''' Wait up to timeout [ms] for a frame with the given identifier.
+        Preceding frames of other identifiers are discarded.
+        '''
+        deadline = time.monotonic() + timeout / 1000.0
+        while True:
+            try:
+                # rounded up, a wait rounded down to 0 would spin until the deadline
+                frame = self.read(max(0, int(math.ceil((deadline - time.monotonic()) * 1000))))
+            except canNoMsg:
+                if time.monotonic() >= deadline:
+                    raise
+                continue
+            if frame[0] == id:
+                return frame
+
+    def read_many(self, max_frames=512, timeout=0):
+        ''' Drain the receive buffer in one call.
+        Waits up to timeout [ms] for the first frame, then takes everything
+        already received, up to max_frames frames.
+
+        :returns: NumPy structured array of common.canFrameDtype
+        '''
+        if np is None:
+            raise ImportError('read_many requires numpy')
+        if not self.rxFrames:
+            self._fill(timeout)
+        while len(self.rxFrames) < max_frames and self._fill(0):
+            pass
+        n = min(len(self.rxFrames), max_frames)
+        frames = np.zeros(n, dtype=canFrameDtype)
+        for i in range(n):
+            id, data, dlc, flag, stamp, returns = self.rxFrames.popleft()
+            frames[i] = (stamp, id, flag, dlc, tuple(data.ljust(8, b'\0')))
+        return frames
+
+
+#---------------------------------------------------------------------------#
+# Exported symbols
+#---------------------------------------------------------------------------#
+__all__ = ['canChannel', 'CAN_SFF_MASK', 'CAN_EFF_MASK']
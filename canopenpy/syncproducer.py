@@ -0,0 +1,187 @@
+'''
+SYNC Producer
+-------------
+
+Transmits the SYNC message (COB-ID 80h) every communication cycle period
+(1006h).  With a counter overflow value (1019h, 2 to 240) the SYNC
+carries one counter byte that runs from 1 to the overflow value, so the
+consumers can spread their synchronous PDOs over several cycles::
+
+    producer = SyncProducer(canopen, period=0.001, overflow=16)
+    producer.addCallback(onSync)
+    producer.start()
+    ...
+    print(producer.stats())
+
+The cycle is scheduled on absolute monotonic deadlines.  When a deadline
+was missed the catch-up policy decides what happens to the lost cycles:
+
+* ``'skip'``    the missed SYNCs are dropped, the phase is kept (default)
+* ``'burst'``   the missed SYNCs are sent at once, the phase is kept
+* ``'restart'`` the missed SYNCs are dropped, the next cycle is one
+  period after now
+
+Every cycle updates a lateness histogram (time the SYNC was sent after
+its deadline) and every miss an overrun histogram (number of cycles
+lost), both readable while the producer runs.
+'''
+import time
+import threading
+from periodic import PeriodicProducer
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger(__name__)
+
+SYNC_COB_ID = 0x80
+CatchUpPolicies = ('skip', 'burst', 'restart')
+
+
+class SyncProducer(PeriodicProducer):
+    ''' SYNC producer thread
+    '''
+
+    def __init__(self, canopen, period=0.001, overflow=0, catchUp='skip', spin=0.0,
+                 binWidth=0.00005, bins=40, cobId=SYNC_COB_ID):
+        ''' Initialize the producer
+
+        :param canopen: CanOpen object used to send the SYNC
+        :param period: communication cycle period [sec]
+        :param overflow: counter overflow value [2,240], 0 for a SYNC without counter
+        :param catchUp: one of CatchUpPolicies
+        :param spin: the last part of every wait [sec] is busy waiting,
+                     trading CPU time for less jitter
+        :param binWidth: width of a lateness histogram bin [sec]
+        :param bins: number of histogram bins, the last one collects the rest
+        :param cobId: COB-ID of the SYNC message
+        '''
+        if overflow and not 2 <= overflow <= 240:
+            logging.error('SYNC counter overflow value %d not in [2,240]' % overflow)
+            raise Exception('SYNC counter overflow value %d not in [2,240]' % overflow)
+        if catchUp not in CatchUpPolicies:
+            logging.error('Unknown catch-up policy %s' % catchUp)
+            raise Exception('Unknown catch-up policy %s' % catchUp)
+        self.canopen = canopen
+        self.overflow = overflow
+        self.catchUp = catchUp
+        self.binWidth = binWidth
+        self.bins = bins
+        self.cobId = cobId
+        self.counter = 0
+        self.msg = bytearray(1 if overflow else 0)
+        self.callbacks = []
+        self.lock = threading.Lock()
+        PeriodicProducer.__init__(self, period, spin)
+
+    #-----------------------------------------------------------------------#
+    # Synchronous window callbacks
+    #-----------------------------------------------------------------------#
+    def addCallback(self, callback):
+        ''' Call callback(counter, timestamp) right after every SYNC
+
+        counter is the transmitted counter value (0 without counter) and
+        timestamp the monotonic time the SYNC was sent, i.e. the start of
+        the synchronous window.  Callbacks run in the producer thread and
+        delay the next SYNC if they take longer than the period.
+        '''
+        with self.lock:
+            self.callbacks = self.callbacks + [callback]
+
+    def removeCallback(self, callback):
+        with self.lock:
+            self.callbacks = [cb for cb in self.callbacks if cb is not callback]
+
+    #-----------------------------------------------------------------------#
+    # Transmission
+    #-----------------------------------------------------------------------#
+    def send(self):
+        ''' Send one SYNC now
+
+        :returns: (counter, timestamp)
+        '''
+        if self.overflow:
+            self.counter = self.counter % self.overflow + 1
+            self.msg[0] = self.counter
+        self.canopen.writeCanMessage(self.cobId, self.msg)
+        now = time.monotonic()
+        for callback in self.callbacks:
+            try:
+                callback(self.counter, now)
+            except Exception as ex:
+                _logger.error('SYNC callback failed: %s' % ex)
+        return self.counter, now
+
+    def start(self):
+        if self.thread is None:
+            # the counter restarts with 1 whenever the SYNC producer starts
+            self.counter = 0
+            self.msg = bytearray(1 if self.overflow else 0)
+        PeriodicProducer.start(self)
+
+    def _run(self):
+        period = self.period
+        deadline = time.monotonic() + period
+        # last deadline already counted as missed, for 'burst'
+        counted = 0.0
+        while not self._wait(deadline):
+            try:
+                counter, sent = self.send()
+            except Exception as ex:
+                _logger.error('SYNC transmission failed: %s' % ex)
+                sent = time.monotonic()
+            self._record(sent, deadline)
+            deadline += period
+            now = time.monotonic()
+            if now < deadline:
+                continue
+            missed = int((now - deadline) // period) + 1
+            if self.catchUp == 'burst':
+                # the missed deadlines are met at once by the next waits,
+                # count only those not seen in a previous iteration
+                last = deadline + (missed - 1) * period
+                if deadline > counted:
+                    self._overrun(missed, 0)
+                elif last > counted:
+                    self._overrun(int(round((last - counted) / period)), 0)
+                counted = last
+            elif self.catchUp == 'skip':
+                self._overrun(missed, missed)
+                deadline += missed * period
+            else:
+                self._overrun(missed, missed)
+                deadline = now + period
+
+    #-----------------------------------------------------------------------#
+    # Statistics
+    #-----------------------------------------------------------------------#
+    def resetStats(self):
+        PeriodicProducer.resetStats(self)
+        self.latenessHistogram = [0] * self.bins
+        self.overrunHistogram = [0] * self.bins
+
+    def _record(self, sent, deadline):
+        lateness = PeriodicProducer._record(self, sent, deadline)
+        self.latenessHistogram[min(int(lateness / self.binWidth), self.bins - 1)] += 1
+        return lateness
+
+    def _overrun(self, missed, skipped):
+        PeriodicProducer._overrun(self, missed, skipped)
+        self.overrunHistogram[min(missed, self.bins - 1)] += 1
+
+    def histograms(self):
+        ''' Copies of the live histograms
+
+        :returns: (lateness, overrun) lateness[i] counts the SYNCs sent
+                  i * binWidth to (i + 1) * binWidth after their deadline,
+                  overrun[n] the misses of n cycles; the last bin of both
+                  collects everything beyond
+        '''
+        return list(self.latenessHistogram), list(self.overrunHistogram)
+
+
+#---------------------------------------------------------------------------#
+# Exported symbols
+#---------------------------------------------------------------------------#
+__all__ = ['SyncProducer', 'CatchUpPolicies', 'SYNC_COB_ID']
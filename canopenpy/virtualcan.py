@@ -0,0 +1,243 @@
+'''
+Virtual CAN Bus
+---------------
+
+An in-process CAN bus with any number of channel endpoints.  Endpoints
+have the API of canlib.canChannel, so CanOpen and every other consumer
+run on it without adapter hardware::
+
+    bus = VirtualBus(bitrate=1000000)
+    master = bus.openChannel(0)
+    slave = bus.openChannel(1)
+    master.open(1000000)
+    slave.open(1000000)
+    canopen = CanOpen(master)
+
+Like on a real bus a frame is received by every other endpoint that is
+on bus, not by its sender.  Frame timing follows the bit rate: the bus
+carries one frame at a time and a frame is visible to the receivers
+only once its last bit was transmitted (47 + 8 * dlc bits for a standard
+frame, bit stuffing not counted).  With ``zeroLatency=True`` frames are
+delivered as soon as they are written, for running protocol stacks at
+full speed.
+'''
+import threading
+import collections
+import time
+from canlib import canNoMsg, canERR_NOMSG, canMSG_STD, canMSG_EXT
+try:
+    import numpy as np
+    from common import canFrameDtype
+except ImportError:
+    np = None
+
+#---------------------------------------------------------------------------#
+# Logging
+#---------------------------------------------------------------------------#
+import logging
+_logger = logging.getLogger(__name__)
+
+
+#---------------------------------------------------------------------------#
+# Bus
+#---------------------------------------------------------------------------#
+class VirtualBus(object):
+    ''' The shared medium of the virtual channels
+    '''
+
+    def __init__(self, bitrate=1000000, zeroLatency=False):
+        ''' Initialize the bus
+
+        :param bitrate: bit rate [bit/s] used for the frame timing
+        :param zeroLatency: if True frames take no bus time
+        '''
+        self.bitrate = bitrate
+        self.zeroLatency = zeroLatency
+        self.channels = []
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.busFree = self.start
+        self.frames = 0
+
+    def openChannel(self, channel=0, flags=0):
+        ''' Attach a new endpoint, see canlib.canlib.openChannel
+
+        :param channel: number reported by the endpoint, for information only
+        :returns: canChannel
+        '''
+        ch = canChannel(self, channel)
+        with self.lock:
+            self.channels.append(ch)
+        return ch
+
+    def frameTime(self, dlc, extended=False):
+        ''' Time [sec] the bus is busy with one data frame
+        '''
+        return ((67 if extended else 47) + 8 * dlc) / float(self.bitrate)
+
+    def transmit(self, sender, frame):
+        ''' Put a frame on the bus
+
+        :param sender: endpoint writing the frame, it does not receive it
+        :param frame: (id, data, dlc, flag)
+        '''
+        with self.lock:
+            if self.zeroLatency:
+                deliverAt = 0
+                stamp = time.monotonic()
+            else:
+                now = time.monotonic()
+                self.busFree = max(self.busFree, now) + self.frameTime(frame[2], frame[3] & canMSG_EXT)
+                deliverAt = stamp = self.busFree
+            self.frames += 1
+            frame = frame + (int((stamp - self.start) * 1000), 0)
+            # under the bus lock, so every receiver sees the bus order
+            for ch in self.channels:
+                if ch is not sender and ch.onBus:
+                    ch.receive(deliverAt, frame)
+
+    def detach(self, ch):
+        with self.lock:
+            if ch in self.channels:
+                self.channels.remove(ch)
+
+
+#---------------------------------------------------------------------------#
+# Channel
+#---------------------------------------------------------------------------#
+class canChannel(object):
+    ''' Endpoint of a VirtualBus with the API of canlib.canChannel
+
+    read returns (id, data, dlc, flag, time, returns) with data as bytes of
+    length dlc and time in [ms] since the bus was created.
+    '''
+
+    def __init__(self, bus, channel=0):
+        self.bus = bus
+        self.index = channel
+        self.onBus = False
+        self.rxFrames = collections.deque()
+        self.cond = threading.Condition()
+
+    def open(self, bitrate=None):
+        ''' Go on bus
+
+        :param bitrate: must match the bit rate of the bus if given
+        '''
+        if bitrate is not None and bitrate != self.bus.bitrate:
+            logging.error('Bit rate %s does not match the virtual bus (%s)' % (bitrate, self.bus.bitrate))
+            raise Exception('Bit rate %s does not match the virtual bus (%s)' % (bitrate, self.bus.bitrate))
+        self.busOn()
+
+    def close(self):
+        self.busOff()
+        self.bus.detach(self)
+
+    def busOn(self):
+        self.onBus = True
+
+    def busOff(self):
+        self.onBus = False
+        with self.cond:
+            self.rxFrames.clear()
+
+    def setBusParams(self, freq, tseg1=0, tseg2=0, sjw=0, noSamp=0, syncmode=0):
+        pass
+
+    def getBusParams(self):
+        return self.bus.bitrate, 0, 0, 0, 1, 0
+
+    #-----------------------------------------------------------------------#
+    # Transmit
+    #-----------------------------------------------------------------------#
+    def write(self, id, msg, flag=0):
+        ''' Queue a frame on the bus, returns immediately
+
+        msg is copied, the caller may reuse its buffer.
+        '''
+        if not self.onBus:
+            logging.error('Virtual channel %d is off bus' % self.index)
+            raise Exception('Virtual channel %d is off bus' % self.index)
+        if not flag & (canMSG_STD | canMSG_EXT):
+            flag |= canMSG_EXT if id > 0x7FF else canMSG_STD
+        data = bytes(msg)
+        self.bus.transmit(self, (id, data, len(data), flag))
+
+    def writeWait(self, id, msg, flag=0, timeout=0):
+        self.write(id, msg, flag)
+
+    #-----------------------------------------------------------------------#
+    # Receive
+    #-----------------------------------------------------------------------#
+    def receive(self, deliverAt, frame):
+        ''' Called by the bus for every frame of another endpoint
+        '''
+        with self.cond:
+            self.rxFrames.append((deliverAt, frame))
+            self.cond.notify()
+
+    def _wait(self, deadline):
+        # with self.cond held: True once the first frame is delivered
+        while True:
+            now = time.monotonic()
+            if self.rxFrames and self.rxFrames[0][0] <= now:
+                return True
+            if deadline is not None and now >= deadline:
+                return False
+            wakeup = deadline
+            if self.rxFrames and (wakeup is None or self.rxFrames[0][0] < wakeup):
+                wakeup = self.rxFrames[0][0]
+            self.cond.wait(None if wakeup is None else wakeup - now)
+
+    def read(self, timeout=0):
+        ''' Return the next frame, waiting up to timeout [ms]
+
+        :param timeout: [ms], None to wait forever
+        :returns: (id, data, dlc, flag, time, returns)
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout / 1000.0
+        with self.cond:
+            if not self._wait(deadline):
+                raise canNoMsg(None, canERR_NOMSG)
+            return self.rxFrames.popleft()[1]
+
+    def readSpecific(self, id, timeout=0):
+        ''' Wait up to timeout [ms] for a frame with the given identifier.
+        Preceding frames of other identifiers are discarded.
+        '''
+        deadline = time.monotonic() + timeout / 1000.0
+        with self.cond:
+            while self._wait(deadline):
+                frame = self.rxFrames.popleft()[1]
+                if frame[0] == id:
+                    return frame
+        raise canNoMsg(None, canERR_NOMSG)
+
+    def read_many(self, max_frames=512, timeout=0):
+        ''' Drain the delivered frames in one call.
+        Waits up to timeout [ms] for the first frame.
+
+        :returns: NumPy structured array of common.canFrameDtype
+        '''
+        if np is None:
+            raise ImportError('read_many requires numpy')
+        frames = []
+        with self.cond:
+            if self._wait(time.monotonic() + timeout / 1000.0):
+                now = time.monotonic()
+                while self.rxFrames and len(frames) < max_frames and self.rxFrames[0][0] <= now:
+                    frames.append(self.rxFrames.popleft()[1])
+        arr = np.zeros(len(frames), dtype=canFrameDtype)
+        for i, (id, data, dlc, flag, stamp, returns) in enumerate(frames):
+            arr[i] = (stamp, id, flag, dlc, tuple(data.ljust(8, b'\0')))
+        return arr
+
+    def ioCtl_flush_rx_buffer(self):
+        with self.cond:
+            self.rxFrames.clear()
+
+
+#---------------------------------------------------------------------------#
+# Exported symbols
+#---------------------------------------------------------------------------#
+__all__ = ['VirtualBus', 'canChannel']
@@ -0,0 +1,63 @@
+'''
+Fixtures running the client against simulated nodes on a VirtualBus,
+no CAN hardware needed::
+
+    python -m pytest -q tests
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'canopenpy'))
+
+import pytest
+import canopenpy
+import virtualcan
+from simslave import SimNetwork
+
+
+@pytest.fixture
+def bus():
+    return virtualcan.VirtualBus(zeroLatency=True)
+
+
+@pytest.fixture
+def network(bus):
+    ''' Running SimNetwork, nodes are added by the test '''
+    channel = bus.openChannel(1)
+    channel.open()
+    net = SimNetwork(channel, pollTimeout=0.01)
+    net.start()
+    yield net
+    net.stop()
+
+
+@pytest.fixture
+def sender(bus):
+    ''' Endpoint for frames of other producers (heartbeats, EMCY, PDOs) '''
+    channel = bus.openChannel(2)
+    channel.open()
+    return channel
+
+
+@pytest.fixture(params=['driver', 'dispatcher'])
+def canopen(request, bus):
+    ''' CanOpen client, once waiting in the driver and once on the dispatcher '''
+    channel = bus.openChannel(0)
+    channel.open()
+    co = canopenpy.CanOpen(channel)
+    co.timeout = 0.2
+    if request.param == 'dispatcher':
+        co.startDispatcher(pollTimeout=0.01)
+    yield co
+    co.close()
+
+
+def waitFor(condition, timeout=2.0):
+    ''' Poll condition() until it is true, False on timeout '''
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
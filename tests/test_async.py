@@ -0,0 +1,134 @@
+import asyncio
+import io
+import os
+
+import pytest
+from asynccanopen import AsyncCanOpen
+
+
+@pytest.fixture
+def node(network):
+    server = network.addNode(3)
+    server.setObject(0x2000, 1, -1234, 'integer16')
+    server.setObject(0x2000, 2, 0xDEADBEEF, 'unsigned32')
+    server.setObject(0x2001, 0, 'a segmented string', 'vis string')
+    server.setObject(0x2002, 0, b'', 'vis string')
+    server.setObject(0x2003, 0, -2 ** 40, 'integer64')
+    return server
+
+
+def run(canopen, coroutine):
+    async def main():
+        return await coroutine(AsyncCanOpen(canopen))
+    return asyncio.run(main())
+
+
+def test_async_sdo(canopen, node):
+    data = os.urandom(5000)
+
+    async def transfers(client):
+        assert await client.SDOUpload(3, 0x2000, 1, 'integer16') == -1234
+        assert await client.SDOUpload(3, 0x2000, 2, 'unsigned32') == 0xDEADBEEF
+        await client.SDODownload(3, 0x2000, 1, -5, 'integer16')
+        assert await client.SDOUpload(3, 0x2001, 0, 'vis string') == 'a segmented string'
+        raw = await client.SDOUpload(3, 0x2001, 0, 'vis string', decode=False)
+        assert raw == canopen.SDOUpload(3, 0x2001, 0, 'vis string', decode=False)
+        assert type(raw) is type(canopen.SDOUpload(3, 0x2001, 0, 'vis string', decode=False))
+        assert await client.SDOUpload(3, 0x2003, 0, 'integer64') == -2 ** 40
+        await client.SDODownload(3, 0x2003, 0, -0.5, 'real64')
+        await client.SDODownload(3, 0x2002, 0, io.BytesIO(data), 'vis string')
+        sink = io.BytesIO()
+        assert await client.SDOUploadStream(3, 0x2002, 0, sink) == len(data)
+        return sink.getvalue()
+
+    assert run(canopen, transfers) == data
+    assert node.getObject(0x2000, 1) == (-5).to_bytes(2, 'little', signed=True)
+    assert canopen.SDOUpload(3, 0x2003, 0, 'real64') == -0.5
+
+
+def test_async_block_upload(canopen, node):
+    data = os.urandom(1000)
+    node.setObject(0x2002, 0, data, 'vis string')
+    node.setFaults(dropSegment=40)
+
+    async def uploads(client):
+        # the block transfer and the next upload to the node take turns
+        return await asyncio.gather(client.SDOUploadBlock(3, 0x2002, 0, size=16),
+                                    client.SDOUpload(3, 0x2000, 1, 'integer16'),
+                                    client.SDOUploadBlock(3, 0x2001, 0, pst=30))
+
+    assert run(canopen, uploads) == [data, -1234, b'a segmented string']
+
+
+def test_async_block_download(canopen, node):
+    data = os.urandom(1000)
+    node.blksize = 16
+    node.setFaults(dropSegment=40)
+
+    async def download(client):
+        await client.SDODownloadBlock(3, 0x2002, 0, data)
+        return await client.SDOUploadBlock(3, 0x2002, 0)
+
+    assert run(canopen, download) == data
+    assert node.getObject(0x2002, 0) == data
+
+
+def test_async_record_strings(canopen, node):
+    values = {1: 'short', 2: 'too long for a segmented transfer'}
+    node.setObject(0x2004, 1, '', 'vis string')
+    node.setObject(0x2004, 2, '', 'vis string')
+
+    async def record(client):
+        await client.download_record(3, 0x2004, values, 'vis string')
+        return await client.upload_record(3, 0x2004, [1, 2], 'vis string')
+
+    assert run(canopen, record) == values
+    assert canopen.blockSupport[3] is True
+
+
+def test_async_cache(canopen, node):
+    canopen.enableSdoCache(default=60)
+
+    async def uploads(client):
+        values = [await client.SDOUpload(3, 0x2000, 2, 'unsigned32') for i in range(3)]
+        await client.SDODownload(3, 0x2000, 2, 1, 'unsigned32')
+        return values + [await client.SDOUpload(3, 0x2000, 2, 'unsigned32')]
+
+    requests = node.requests
+    assert run(canopen, uploads) == [0xDEADBEEF] * 3 + [1]
+    assert node.requests == requests + 3
+    # the sync client shares the cache
+    assert canopen.SDOUpload(3, 0x2000, 2, 'unsigned32') == 1
+    assert node.requests == requests + 3
+
+
+def test_async_abort_and_timeout(canopen, node):
+    canopen.timeout = 0.01
+
+    async def failures(client):
+        with pytest.raises(Exception, match='Abort code'):
+            await client.SDOUpload(3, 0x3000, 0, 'unsigned32')
+        with pytest.raises(Exception, match='Abort code'):
+            await client.SDODownload(3, 0x3000, 0, b'0123456789', 'vis string')
+        with pytest.raises(Exception, match='Timeout'):
+            await client.SDOUpload(5, 0x1000, 0, 'unsigned32')
+        return await client.SDOUpload(3, 0x2000, 1, 'integer16')
+
+    assert run(canopen, failures) == -1234
+
+
+def test_async_pdo_mapping(canopen, network):
+    server = network.addNode(3)
+    server.setObject(0x1800, 1, 0x183, 'unsigned32')
+    server.setObject(0x1800, 2, 255, 'unsigned8')
+    for subindex in range(9):
+        server.setObject(0x1A00, subindex, 0, 'unsigned8' if subindex == 0 else 'unsigned32')
+    canopen.enableSdoCache(default=60)
+
+    async def mapping(client):
+        assert await client.SDOUpload(3, 0x1A00, 0, 'unsigned8') == 0
+        await client.SetPdoMapping(3, 1, 'Tx', 1, [0x6041, 0x6064], [0, 0], [16, 32], 0x190)
+        return await client.upload_record(3, 0x1A00, None, 'unsigned32')
+
+    assert run(canopen, mapping) == {1: 0x60410010, 2: 0x60640020}
+    assert canopen.upload_record(3, 0x1800, [1, 2], {1: 'unsigned32', 2: 'unsigned8'}) == {1: 0x40000190, 2: 1}
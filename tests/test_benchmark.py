@@ -0,0 +1,30 @@
+import argparse
+
+import pytest
+import benchmark
+
+
+def test_median_of_repeats(monkeypatch):
+    runs = iter([10.0, 50.0, 12.0])
+    monkeypatch.setattr(benchmark, 'benchSdo', lambda results, *args: results.update(sdo_segmented_Bps=next(runs)))
+    monkeypatch.setattr(benchmark, 'benchPdo', lambda results, *args: None)
+    monkeypatch.setattr(benchmark, 'benchGetRU', lambda results, *args: None)
+    samples = {}
+    assert benchmark.run(repeat=3, samples=samples) == {'sdo_segmented_Bps': 12.0}
+    assert samples == {'sdo_segmented_Bps': [10.0, 50.0, 12.0]}
+
+
+def test_compare_tolerances():
+    baseline = {'sdo_expedited_p99_us': 100.0, 'sdo_segmented_Bps': 1000.0}
+    results = {'sdo_expedited_p99_us': 130.0, 'sdo_segmented_Bps': 850.0}
+    rows = benchmark.compare(results, baseline, 0.1)
+    assert [row[4] for row in rows] == [True, True]
+    rows = benchmark.compare(results, baseline, 0.1, tolerances={'sdo_expedited_p99_us': 0.5})
+    assert [(row[0], row[4]) for row in rows] == [('sdo_expedited_p99_us', False), ('sdo_segmented_Bps', True)]
+
+
+def test_metric_tolerance_option():
+    assert benchmark.metricTolerance('sdo_expedited_p99_us=0.5') == ('sdo_expedited_p99_us', 0.5)
+    for text in ('sdo_expedited_p99_us', 'unknown=0.5', 'sdo_expedited_p99_us=much'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            benchmark.metricTolerance(text)
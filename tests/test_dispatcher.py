@@ -0,0 +1,132 @@
+import time
+
+import pytest
+import canopenpy
+from canlib import canNoMsg, canERR_NOMSG
+from dispatcher import CanDispatcher
+from simslave import SdoServer
+
+
+class InstantChannel(object):
+    ''' Channel whose node answers inside write(), before write returns,
+    the fastest possible reply
+    '''
+
+    def __init__(self, server):
+        self.server = server
+        self.dispatcher = None
+
+    def write(self, id, msg, flag=0):
+        for response in self.server.handle(msg):
+            self.dispatcher.dispatch((0x580 + self.server.nodeId, response, 8, 0, 0, 0))
+
+    def read(self, timeout=0):
+        raise canNoMsg(None, canERR_NOMSG)
+
+    def close(self):
+        pass
+
+
+def test_reply_before_wait():
+    server = SdoServer(3)
+    server.setObject(0x2000, 0, 'a segmented value', 'vis string')
+    channel = InstantChannel(server)
+    co = canopenpy.CanOpen(channel)
+    co.timeout = 0.05
+    channel.dispatcher = co.startDispatcher(pollTimeout=0.01)
+    try:
+        assert co.SDOUpload(3, 0x1018, 4, 'unsigned32') == 3
+        assert co.SDOUpload(3, 0x2000, 0, 'vis string') == 'a segmented value'
+        assert channel.dispatcher.unrouted == 0
+    finally:
+        co.close()
+
+
+class FailingChannel(object):
+    ''' Channel whose driver read fails the first failures times '''
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.reads = 0
+
+    def write(self, id, msg, flag=0):
+        pass
+
+    def read(self, timeout=0):
+        self.reads += 1
+        if self.reads <= self.failures:
+            raise OSError('driver gone')
+        raise canNoMsg(None, canERR_NOMSG)
+
+    def close(self):
+        pass
+
+
+def test_persistent_read_error():
+    channel = FailingChannel(10 ** 6)
+    co = canopenpy.CanOpen(channel)
+    co.timeout = 0.05
+    dispatcher = co.startDispatcher(pollTimeout=0.01)
+    try:
+        dispatcher.thread.join(5)
+        # gave up after backing off instead of spinning on the error
+        assert not dispatcher.thread.is_alive()
+        assert channel.reads == dispatcher.maxErrors
+        with pytest.raises(Exception, match='dispatcher stopped: driver gone'):
+            co.SDOUpload(3, 0x1018, 4, 'unsigned32')
+        # a restart clears the error
+        channel.failures = 0
+        co.startDispatcher()
+        assert dispatcher.error is None
+        with pytest.raises(Exception, match='Timeout'):
+            co.SDOUpload(3, 0x1018, 4, 'unsigned32')
+    finally:
+        co.close()
+
+
+def test_transient_read_error():
+    server = SdoServer(3)
+    channel = InstantChannel(server)
+    failing = FailingChannel(3)
+    channel.read = failing.read
+    co = canopenpy.CanOpen(channel)
+    co.timeout = 0.05
+    channel.dispatcher = co.startDispatcher(pollTimeout=0.01)
+    try:
+        assert co.SDOUpload(3, 0x1018, 4, 'unsigned32') == 3
+        time.sleep(0.05)
+        assert failing.reads > 3 and channel.dispatcher.running
+        assert channel.dispatcher.error is None
+    finally:
+        co.close()
+
+
+class FilterChannel(FailingChannel):
+    ''' Channel recording the kernel filters installed on it '''
+
+    def __init__(self):
+        FailingChannel.__init__(self, 0)
+        self.filters = []
+
+    def setFilters(self, cobIds):
+        self.filters.append(None if cobIds is None else list(cobIds))
+
+
+def test_kernel_filters():
+    channel = FilterChannel()
+    dispatcher = CanDispatcher(channel, pollTimeout=0.01)
+    dispatcher.subscribe(0x581)
+    assert channel.filters == []
+    dispatcher.start()
+    try:
+        dispatcher.subscribe(0x581)
+        dispatcher.addCallback(range(0x701, 0x703), lambda frame: None)
+        dispatcher.unsubscribe(0x581)
+    finally:
+        dispatcher.stop()
+    assert channel.filters == [[0x581], [0x581, 0x701, 0x702], [0x701, 0x702], None]
+    # a dispatcher told not to filter leaves the channel alone
+    channel = FilterChannel()
+    with CanDispatcher(channel, pollTimeout=0.01, kernelFilters=False) as dispatcher:
+        dispatcher.subscribe(0x581)
+    assert channel.filters == []
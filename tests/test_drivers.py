@@ -0,0 +1,80 @@
+from ctypes import sizeof
+from types import SimpleNamespace
+
+import pytest
+np = pytest.importorskip('numpy')
+import canlib
+import ni8473a
+from canlib import canMSG_RTR, canMSG_STD, canMSG_EXT
+from common import canFrameDtype
+
+
+class CanlibDll(object):
+    ''' canReadWait of a queue of (id, data, flag, time) frames '''
+
+    def __init__(self, frames):
+        self.frames = list(frames)
+
+    def canOpenChannel(self, channel, flags):
+        return 0
+
+    def canReadWait(self, handle, id, msg, dlc, flag, time, timeout):
+        if not self.frames:
+            raise canlib.canNoMsg(None, canlib.canERR_NOMSG)
+        frameId, data, frameFlag, stamp = self.frames.pop(0)
+        id._obj.value = frameId
+        msg._obj[:len(data)] = list(data)
+        dlc._obj.value = len(data)
+        flag._obj.value = frameFlag
+        time._obj.value = stamp
+
+
+class NicanDll(object):
+    ''' ncReadMult of a list of NCTYPE_CAN_STRUCT fields '''
+
+    def __init__(self, frames):
+        self.frames = frames
+
+    def ncReadMult(self, handle, size, data, actual):
+        for frame, (stamp, id, frameType, payload) in zip(data._obj, self.frames):
+            frame.TimeStamp.LowPart = stamp
+            frame.ArbitrationId = id
+            frame.FrameType = frameType
+            frame.DataLength = len(payload)
+            frame.Data[:len(payload)] = list(payload)
+        actual._obj.value = len(self.frames) * sizeof(ni8473a.NCTYPE_CAN_STRUCT)
+
+
+def test_drivers_share_frame_dtype():
+    import socketcan
+    import virtualcan
+    assert canlib.canFrameDtype is ni8473a.canFrameDtype is canFrameDtype
+    assert socketcan.canFrameDtype is virtualcan.canFrameDtype is canFrameDtype
+
+
+def test_canlib_read_many_zeroes_stale_data():
+    dll = CanlibDll([(0x181, b'\x11' * 8, canMSG_STD, 10),
+                     (0x1234567, b'\x22\x33', canMSG_EXT, 11),
+                     (0x601, b'', canMSG_STD | canMSG_RTR, 12)])
+    ch = canlib.canChannel(SimpleNamespace(dll=dll, canMessage=canlib.canlib.canMessage), 0)
+    frames = ch.read_many()
+    assert frames.dtype == canFrameDtype
+    assert list(frames['id']) == [0x181, 0x1234567, 0x601]
+    assert list(frames['dlc']) == [8, 2, 0]
+    # the message buffer still holds the bytes of the first frame
+    assert bytes(frames['data'][1]) == b'\x22\x33' + bytes(6)
+    assert bytes(frames['data'][2]) == bytes(8)
+
+
+def test_ni_read_many_converts_frames():
+    dll = NicanDll([(10, 0x181, ni8473a.NC_FRMTYPE_DATA, b'\x11\x22'),
+                    (11, 0x1234567 | ni8473a.NC_FL_CAN_ARBID_XTD, ni8473a.NC_FRMTYPE_DATA, b'\x33' * 8),
+                    (12, 0x601, ni8473a.NC_FRMTYPE_REMOTE, b'')])
+    ch = ni8473a.canChannel(SimpleNamespace(dll=dll), 'CAN0')
+    frames = ch.read_many(max_frames=4)
+    assert frames.dtype == canFrameDtype
+    assert list(frames['timestamp']) == [10, 11, 12]
+    assert list(frames['id']) == [0x181, 0x1234567, 0x601]
+    assert list(frames['flags']) == [canMSG_STD, canMSG_EXT, canMSG_STD | canMSG_RTR]
+    assert bytes(frames['data'][0]) == b'\x11\x22' + bytes(6)
+    assert bytes(frames['data'][1]) == b'\x33' * 8
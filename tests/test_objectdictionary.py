@@ -0,0 +1,181 @@
+import hashlib
+import os
+import pickle
+
+import pytest
+from objectdictionary import CACHE_VERSION, loadObjectDictionary, parseEds
+
+EDS = '''
+[DeviceInfo]
+ProductName=Test drive
+
+[1018]
+ParameterName=Identity object
+ObjectType=0x9
+SubNumber=2
+
+[1018sub0]
+ParameterName=Number of entries
+DataType=0x0005
+AccessType=ro
+DefaultValue=1
+
+[1018sub1]
+ParameterName=Vendor-ID
+DataType=0x0007
+AccessType=ro
+
+[2000]
+ParameterName=Speed
+ObjectType=0x7
+DataType=0x0003
+AccessType=rw
+PDOMapping=1
+
+[2001]
+ParameterName=Counter
+ObjectType=0x7
+DataType=0x0007
+AccessType=rw
+
+[2002]
+ParameterName=Name
+ObjectType=0x7
+DataType=0x0009
+AccessType=rw
+
+[2003]
+ParameterName=Table
+ObjectType=0x8
+DataType=0x0006
+AccessType=rw
+CompactSubObj=3
+
+[2004]
+ParameterName=Offset
+ObjectType=0x7
+DataType=0x0007
+AccessType=rw
+DefaultValue=$NODEID+0x180
+'''
+
+
+def test_parse():
+    od = parseEds(EDS)
+    entry = od['Identity object.Vendor-ID']
+    assert (entry.index, entry.subindex, entry.Type) == (0x1018, 1, 'unsigned32')
+    assert od['speed'].bits == 16 and od['Speed'].pdoMapping
+    assert od['2003sub2'].Type == 'unsigned16'
+    assert od[(0x2003, 3)].name == '3'
+    assert od.objectName(0x2003) == 'Table'
+    assert od['Identity object'] is od[(0x1018, 0)]
+    with pytest.raises(KeyError):
+        od['missing']
+
+
+def test_compiled_cache(tmp_path):
+    path = tmp_path / 'drive.eds'
+    path.write_text(EDS)
+    cacheDir = tmp_path / 'cache'
+    first = loadObjectDictionary(str(path), str(cacheDir))
+    assert len(list(cacheDir.iterdir())) == 1
+    second = loadObjectDictionary(str(path), str(cacheDir))
+    assert second.entries == first.entries and second.names == first.names
+
+
+@pytest.fixture
+def od(canopen, network):
+    server = network.addNode(3)
+    server.setObject(0x2000, 0, -3, 'integer16')
+    server.setObject(0x2001, 0, 10, 'unsigned32')
+    server.setObject(0x2002, 0, 'abc', 'vis string')
+    od = parseEds(EDS)
+    canopen.addObjectDictionary(od, 3)
+    return server
+
+
+def test_sdo_by_name(canopen, od):
+    assert canopen.SDOUpload(3, 'Speed') == -3
+    assert canopen.SDOUpload(3, 'Counter') == 10
+    assert canopen.SDOUpload(3, 'Name') == 'abc'
+    canopen.SDODownload(3, 'Speed', data=-9)
+    canopen.SDODownload(3, 'Name', data='text')
+    assert canopen.SDOUpload(3, 0x2000) == -9
+    assert canopen.SDOUpload(3, parseEds(EDS)['Name']) == 'text'
+
+
+# (data type, value on the node, value written) of every type of DataTypes
+TYPE_VALUES = [(0x01, 1, 0), (0x02, -5, 7), (0x03, -300, 301), (0x04, -70000, 70001),
+               (0x05, 200, 3), (0x06, 60000, 4), (0x07, 0xFFFFFFF0, 5), (0x08, 1.5, -0.25),
+               (0x09, 'abc', 'defgh'), (0x0A, 'xyz', '0123456789'), (0x0B, 'uvw', 'u'),
+               (0x0F, 'dom', 'domain'), (0x11, -2.25e100, 1e-300),
+               (0x15, -2 ** 40, 2 ** 62), (0x1B, 2 ** 63 + 5, 1)]
+TYPES_EDS = ''.join('[%X]\nParameterName=Type%X\nObjectType=0x7\nDataType=0x%04X\nAccessType=rw\n\n'
+                    % (0x3000 + dataType, dataType, dataType) for dataType, _, _ in TYPE_VALUES)
+
+
+@pytest.mark.parametrize('dataType, value, written', TYPE_VALUES)
+def test_sdo_by_name_every_type(canopen, network, dataType, value, written):
+    od = parseEds(TYPES_EDS)
+    entry = od['Type%X' % dataType]
+    server = network.addNode(3)
+    server.setObject(entry.index, 0, value, entry.sdoType)
+    canopen.addObjectDictionary(od, 3)
+    assert canopen.SDOUpload(3, entry.name) == value
+    canopen.SDODownload(3, entry.name, data=written)
+    assert canopen.SDOUpload(3, entry.name) == written
+    canopen.download_record(3, entry.index, {0: value})
+    assert canopen.upload_record(3, entry.name, [0]) == {0: value}
+
+
+class Planted(object):
+    ''' Pickle running code when loaded '''
+    loaded = False
+
+    def __reduce__(self):
+        return (Planted.mark, ())
+
+    @staticmethod
+    def mark():
+        Planted.loaded = True
+        return (None, {}, {}, {})
+
+
+def test_default_cache_dir_private(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'xdg'))
+    path = tmp_path / 'drive.eds'
+    path.write_text(EDS)
+    loadObjectDictionary(str(path))
+    cacheDir = tmp_path / 'xdg' / 'canopenpy' / 'od'
+    assert oct(os.stat(cacheDir).st_mode & 0o777) == oct(0o700)
+    files = list(cacheDir.iterdir())
+    assert len(files) == 1 and os.stat(files[0]).st_mode & 0o077 == 0
+
+
+def test_shared_cache_dir_ignored(tmp_path):
+    path = tmp_path / 'drive.eds'
+    path.write_text(EDS)
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    os.chmod(shared, 0o777)
+    key = hashlib.sha1(EDS.encode('latin-1')).hexdigest()
+    with open(shared / ('%s-objectdictionary-%d.pickle' % (key, CACHE_VERSION)), 'wb') as f:
+        pickle.dump(Planted(), f)
+    od = loadObjectDictionary(str(path), str(shared))
+    assert not Planted.loaded
+    assert od['Speed'].index == 0x2000
+    # nothing written there either
+    assert len(list(shared.iterdir())) == 1
+
+
+def test_shared_cache_file_ignored(tmp_path):
+    path = tmp_path / 'drive.eds'
+    path.write_text(EDS)
+    cacheDir = tmp_path / 'cache'
+    loadObjectDictionary(str(path), str(cacheDir))
+    pickled = list(cacheDir.iterdir())[0]
+    with open(pickled, 'wb') as f:
+        pickle.dump(Planted(), f)
+    os.chmod(pickled, 0o666)
+    loadObjectDictionary(str(path), str(cacheDir))
+    assert not Planted.loaded
@@ -0,0 +1,267 @@
+import io
+import os
+import struct
+
+import pytest
+from conftest import waitFor
+from simslave import ABORT_NO_OBJECT, ABORT_CRC, ABORT_CS
+
+
+@pytest.fixture
+def node(network):
+    server = network.addNode(3)
+    server.setObject(0x2000, 1, -1234, 'integer16')
+    server.setObject(0x2000, 2, 0xDEADBEEF, 'unsigned32')
+    server.setObject(0x2000, 3, 7, 'unsigned8')
+    server.setObject(0x2001, 0, 'a segmented string', 'vis string')
+    server.setObject(0x2002, 0, b'', 'vis string')
+    return server
+
+
+def recordRequests(server):
+    ''' List of the frames server receives from now on '''
+    received = []
+    handle = server.handle
+
+    def record(msg):
+        received.append(bytes(msg))
+        return handle(msg)
+
+    server.handle = record
+    return received
+
+
+def test_expedited_upload(canopen, node):
+    assert canopen.SDOUpload(3, 0x2000, 1, 'integer16') == -1234
+    assert canopen.SDOUpload(3, 0x2000, 2, 'unsigned32') == 0xDEADBEEF
+    assert canopen.SDOUpload(3, 0x2000, 3, 'unsigned8') == 7
+
+
+def test_expedited_download(canopen, node):
+    canopen.SDODownload(3, 0x2000, 1, -5, 'integer16')
+    canopen.SDODownload(3, 0x2000, 2, 0x12345678, 'unsigned32')
+    assert node.getObject(0x2000, 1) == (-5).to_bytes(2, 'little', signed=True)
+    assert canopen.SDOUpload(3, 0x2000, 2, 'unsigned32') == 0x12345678
+
+
+def test_segmented_upload(canopen, node):
+    assert canopen.SDOUpload(3, 0x2001, 0, 'vis string') == 'a segmented string'
+    assert canopen.SDOUpload(3, 0x2001, 0, 'vis string', decode=False) == b'a segmented string'
+
+
+def test_empty_upload(canopen, node):
+    assert canopen.SDOUpload(3, 0x2002, 0, 'vis string') == ''
+    assert canopen.SDOUpload(3, 0x2002, 0, 'vis string', decode=False) == b''
+    assert canopen.SDOUploadStream(3, 0x2002, 0) == b''
+
+
+@pytest.mark.parametrize('size', [0, 1, 7, 8, 100, 5000])
+def test_segmented_download(canopen, node, size):
+    data = os.urandom(size)
+    canopen.SDODownload(3, 0x2002, 0, data, 'vis string')
+    assert node.getObject(0x2002, 0) == data
+    canopen.SDODownload(3, 0x2002, 0, memoryview(bytearray(data)), 'vis string')
+    assert node.getObject(0x2002, 0) == data
+
+
+def test_segmented_download_str(canopen, node):
+    canopen.SDODownload(3, 0x2002, 0, 'some text', 'vis string')
+    assert node.getObject(0x2002, 0) == b'some text'
+
+
+def test_download_from_file(canopen, node, tmp_path):
+    data = os.urandom(3000)
+    path = tmp_path / 'domain.bin'
+    path.write_bytes(b'head' + data)
+    with open(path, 'rb') as f:
+        f.seek(4)
+        canopen.SDODownload(3, 0x2002, 0, f, 'vis string')
+    assert node.getObject(0x2002, 0) == data
+
+
+def test_upload_stream(canopen, node):
+    data = os.urandom(1000)
+    node.setObject(0x2002, 0, data, 'vis string')
+    assert canopen.SDOUploadStream(3, 0x2002, 0) == data
+    sink = io.BytesIO()
+    progress = []
+    assert canopen.SDOUploadStream(3, 0x2002, 0, sink, lambda received, size: progress.append(received)) == 1000
+    assert sink.getvalue() == data
+    assert progress[-1] == 1000
+    buf = bytearray(1000)
+    assert canopen.SDOUploadStream(3, 0x2002, 0, memoryview(buf)) == 1000
+    assert buf == data
+    with pytest.raises(Exception):
+        canopen.SDOUploadStream(3, 0x2002, 0, bytearray(10))
+
+
+@pytest.mark.parametrize('size', [1, 100, 889, 890, 4096])
+def test_block_upload(canopen, node, size):
+    data = os.urandom(size)
+    node.setObject(0x2002, 0, data, 'vis string')
+    assert canopen.SDOUploadBlock(3, 0x2002, 0) == data
+    assert canopen.SDOUploadBlock(3, 0x2002, 0, size=5) == data
+
+
+def test_block_upload_lost_segment(canopen, node):
+    data = os.urandom(100)
+    node.setObject(0x2002, 0, data, 'vis string')
+    node.setFaults(dropSegment=8)
+    requests = recordRequests(node)
+    assert canopen.SDOUploadBlock(3, 0x2002, 0, size=5) == data
+    # the second block is acknowledged up to the segment before the lost one
+    # and then resent from it
+    assert requests[2:4] == [bytes((0xA2, 5, 5)) + bytes(5), bytes((0xA2, 2, 5)) + bytes(5)]
+
+
+def test_block_upload_crc_error(canopen, node):
+    node.setObject(0x2002, 0, os.urandom(100), 'vis string')
+    node.setFaults(corruptCrc=True)
+    requests = recordRequests(node)
+    with pytest.raises(Exception, match='CRC error'):
+        canopen.SDOUploadBlock(3, 0x2002, 0)
+    assert waitFor(lambda: requests[-1][0] == 0x80)
+    assert struct.unpack_from('<L', requests[-1], 4)[0] == ABORT_CRC
+
+
+@pytest.mark.parametrize('size, requests', [(0, 2), (3, 1), (14, 3), (15, 4)])
+def test_block_upload_protocol_switch(canopen, node, size, requests):
+    data = os.urandom(size)
+    node.setObject(0x2002, 0, data, 'vis string')
+    received = recordRequests(node)
+    assert canopen.SDOUploadBlock(3, 0x2002, 0, pst=14) == data
+    assert waitFor(lambda: len(received) == requests)
+    if size <= 14:
+        # answered as a normal upload: expedited, or upload segment requests follow
+        assert all(frame[0] & 0xE0 == 0x60 for frame in received[1:])
+    else:
+        # start, acknowledge, end
+        assert [frame[0] for frame in received[1:]] == [0xA3, 0xA2, 0xA1]
+
+
+@pytest.mark.parametrize('size', [1, 100, 889, 890, 4096])
+def test_block_download(canopen, node, size):
+    data = os.urandom(size)
+    canopen.SDODownloadBlock(3, 0x2002, 0, data)
+    assert node.getObject(0x2002, 0) == data
+
+
+def test_block_download_lost_segment(canopen, node):
+    data = os.urandom(100)
+    node.blksize = 5
+    node.setFaults(dropSegment=8)
+    requests = recordRequests(node)
+    canopen.SDODownloadBlock(3, 0x2002, 0, data)
+    assert node.getObject(0x2002, 0) == data
+    # the server acknowledged 2 segments of the second block, the next
+    # block starts with the lost third one
+    assert requests[6:12] == [bytes((seqno,)) + data[28 + 7 * seqno:35 + 7 * seqno] for seqno in range(1, 6)] + \
+        [bytes((1,)) + data[49:56]]
+
+
+def test_block_download_crc_error(canopen, node):
+    node.setObject(0x2002, 0, b'old', 'vis string')
+    node.setFaults(corruptCrc=True)
+    with pytest.raises(Exception, match='CRC error'):
+        canopen.SDODownloadBlock(3, 0x2002, 0, os.urandom(100))
+    assert node.getObject(0x2002, 0) == b'old'
+
+
+def test_record(canopen, node):
+    canopen.download_record(3, 0x2000, {1: -7, 2: 9, 3: 1},
+                            {1: 'integer16', 2: 'unsigned32', 3: 'unsigned8'})
+    assert canopen.upload_record(3, 0x2000, [1, 2, 3],
+                                 {1: 'integer16', 2: 'unsigned32', 3: 'unsigned8'}) == {1: -7, 2: 9, 3: 1}
+
+
+@pytest.mark.parametrize('refuse, block', [(None, True), (ABORT_CS, False)])
+def test_record_strings(canopen, node, refuse, block):
+    values = {1: 'short', 2: 'too long for a segmented transfer'}
+    node.setObject(0x2003, 1, '', 'vis string')
+    node.setObject(0x2003, 2, '', 'vis string')
+    node.setFaults(refuseBlock=refuse)
+    canopen.download_record(3, 0x2003, values, 'vis string')
+    assert [node.getObject(0x2003, sub) for sub in (1, 2)] == [b'short', b'too long for a segmented transfer']
+    assert canopen.upload_record(3, 0x2003, [1, 2], 'vis string') == values
+    # block transfers for the long string, or segmented once the node refused one
+    assert canopen.blockSupport[3] is block
+
+
+def test_upload_abort(canopen, node):
+    with pytest.raises(Exception, match='Abort code'):
+        canopen.SDOUpload(3, 0x3000, 0, 'unsigned32')
+    node.setAbort(0x2000, 2, ABORT_NO_OBJECT)
+    with pytest.raises(Exception, match='Abort code'):
+        canopen.SDOUpload(3, 0x2000, 2, 'unsigned32')
+
+
+def test_download_abort(canopen, node):
+    with pytest.raises(Exception, match='Abort code'):
+        canopen.SDODownload(3, 0x1000, 0, 1, 'unsigned32')
+    with pytest.raises(Exception, match='Abort code'):
+        canopen.SDODownload(3, 0x3000, 0, b'0123456789', 'vis string')
+    with pytest.raises(Exception, match='Abort code'):
+        canopen.SDODownloadBlock(3, 0x3000, 0, b'0123456789' * 20)
+    # the client recovers after an abort
+    assert canopen.SDOUpload(3, 0x2000, 3, 'unsigned8') == 7
+
+
+def test_timeout(canopen, node):
+    canopen.timeout = 0.01
+    with pytest.raises(Exception, match='Timeout'):
+        canopen.SDOUpload(5, 0x1000, 0, 'unsigned32')
+    with pytest.raises(Exception, match='Timeout'):
+        canopen.SDODownload(5, 0x2000, 1, 1, 'unsigned8')
+    with pytest.raises(Exception, match='Timeout'):
+        canopen.SDOUploadBlock(5, 0x2002, 0)
+    assert canopen.SDOUpload(3, 0x2000, 3, 'unsigned8') == 7
+
+
+
+def test_segment_timeout_aborts(canopen, node):
+    # the node stops answering after the initiate of a segmented download
+    received = []
+    handle = node.handle
+
+    def mute(msg):
+        received.append(bytes(msg))
+        return handle(msg) if len(received) == 1 else []
+
+    node.handle = mute
+    canopen.timeout = 0.02
+    with pytest.raises(Exception, match='Timeout'):
+        canopen.SDODownload(3, 0x2002, 0, b'0123456789', 'vis string')
+    # the client aborted the transfer with the SDO protocol timeout
+    assert waitFor(lambda: len(received) == 3)
+    assert received[2] == bytes((0x80, 0x02, 0x20, 0x00, 0x00, 0x00, 0x04, 0x05))
+
+@pytest.mark.parametrize('bitrate, timeout', [(250000, 0.04), (125000, 0.05)])
+def test_block_download_timed_bus(bitrate, timeout):
+    # a block of 127 segments takes 56 ms at 250 kbit/s and 112 ms at
+    # 125 kbit/s on the bus, longer than the SDO timeout; the timeout itself
+    # leaves room for the thread wake-ups of the simulation
+    import canopenpy
+    import virtualcan
+    from simslave import SimNetwork
+    bus = virtualcan.VirtualBus(bitrate)
+    channel = bus.openChannel(1)
+    channel.open()
+    network = SimNetwork(channel, pollTimeout=0.01)
+    server = network.addNode(3)
+    server.setObject(0x2002, 0, b'', 'vis string')
+    network.start()
+    master = bus.openChannel(0)
+    master.open()
+    co = canopenpy.CanOpen(master)
+    co.bitrate = bitrate
+    co.timeout = timeout
+    try:
+        data = os.urandom(4096)
+        co.SDODownloadBlock(3, 0x2002, 0, data)
+        assert server.getObject(0x2002, 0) == data
+        co.startDispatcher(pollTimeout=0.01)
+        co.SDODownloadBlock(3, 0x2002, 0, data[::-1])
+        assert server.getObject(0x2002, 0) == data[::-1]
+    finally:
+        network.stop()
+        co.close()
@@ -0,0 +1,308 @@
+import struct
+import threading
+import time
+
+import pytest
+from conftest import waitFor
+from pdo import ProcessImage, TpdoConsumer, pdoFormat
+from nmt import NmtMonitor, EVENT_BOOTUP, EVENT_STATE, EVENT_TIMEOUT, EVENT_RECOVERED, NMT_OPERATIONAL
+from emcy import EmcyConsumer
+from pdo import RpdoProducer
+from syncproducer import SyncProducer
+from objectdictionary import parseEds
+
+
+def test_tpdo_decode(canopen, sender):
+    image = ProcessImage()
+    consumer = TpdoConsumer(canopen, image)
+    pdo = consumer.addPdo(3, 1, [(0x6041, 0, 16), (0x6064, 0, 32)], {(0x6064, 0): 'integer32'})
+    consumer.start()
+    try:
+        sender.write(0x183, struct.pack('<Hl', 0x1237, -100000))
+        assert waitFor(lambda: pdo.count == 1)
+        assert image[3, 0x6041, 0] == 0x1237
+        assert image[3, 0x6064, 0] == -100000
+        # too short for the mapping
+        sender.write(0x183, b'\x01\x02')
+        assert waitFor(lambda: pdo.errors == 1)
+    finally:
+        consumer.stop()
+
+
+
+def test_pdo_format_types():
+    # every type of TypeLength, whatever the case
+    assert pdoFormat([(0x6064, 0, 32), (0x6065, 0, 32)], {(0x6064, 0): 'real32', (0x6065, 0): 'Integer32'}) == \
+        ('<fl', [(0x6064, 0), (0x6065, 0)])
+    for Type, code in (('integer64', 'q'), ('unsigned64', 'Q'), ('real64', 'd')):
+        assert pdoFormat([(0x2000, 1, 64)], {(0x2000, 1): Type})[0] == '<' + code
+    with pytest.raises(Exception, match='does not have 32 bits'):
+        pdoFormat([(0x2000, 1, 32)], {(0x2000, 1): 'real64'})
+
+
+def test_tpdo_decode_list_data(canopen):
+    # canlib and ni8473a return the data of a frame as a list
+    image = ProcessImage()
+    consumer = TpdoConsumer(canopen, image)
+    pdo = consumer.addPdo(3, 1, [(0x6041, 0, 16), (0x6064, 0, 32)], {(0x6064, 0): 'integer32'})
+    consumer.start()
+    try:
+        canopen.dispatcher.dispatch((0x183, list(struct.pack('<Hl', 0x1237, -7)), 6, 0, 0, 0))
+        assert pdo.count == 1 and pdo.errors == 0
+        assert image[3, 0x6064, 0] == -7
+    finally:
+        consumer.stop()
+
+
+def test_periodic_producers(canopen, sender):
+    image = ProcessImage()
+    rpdo = RpdoProducer(canopen, image, period=0.002)
+    pdo = rpdo.addPdo(3, 1, [(0x6040, 0, 16)])
+    image[3, 0x6040, 0] = 0x0F
+    sync = SyncProducer(canopen, period=0.002, overflow=3)
+    with rpdo, sync:
+        assert waitFor(lambda: sync.cycles >= 5 and pdo.count >= 5)
+    frames = []
+    while True:
+        try:
+            frames.append(sender.read(0))
+        except Exception:
+            break
+    assert [bytes(f[1]) for f in frames if f[0] == 0x80][:4] == [b'\x01', b'\x02', b'\x03', b'\x01']
+    assert all(bytes(f[1]) == b'\x0f\x00' for f in frames if f[0] == 0x203)
+    for stats, extra in ((rpdo.stats(), 'inhibited'), (sync.stats(), 'skipped')):
+        assert stats['cycles'] >= 5 and stats['period'] > 0 and extra in stats
+    assert sum(sync.histograms()[0]) == sync.cycles
+    sync.resetStats()
+    assert sync.stats()['cycles'] == 0 and sum(sync.histograms()[0]) == 0
+
+def test_overrun_accounting(canopen):
+    # one cycle takes 3.5 periods: one overrun, 3 cycles never sent
+    period = 0.05
+    for producer, name in ((RpdoProducer(canopen, period=period), 'cycle'),
+                           (SyncProducer(canopen, period=period), 'send')):
+        calls = []
+        original = getattr(producer, name)
+
+        def slow(*args, original=original, calls=calls):
+            calls.append(args)
+            if len(calls) == 2:
+                time.sleep(3.5 * period)
+            return original(*args)
+
+        setattr(producer, name, slow)
+        with producer:
+            assert waitFor(lambda: producer.cycles >= 4)
+        stats = producer.stats()
+        assert (stats['overruns'], stats['skipped']) == (1, 3)
+
+
+def test_nmt_timeout_and_recovery(canopen, sender):
+    events = []
+    monitor = NmtMonitor(canopen, tick=0.002)
+    monitor.addCallback(lambda nodeId, event, state: events.append((nodeId, event)))
+    monitor.start()
+    try:
+        monitor.supervise(5, timeout=0.03)
+        sender.write(0x705, b'\x00')
+        sender.write(0x705, bytes((NMT_OPERATIONAL,)))
+        assert waitFor(lambda: monitor.isAlive(5))
+        assert waitFor(lambda: (5, EVENT_TIMEOUT) in events)
+        assert not monitor.isAlive(5)
+        sender.write(0x705, bytes((NMT_OPERATIONAL,)))
+        assert waitFor(lambda: (5, EVENT_RECOVERED) in events)
+        assert events[:2] == [(5, EVENT_BOOTUP), (5, EVENT_STATE)]
+        # reported once per loss
+        assert events.count((5, EVENT_TIMEOUT)) == 1
+        assert monitor.nodes() == {5: NMT_OPERATIONAL}
+    finally:
+        monitor.stop()
+
+
+def test_nmt_receive_takes_lock(canopen):
+    # a heartbeat waits while the monitor thread checks the timeouts
+    monitor = NmtMonitor(canopen)
+    events = []
+    monitor.addCallback(lambda nodeId, event, state: events.append((nodeId, event)))
+    monitor.supervise(5, timeout=0.03)
+    monitor.lost[5] = True
+    with monitor.lock:
+        thread = threading.Thread(target=monitor.receive, args=((0x705, bytes((NMT_OPERATIONAL,))),))
+        thread.start()
+        thread.join(0.05)
+        assert thread.is_alive() and monitor.states[5] is None
+    thread.join()
+    assert monitor.isAlive(5)
+    assert events == [(5, EVENT_RECOVERED), (5, EVENT_STATE)]
+
+
+def test_emcy_ring(canopen, sender):
+    consumer = EmcyConsumer(canopen, history=4)
+    received = []
+    consumer.addCallback(received.append)
+    events = consumer.subscribe(maxsize=3)
+    consumer.start()
+    try:
+        for i in range(1, 7):
+            sender.write(0x83, struct.pack('<HB5s', 0x2300 + i, 1, b'abcde'))
+        assert waitFor(lambda: consumer.counts[3] == 6 and len(received) == 6)
+        history = consumer.history[3]
+        assert [emcy.code for emcy in history] == [0x2303, 0x2304, 0x2305, 0x2306]
+        assert consumer.last(3).data == b'abcde'
+        assert consumer.errors() == {3: consumer.last(3)}
+        # the subscriber queue kept the latest
+        assert [events.get_nowait().code for i in range(3)] == [0x2304, 0x2305, 0x2306]
+        assert consumer.dropped == 3
+        sender.write(0x83, bytes(8))
+        assert waitFor(lambda: consumer.counts[3] == 7)
+        assert consumer.errors() == {}
+    finally:
+        consumer.stop()
+
+
+@pytest.fixture
+def node(network):
+    server = network.addNode(3)
+    server.setObject(0x2000, 1, 5, 'unsigned32')
+    server.setObject(0x1008, 0, 'drive', 'vis string', readOnly=True)
+    return server
+
+
+def test_read_error_history(canopen, node):
+    consumer = EmcyConsumer(canopen)
+    node.setObject(0x1003, 0, 0, 'unsigned8')
+    assert consumer.readErrorHistory(3) == []
+    node.setObject(0x1003, 0, 2, 'unsigned8')
+    node.setObject(0x1003, 1, 0x00122310, 'unsigned32')
+    node.setObject(0x1003, 2, 0x00005530, 'unsigned32')
+    assert consumer.readErrorHistory(3) == [(0x2310, 0x12), (0x5530, 0)]
+    histories = consumer.readErrorHistories([3, 4])
+    assert histories[3] == [(0x2310, 0x12), (0x5530, 0)]
+    assert isinstance(histories[4], Exception)
+
+
+def test_cache_hit_miss_invalidate(canopen, node):
+    cache = canopen.enableSdoCache(default=60)
+    requests = node.requests
+    assert canopen.SDOUpload(3, 0x2000, 1, 'unsigned32') == 5
+    assert canopen.SDOUpload(3, 0x2000, 1, 'unsigned32') == 5
+    assert node.requests == requests + 1
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+    # a download invalidates the cached value
+    canopen.SDODownload(3, 0x2000, 1, 6, 'unsigned32')
+    assert canopen.SDOUpload(3, 0x2000, 1, 'unsigned32') == 6
+    # an explicit invalidation or cached=False reads from the node
+    node.setObject(0x2000, 1, 7, 'unsigned32')
+    assert canopen.SDOUpload(3, 0x2000, 1, 'unsigned32') == 6
+    assert canopen.SDOUpload(3, 0x2000, 1, 'unsigned32', cached=False) == 7
+    node.setObject(0x2000, 1, 8, 'unsigned32')
+    cache.invalidate(3)
+    assert canopen.SDOUpload(3, 0x2000, 1, 'unsigned32') == 8
+
+
+def test_cache_policies(canopen, node):
+    cache = canopen.enableSdoCache(default='never')
+    canopen.SDOUpload(3, 0x2000, 1, 'unsigned32')
+    canopen.SDOUpload(3, 0x2000, 1, 'unsigned32')
+    assert cache.stats()['hits'] == 0
+    # pinned by default
+    assert canopen.SDOUpload(3, 0x1008, 0, 'vis string') == 'drive'
+    requests = node.requests
+    assert canopen.SDOUpload(3, 0x1008, 0, 'vis string') == 'drive'
+    assert node.requests == requests
+    cache.setPolicy(0x2000, policy=0.01)
+    canopen.SDOUpload(3, 0x2000, 1, 'unsigned32')
+    time.sleep(0.02)
+    requests = node.requests
+    canopen.SDOUpload(3, 0x2000, 1, 'unsigned32')
+    assert node.requests == requests + 1
+
+
+CACHE_EDS = '''
+[2000]
+ParameterName=Vendor code
+ObjectType=0x7
+DataType=0x0007
+AccessType=const
+
+[2001]
+ParameterName=Status
+ObjectType=0x7
+DataType=0x0007
+AccessType=ro
+'''
+
+
+def test_cache_od_access(canopen, node):
+    node.setObject(0x2000, 0, 5, 'unsigned32')
+    node.setObject(0x2001, 0, 1, 'unsigned32')
+    canopen.addObjectDictionary(parseEds(CACHE_EDS), 3)
+    canopen.enableSdoCache(default='never')
+    requests = node.requests
+    for _ in range(2):
+        assert canopen.SDOUpload(3, 'Vendor code') == 5
+        assert canopen.SDOUpload(3, 'Status') == 1
+    # const pinned, ro read from the node every time
+    assert node.requests == requests + 3
+    node.setObject(0x2001, 0, 2, 'unsigned32')
+    assert canopen.SDOUpload(3, 'Status') == 2
+
+
+@pytest.fixture
+def mapped(network):
+    server = network.addNode(3)
+    server.setObject(0x1800, 1, 0x183, 'unsigned32')
+    server.setObject(0x1800, 2, 255, 'unsigned8')
+    server.setObject(0x1A00, 0, 2, 'unsigned8')
+    server.setObject(0x1A00, 1, 0x60410010, 'unsigned32')
+    server.setObject(0x1A00, 2, 0x60640020, 'unsigned32')
+    for subindex in range(3, 9):
+        server.setObject(0x1A00, subindex, 0, 'unsigned32')
+    return server
+
+
+def test_apply_pdo_mapping_noop(canopen, mapped):
+    entries = [(0x6041, 0, 16), (0x6064, 0, 32)]
+    assert canopen.apply_pdo_mapping(3, 1, 'Tx', entries, 255) is False
+    requests = mapped.requests
+    assert canopen.apply_pdo_mapping(3, 1, 'Tx', entries, 255) is False
+    assert mapped.requests == requests
+
+
+def test_apply_pdo_mapping_changed(canopen, mapped):
+    entries = [(0x6041, 0, 16), (0x606C, 0, 32)]
+    assert canopen.apply_pdo_mapping(3, 1, 'Tx', entries) is True
+    assert canopen.read_pdo_mapping(3, 1, 'Tx', refresh=True) == (0x183, 255, (0x60410010, 0x606C0020))
+    requests = mapped.requests
+    assert canopen.apply_pdo_mapping(3, 1, 'tx', entries, 1) is True
+    # only the transmission type was written
+    assert mapped.requests == requests + 1
+    assert mapped.getObject(0x1800, 2) == b'\x01'
+
+
+def test_read_mapping(canopen, mapped):
+    image = ProcessImage()
+    consumer = TpdoConsumer(canopen, image)
+    pdo = consumer.readMapping(3, 1, {(0x6064, 0): 'integer32'})
+    assert (pdo.cobId, pdo.keys) == (0x183, [(0x6041, 0), (0x6064, 0)])
+    # the mapping left by apply_pdo_mapping, without reading it again
+    canopen.apply_pdo_mapping(3, 1, 'Tx', [(0x6041, 0, 16), (0x606C, 0, 32)])
+    requests = mapped.requests
+    pdo = consumer.readMapping(3, 1)
+    assert pdo.keys == [(0x6041, 0), (0x606C, 0)] and mapped.requests == requests
+    assert consumer.readMapping(3, 1, refresh=True).keys == pdo.keys
+    assert mapped.requests > requests
+
+
+def test_cache_raw_type(canopen, node):
+    node.setObject(0x2001, 0, 'a segmented string', 'vis string')
+    node.setObject(0x2002, 0, 'abc', 'vis string')
+    canopen.enableSdoCache(default=60)
+    for index, data in ((0x2001, b'a segmented string'), (0x2002, b'abc')):
+        miss = canopen.SDOUpload(3, index, 0, 'vis string', decode=False)
+        hit = canopen.SDOUpload(3, index, 0, 'vis string', decode=False)
+        assert type(miss) is type(hit) is bytearray
+        assert miss == hit == data
+        # a caller changing its copy does not change the cache
+        hit[0] = 0
+        assert canopen.SDOUpload(3, index, 0, 'vis string', decode=False) == data
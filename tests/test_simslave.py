@@ -0,0 +1,45 @@
+import struct
+
+from canopenpy import crc16
+from simslave import SdoServer, ABORT_CS, ABORT_CRC
+
+DATA = bytes(range(20))
+
+
+def blockUpload(server, blksize=127):
+    ''' Initiate and start a block upload of 0x2002, the frames of the first block '''
+    assert server.handle(struct.pack('<BHBBB', 0xA4, 0x2002, 0, blksize, 0))[0][0] & 0xE0 == 0xC0
+    return server.handle(b'\xa3')
+
+
+def test_server_drops_segment():
+    server = SdoServer(3)
+    server.setObject(0x2002, 0, DATA, 'vis string')
+    server.setFaults(dropSegment=2)
+    assert [frame[0] for frame in blockUpload(server)] == [1, 0x83]
+    # resent from the acknowledged segment on, no longer lost
+    assert [frame[0] for frame in server.handle(b'\xa2\x01\x7f')] == [1, 0x82]
+
+
+def test_server_corrupts_crc():
+    server = SdoServer(3)
+    server.setObject(0x2002, 0, DATA, 'vis string')
+    server.setFaults(corruptCrc=True)
+    blockUpload(server)
+    end = server.handle(b'\xa2\x03\x7f')[0]
+    assert struct.unpack_from('<H', end, 1)[0] != crc16(DATA)
+    # a block download with the right CRC is refused
+    server.handle(struct.pack('<BHBL', 0xC6, 0x2002, 0, 3))
+    assert server.handle(b'\x81abc\0\0\0\0') == [bytes((0xA2, 1, 127)) + bytes(5)]
+    abort = server.handle(struct.pack('<BH', 0xC1 | (4 << 2), crc16(b'abc')) + bytes(5))[0]
+    assert struct.unpack_from('<BHBL', abort) == (0x80, 0x2002, 0, ABORT_CRC)
+
+
+def test_server_refuses_block():
+    server = SdoServer(3)
+    server.setObject(0x2002, 0, DATA, 'vis string')
+    server.setFaults(refuseBlock=ABORT_CS)
+    for initiate in (struct.pack('<BHBBB', 0xA4, 0x2002, 0, 127, 0), struct.pack('<BHBL', 0xC6, 0x2002, 0, 3)):
+        assert struct.unpack_from('<BHBL', server.handle(initiate)[0]) == (0x80, 0x2002, 0, ABORT_CS)
+    server.setFaults()
+    assert len(blockUpload(server)) == 3
@@ -0,0 +1,130 @@
+import errno
+import select
+import socket
+import time
+
+import pytest
+import socketcan
+from canlib import canNoMsg, canMSG_RTR, canMSG_STD, canMSG_EXT
+from socketcan import canFrame, canFilter, CAN_EFF_FLAG, CAN_RTR_FLAG, CAN_SFF_MASK
+
+
+class FullQueueSocket(object):
+    ''' Refuses the first frames with ENOBUFS, as a full transmit queue does '''
+
+    def __init__(self, refused):
+        self.refused = refused
+        self.sent = []
+
+    def send(self, buf):
+        if self.refused:
+            self.refused -= 1
+            raise OSError(errno.ENOBUFS, 'No buffer space available')
+        self.sent.append(bytes(buf))
+        return len(buf)
+
+
+class IdlePoller(object):
+    ''' poll of a socket nothing arrives on, records the timeouts [ms] '''
+
+    def __init__(self):
+        self.timeouts = []
+
+    def poll(self, timeout):
+        self.timeouts.append(timeout)
+        time.sleep(timeout / 1000.0)
+        return []
+
+
+def test_write_retries_full_queue():
+    ch = socketcan.canChannel('vcan0')
+    ch.sock = FullQueueSocket(3)
+    ch.write(0x601, b'\x40\x00\x10\x00')
+    assert len(ch.sock.sent) == 1
+
+
+def test_write_gives_up():
+    ch = socketcan.canChannel('vcan0', writeTimeout=0.01)
+    ch.sock = FullQueueSocket(10 ** 6)
+    with pytest.raises(OSError):
+        ch.write(0x601, b'\x40')
+    assert not ch.sock.sent
+
+
+def test_read_specific_does_not_spin():
+    ch = socketcan.canChannel('vcan0')
+    ch.poller = IdlePoller()
+    with pytest.raises(canNoMsg):
+        ch.readSpecific(0x581, 2.5)
+    # the last part of a millisecond is waited for, not polled for
+    assert 0 not in ch.poller.timeouts[:-1]
+    assert len(ch.poller.timeouts) <= 4
+
+
+class OptionSocket(object):
+    ''' Records the socket options set '''
+
+    def __init__(self):
+        self.options = []
+
+    def setsockopt(self, level, option, value):
+        self.options.append((level, option, value))
+
+
+@pytest.fixture
+def pair():
+    ''' Channel reading one end of a datagram socket pair, the other end
+    sends the struct can_frame the kernel would deliver
+    '''
+    ch = socketcan.canChannel('vcan0')
+    ch.sock, peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    ch.poller = select.poll()
+    ch.poller.register(ch.sock, select.POLLIN)
+    yield ch, peer
+    ch.close()
+    peer.close()
+
+
+def test_fill_parses_frames(pair):
+    ch, peer = pair
+    peer.send(canFrame.pack(0x181, 2, b'\x11\x22' + bytes(6)))
+    peer.send(canFrame.pack(0x1234567 | CAN_EFF_FLAG, 8, b'\x33' * 8))
+    peer.send(canFrame.pack(0x701 | CAN_RTR_FLAG, 0, bytes(8)))
+    peer.send(canFrame.pack(0x201, 15, b'\x44' * 8))
+    # shorter than a can_frame, skipped
+    peer.send(b'\x01\x02')
+    assert ch._fill(100) == 4
+    assert [frame[:4] for frame in ch.rxFrames] == [
+        (0x181, b'\x11\x22', 2, canMSG_STD),
+        (0x1234567, b'\x33' * 8, 8, canMSG_EXT),
+        (0x701, b'', 0, canMSG_STD | canMSG_RTR),
+        (0x201, b'\x44' * 8, 8, canMSG_STD)]
+    assert ch.read()[0] == 0x181
+
+
+def test_read_many_from_socket(pair):
+    np = pytest.importorskip('numpy')
+    ch, peer = pair
+    for cobId in range(0x181, 0x185):
+        peer.send(canFrame.pack(cobId, 3, b'abc' + bytes(5)))
+    frames = ch.read_many(timeout=100)
+    assert list(frames['id']) == [0x181, 0x182, 0x183, 0x184]
+    assert list(frames['flags']) == [canMSG_STD] * 4
+    assert bytes(frames['data'][0]) == b'abc' + bytes(5)
+    assert len(ch.read_many()) == 0
+
+
+def test_set_filters():
+    ch = socketcan.canChannel('vcan0')
+    # kept until open creates the socket
+    ch.setFilters([0x581, 0x701])
+    assert ch.filters == [0x581, 0x701]
+    ch.sock = OptionSocket()
+    ch.setFilters([0x581, 0x701])
+    mask = CAN_SFF_MASK | CAN_EFF_FLAG | CAN_RTR_FLAG
+    assert ch.sock.options == [(socket.SOL_CAN_RAW, socket.CAN_RAW_FILTER,
+                                canFilter.pack(0x581, mask) + canFilter.pack(0x701, mask))]
+    ch.setFilters(None)
+    assert ch.sock.options[-1][2] == canFilter.pack(0, 0)
+    ch.setFilters([])
+    assert ch.sock.options[-1][2] == b''